@@ -6,9 +6,8 @@ from mongoengine.context_managers import switch_db
 from kaka.settings import TEST_DB_ALIAS
 from mongcore.query_from_request import QueryRequestHandler
 from mongcore.models import Experiment, DataSource, make_table_datasource
-from mongcore.query_set_helpers import query_to_csv_rows_list
 from mongcore.view_helpers import write_stream_response
-from mongenotype.models import Genotype
+from mongenotype.matrix import has_genotypes, study_csv_rows
 from web.views import genotype_report
 from . import forms as my_forms
 from .tables import DataSourceTable
@@ -157,31 +156,30 @@ def stream_experiment_csv(request, experi_id):
     """
     global csv_response
     redirect_address = get_redirect_address(request)
-    genotype, experi = query_genotype_by_experiment(experi_id)
+    db_alias = TEST_DB_ALIAS if testing else 'default'
+    experi = query_experiment(experi_id)
 
-    if len(genotype) == 0:
+    if not has_genotypes(experi, db_alias):
         # No data found so go to the no_download page
         return render(
             request, "experimentsearch/no_download.html", {"from_url": redirect_address}
         )
 
-    rows = query_to_csv_rows_list(genotype, testing=testing)
+    # the genotype documents and matrices are read one after another as the rows stream
+    rows = study_csv_rows(experi, db_alias, testing=testing)
 
     csv_response = write_stream_response(rows, experi.name)
     return redirect(redirect_address)
 
 
-def query_genotype_by_experiment(experi_id):
+def query_experiment(experi_id):
     db_alias = TEST_DB_ALIAS if testing else 'default'
     # Make query
     try:
         with switch_db(Experiment, db_alias) as Exper:
-            ex = Exper.objects.get(id=experi_id)
+            return Exper.objects.get(id=experi_id)
     except Experiment.DoesNotExist:
         raise Http404("Experiment does not exist")
-    with switch_db(Genotype, db_alias) as Gen:
-        genotype = Gen.objects(study=ex)
-    return genotype, ex
 
 
 def get_redirect_address(request):
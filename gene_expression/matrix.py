@@ -0,0 +1,145 @@
+"""
+Writes count tables of expression experiments to ExpressionMatrix storage in one pass,
+taking the condition and lib_type of each library from the experiment's Target documents
+"""
+
+from array import array
+from mongoengine.context_managers import switch_db
+from mongcore.models import DataError
+from mongenotype.matrix import positions_getter
+from .models import Target, ExpressionMatrix, ExpressionMatrixChunk
+
+# Columns of count tables that describe the gene rather than a library
+gene_info_columns = ['gene_id', 'name', 'length', 'gene_name', 'description']
+missing_values = ('', 'NA', 'NaN', 'nan', None)
+
+
+def to_float(value):
+    if value in missing_values:
+        return float('nan')
+    try:
+        return float(value)
+    except ValueError:
+        raise DataError("Not an expression value: %r" % value)
+
+
+def library_info(libraries, datasource=None, db_alias='default'):
+    """
+    Condition and lib_type of each library, from the Target documents whose column is
+    the library's name. Libraries without a Target get empty strings
+
+    :param libraries: Library names, as in the header of the count table
+    :param datasource: Data source of the Targets, or None for any
+    :return: Lists of the conditions and lib_types, in the order of libraries
+    """
+    with switch_db(Target, db_alias) as Tar:
+        query = Tar.objects(column__in=libraries)
+        if datasource is not None:
+            query = query.filter(datasource=datasource)
+        targets = dict((target.column, target) for target in query.only('column', 'condition', 'lib_type'))
+    conditions = [targets[lib].condition or '' if lib in targets else '' for lib in libraries]
+    lib_types = [targets[lib].lib_type or '' if lib in targets else '' for lib in libraries]
+    return conditions, lib_types
+
+
+class ExpressionMatrixWriter:
+    """
+    Writes positional rows of a count table to a new ExpressionMatrix. The gene column
+    and any other gene info columns are kept as strings, every other column is a
+    library. Values are written chunk_values at a time, each chunk as one
+    ExpressionMatrixChunk
+    """
+
+    def __init__(self, header, gene_column='gene_id', db_alias='default', chunk_values=1 << 20,
+                 conditions=None, lib_types=None, on_insert=None, **fields):
+        """
+        :param header: Column names of the rows that will be added
+        :param gene_column: Column holding the gene ids
+        :param db_alias: Alias of database to write to
+        :param chunk_values: Number of values written per chunk
+        :param conditions: Condition of each library, as a list in column order or a
+                           dictionary keyed by library name, or None to take them from
+                           the Targets
+        :param lib_types: lib_type of each library, as for conditions
+        :param on_insert: Called with the number of chunks each time chunks are written
+        :param fields: Values for the ExpressionMatrix fields, eg. study and datasource
+        """
+        if gene_column not in header:
+            raise DataError("Count table has no %s column" % gene_column)
+        info = [i for i, h in enumerate(header) if h == gene_column or h in gene_info_columns]
+        libraries = [i for i in range(len(header)) if i not in info]
+        names = [header[i] for i in libraries]
+        if isinstance(conditions, dict):
+            conditions = [conditions.get(name, '') for name in names]
+        if isinstance(lib_types, dict):
+            lib_types = [lib_types.get(name, '') for name in names]
+        if conditions is None or lib_types is None:
+            found = library_info(names, fields.get('datasource'), db_alias)
+            conditions = found[0] if conditions is None else conditions
+            lib_types = found[1] if lib_types is None else lib_types
+        self.width = len(header)
+        self.db_alias = db_alias
+        self.on_insert = on_insert
+        self.pick_info = positions_getter(info)
+        self.pick_values = positions_getter(libraries)
+        self.chunk_rows = max(1, chunk_values // max(1, len(libraries)))
+        self.matrix = ExpressionMatrix(
+            gene_column=gene_column, info_columns=[header[i] for i in info], libraries=names,
+            conditions=list(conditions), lib_types=list(lib_types), **fields
+        )
+        self.matrix.switch_db(db_alias)
+        self.matrix.save()
+        self.info = []
+        self.values = array('f')
+
+    def add(self, row):
+        if len(row) < self.width:
+            row = list(row) + [''] * (self.width - len(row))
+        self.info.append(['' if value is None else str(value) for value in self.pick_info(row)])
+        self.values.extend(map(to_float, self.pick_values(row)))
+        if len(self.info) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.info:
+            return
+        start = self.matrix.n_genes
+        chunk = ExpressionMatrixChunk(
+            matrix=self.matrix, start=start, stop=start + len(self.info), info=self.info,
+            values=self.values.tobytes(), ingest_run=self.matrix.ingest_run,
+        )
+        chunk.switch_db(self.db_alias)
+        chunk.save()
+        self.matrix.n_genes = chunk.stop
+        with switch_db(ExpressionMatrix, self.db_alias) as Matrix:
+            Matrix.objects(id=self.matrix.id).update_one(set__n_genes=self.matrix.n_genes)
+        self.info = []
+        self.values = array('f')
+        if self.on_insert:
+            self.on_insert(1)
+
+
+def load_count_table(conn, gene_column='gene_id', db_alias='default', chunk_size=1000, **fields):
+    """
+    Writes every row of a count table to a new ExpressionMatrix, in one pass over the
+    connector's rows
+
+    :param conn: Connector of the count table (eg. CsvConnector or ExcelConnector)
+    :param fields: Values for the ExpressionMatrix fields, eg. study and datasource
+    :return: The ExpressionMatrix
+    """
+    writer = ExpressionMatrixWriter(conn.header, gene_column, db_alias, **fields)
+    for rows in conn.chunks(chunk_size):
+        for row in rows:
+            writer.add(row)
+    writer.flush()
+    return writer.matrix
+
+
+def delete_expression_matrices(datasource, db_alias='default'):
+    # Removes the matrices loaded from the given data source, with their chunks
+    with switch_db(ExpressionMatrix, db_alias) as Matrix:
+        ids = [matrix.id for matrix in Matrix.objects(datasource=datasource).only('id')]
+        with switch_db(ExpressionMatrixChunk, db_alias) as Chunk:
+            Chunk.objects(matrix__in=ids).delete()
+        return Matrix.objects(id__in=ids).delete()
@@ -1,6 +1,8 @@
 import mongoengine
+from array import array
+from mongoengine.context_managers import switch_db
 
-from mongcore.models import Feature, Species
+from mongcore.models import Feature, Species, Experiment, DataSource
 
 
 from jsonfield import JSONField
@@ -16,7 +18,127 @@ class Target(Feature):
     condition = mongoengine.StringField(max_length=255)
     lib_type = mongoengine.StringField(max_length=255)
 
-    
+
 class Gene(Feature):
     gene_id = mongoengine.StringField(max_length=255)
     length = mongoengine.IntField()
+
+
+class ExpressionMatrix(mongoengine.Document):
+    """
+    Expression values of one expression experiment stored as a matrix instead of a Gene
+    document per row of its count table. The libraries (the count table's sample
+    columns) are kept once, in column order, with the condition and lib_type of each,
+    and the values are stored a chunk of genes at a time in ExpressionMatrixChunk
+    documents, as float32 with the values of a gene next to each other. Columns that
+    describe the gene rather than a library (its id, name, length and so on) are kept as
+    strings in info_columns order
+    """
+    study = mongoengine.ReferenceField(Experiment)
+    datasource = mongoengine.ReferenceField(DataSource)
+    gene_column = mongoengine.StringField()
+    info_columns = mongoengine.ListField(mongoengine.StringField())
+    libraries = mongoengine.ListField(mongoengine.StringField())
+    conditions = mongoengine.ListField(mongoengine.StringField())
+    lib_types = mongoengine.ListField(mongoengine.StringField())
+    n_genes = mongoengine.IntField(default=0)
+    createddate = mongoengine.DateTimeField()
+    description = mongoengine.StringField(default="")
+    ingest_run = mongoengine.ObjectIdField()
+
+    meta = {
+        'indexes': ['study', 'datasource', {'fields': ['ingest_run'], 'sparse': True}]
+    }
+
+    def chunks(self, start=0, stop=None, fields=None, db_alias='default'):
+        # Chunks holding genes start to stop, in gene order
+        with switch_db(ExpressionMatrixChunk, db_alias) as Chunk:
+            query = Chunk.objects(matrix=self.id, stop__gt=start)
+        if stop is not None:
+            query = query.filter(start__lt=stop)
+        if fields:
+            query = query.only(*fields)
+        return query.order_by('start')
+
+    def library_positions(self, libraries=None, condition=None, lib_type=None):
+        """
+        Columns of the libraries with the given names, condition and lib_type, in column
+        order. Criteria left as None match every library
+        """
+        return [
+            j for j, library in enumerate(self.libraries)
+            if (libraries is None or library in libraries)
+            and (condition is None or self.conditions[j] == condition)
+            and (lib_type is None or self.lib_types[j] == lib_type)
+        ]
+
+    def gene_rows(self, genes, db_alias='default'):
+        """
+        Reads the gene column of every chunk to find the rows of the given genes
+
+        :return: Dictionary of gene to row, for the genes in the matrix
+        """
+        wanted = set(genes)
+        gene_i = self.info_columns.index(self.gene_column)
+        rows = {}
+        for chunk in self.chunks(fields=['start', 'info'], db_alias=db_alias):
+            for i, info in enumerate(chunk.info):
+                if info[gene_i] in wanted:
+                    rows[info[gene_i]] = chunk.start + i
+        return rows
+
+    def values(self, genes=None, libraries=None, condition=None, lib_type=None,
+               db_alias='default'):
+        """
+        Reads the expression values of the given genes in the libraries with the given
+        names, condition and lib_type. Whole columns are sliced out of each chunk in one
+        step when every gene is read
+
+        :param genes: Gene ids, or None for every gene
+        :return: List of the gene ids read, in matrix order, and dictionary of library
+                 name to array('f') of its values, in the order of the gene ids
+        """
+        gene_i = self.info_columns.index(self.gene_column)
+        positions = self.library_positions(libraries, condition, lib_type)
+        columns = dict((self.libraries[j], array('f')) for j in positions)
+        width = len(self.libraries)
+        if genes is not None:
+            rows = sorted(self.gene_rows(genes, db_alias).values())
+            if not rows:
+                return [], columns
+            start, stop = rows[0], rows[-1] + 1
+        else:
+            rows, start, stop = None, 0, None
+        gene_ids = []
+        for chunk in self.chunks(start, stop, db_alias=db_alias):
+            values = array('f')
+            values.frombytes(chunk.values)
+            if rows is None:
+                gene_ids.extend(info[gene_i] for info in chunk.info)
+                for j in positions:
+                    columns[self.libraries[j]].extend(values[j::width])
+                continue
+            for row in rows:
+                if chunk.start <= row < chunk.stop:
+                    i = row - chunk.start
+                    gene_ids.append(chunk.info[i][gene_i])
+                    for j in positions:
+                        columns[self.libraries[j]].append(values[i * width + j])
+        return gene_ids, columns
+
+
+class ExpressionMatrixChunk(mongoengine.Document):
+    """
+    The values of genes start to stop of an ExpressionMatrix, as float32 with the values
+    of a gene next to each other, and the genes' info column values
+    """
+    matrix = mongoengine.ReferenceField(ExpressionMatrix)
+    start = mongoengine.IntField()
+    stop = mongoengine.IntField()
+    info = mongoengine.ListField(mongoengine.ListField(mongoengine.StringField()))
+    values = mongoengine.BinaryField()
+    ingest_run = mongoengine.ObjectIdField()
+
+    meta = {
+        'indexes': [('matrix', 'start'), {'fields': ['ingest_run'], 'sparse': True}]
+    }
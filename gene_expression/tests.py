@@ -1,3 +1,81 @@
-from django.test import TestCase
+import math
+from kaka.settings import TEST_DB_ALIAS
+from mongoengine.context_managers import switch_db
+from mongcore.models import Experiment, DataSource
+from mongcore.query_set_helpers import fetch_or_save
+from mongcore.tests import MasterTestCase
+from .matrix import ExpressionMatrixWriter, delete_expression_matrices
+from .models import Target, ExpressionMatrix, ExpressionMatrixChunk
 
-# Create your tests here.
+header = ['gene_id', 'length', 'L1', 'L2', 'L3']
+rows = [
+    ['g0', '100', '1.5', '0', '2'],
+    ['g1', '200', '3', 'NA', '4'],
+    ['g2', '300', '5', '6', '7.25'],
+    ['g3', '400', '8'],
+]
+
+
+class ExpressionMatrixTestCase(MasterTestCase):
+    """
+    Tests storing a count table as an ExpressionMatrix and slicing it
+    """
+
+    def setUp(self):
+        super(ExpressionMatrixTestCase, self).setUp()
+        self.study, created = fetch_or_save(Experiment, TEST_DB_ALIAS, name='Expression')
+        self.ds, created = fetch_or_save(DataSource, TEST_DB_ALIAS, name='Expression')
+        for column, condition, lib_type in [('L1', 'cold', 'F'), ('L2', 'warm', 'F'), ('L3', 'cold', 'R')]:
+            target = Target(
+                name=column, column=column, condition=condition, lib_type=lib_type,
+                datasource=self.ds, species=None,
+            )
+            target.switch_db(TEST_DB_ALIAS)
+            target.save()
+        # 6 values per chunk, so the rows are split over 2 chunks
+        writer = ExpressionMatrixWriter(
+            header, db_alias=TEST_DB_ALIAS, chunk_values=6, study=self.study, datasource=self.ds,
+        )
+        for row in rows:
+            writer.add(row)
+        writer.flush()
+        self.matrix = writer.matrix
+
+    def tearDown(self):
+        delete_expression_matrices(self.ds, TEST_DB_ALIAS)
+        with switch_db(Target, TEST_DB_ALIAS) as TestTarget:
+            TestTarget.objects.all().delete()
+        super(ExpressionMatrixTestCase, self).tearDown()
+
+    def test_layout(self):
+        self.assertEqual(self.matrix.info_columns, ['gene_id', 'length'])
+        self.assertEqual(self.matrix.libraries, ['L1', 'L2', 'L3'])
+        self.assertEqual(self.matrix.conditions, ['cold', 'warm', 'cold'])
+        self.assertEqual(self.matrix.lib_types, ['F', 'F', 'R'])
+        with switch_db(ExpressionMatrix, TEST_DB_ALIAS) as TestMatrix:
+            self.assertEqual(TestMatrix.objects.get(id=self.matrix.id).n_genes, 4)
+        with switch_db(ExpressionMatrixChunk, TEST_DB_ALIAS) as TestChunk:
+            self.assertEqual(TestChunk.objects(matrix=self.matrix.id).count(), 2)
+
+    def test_all_genes(self):
+        """
+        Tests that whole columns read back as stored, with missing values as nan
+        """
+        genes, columns = self.matrix.values(condition='cold', db_alias=TEST_DB_ALIAS)
+        self.assertEqual(genes, ['g0', 'g1', 'g2', 'g3'])
+        self.assertEqual(sorted(columns), ['L1', 'L3'])
+        self.assertEqual(list(columns['L1']), [1.5, 3, 5, 8])
+        self.assertEqual(list(columns['L3'])[:3], [2, 4, 7.25])
+        self.assertTrue(math.isnan(columns['L3'][3]))
+
+    def test_gene_list(self):
+        """
+        Tests slicing the genes of a list, across chunks, by lib_type
+        """
+        genes, columns = self.matrix.values(
+            genes=['g3', 'g1', 'missing'], lib_type='F', db_alias=TEST_DB_ALIAS
+        )
+        self.assertEqual(genes, ['g1', 'g3'])
+        self.assertEqual(list(columns['L1']), [3, 8])
+        self.assertTrue(all(math.isnan(value) for value in columns['L2']))
+        self.assertEqual(self.matrix.values(genes=['missing'], db_alias=TEST_DB_ALIAS)[0], [])
@@ -20,13 +20,28 @@ TEST_DB_ALIAS = 'test'
 PRIMARY_DB_NAME = 'primary'
 PRIMARY_DB_ALIAS = 'primary'
 
+MONGODB_HOST = 'mongodb://mongo'
+
+# WiredTiger storage for the collections of these document classes, used when their
+# collections are created (see mongcore.storage). block_compressor is one of 'none',
+# 'snappy', 'zlib' or 'zstd' (MongoDB 4.2+). prefix_compression is for their indexes
+COLLECTION_STORAGE = {
+    'Genotype': {'block_compressor': 'zlib', 'prefix_compression': True},
+    'GenotypeMatrixChunk': {'block_compressor': 'zlib', 'prefix_compression': True},
+}
+
+# Storage of the archive collections features of inactive data sources are moved to
+# (see mongcore.archive), and the directory they are moved to when archived to files
+ARCHIVE_STORAGE = {'block_compressor': 'zlib', 'prefix_compression': True}
+ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+
 connected = False
 # connect(PRIMARY_DB_NAME, host='mongodb://10.1.8.102', replicaSet='kaka1')
 # MONGODB_HOST = os.environ.get('mongo_PORT_27017_TCP_ADDR', '127.0.0.1')
 # connect(host=MONGODB_HOST)
 while not connected:
     try:
-        connect(PRIMARY_DB_NAME, host='mongodb://mongo')
+        connect(PRIMARY_DB_NAME, host=MONGODB_HOST)
         connected = True
     except ConnectionError:
         pass
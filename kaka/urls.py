@@ -15,6 +15,8 @@ urlpatterns = [
     url(r'^accounts/login/$', 'django.contrib.auth.views.login'),
     url(r'^inplaceeditform/', include('inplaceeditform.urls')),
     url(r'^api/genotype/$', 'web.views.genotype_report', name='genotype_report'),
+    url(r'^api/genotype/region/$', 'web.views.genotype_region_report', name='genotype_region_report'),
+    url(r'^api/experiment/summary/$', 'web.views.experiment_summary_report', name='experiment_summary_report'),
     url(r'^api/(?P<report>[0-9a-zA-Z_]*)/$', 'web.views.page_report' ),
     url(r'^api/(?P<report>[0-9a-zA-Z_]*)/(?P<fmt>[a-z]*)/$', 'web.views.page_report'),
     url(r'^api/(?P<report>[0-9a-zA-Z_]*)/(?P<fmt>[a-z]*)/(?P<conf>.*)$', 'web.views.page_report'),
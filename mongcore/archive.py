@@ -0,0 +1,287 @@
+"""
+Archive tier for the features of data sources that are no longer active. Superseded
+loads otherwise stay in the main feature collections for good, where every query and
+index has to step over them. archive_datasource() moves every Feature document of a
+data source out of the main collections, either into an archive collection per feature
+collection (<collection>_archive, created with settings.ARCHIVE_STORAGE), or into
+gzipped BSON or JSON lines files on local disk, one per feature collection under
+<directory>/<data source id>/. The DataSource document stays where it is and records
+where its features went, and restore_datasource() moves them back.
+
+The features are copied before they are removed, and copies replace documents with the
+same id, so an archive or restore that was interrupted can be run again.
+archived_features() reads archived features for searches that ask to include them
+"""
+
+import gzip
+import os
+import shutil
+from datetime import datetime
+from bson import BSON, ObjectId, decode_file_iter, json_util
+from django.conf import settings
+from mongoengine.connection import get_db
+from mongoengine.context_managers import switch_db
+from .models import DataSource, feature_documents, class_spec
+from .imports import delete_many
+from .lean import fill_lean
+from .storage import create_named_collection
+from .headers import invalidate_headers
+from .logger import Logger
+
+# Value of DataSource.archive for features moved to the archive collections
+in_collection = 'collection'
+file_formats = {'bson': '.bson.gz', 'json': '.jsonl.gz'}
+archive_suffix = '_archive'
+
+
+def archive_name(collection):
+    return collection + archive_suffix
+
+
+def archive_collection(db, collection):
+    # The archive collection of a feature collection, created compressed if missing
+    name = archive_name(collection)
+    if create_named_collection(db, name, getattr(settings, 'ARCHIVE_STORAGE', {})):
+        db[name].create_index('datasource')
+        db[name].create_index('study')
+    return db[name]
+
+
+def archive_path(directory, datasource_id, collection, fmt):
+    return os.path.join(directory, str(datasource_id), collection + file_formats[fmt])
+
+
+def archive_files(directory, datasource_id, collection):
+    # The archive files of a feature collection for a data source, in either format
+    for fmt in sorted(file_formats):
+        path = archive_path(directory, datasource_id, collection, fmt)
+        if os.path.exists(path):
+            yield path
+
+
+def write_file(path, sons):
+    """
+    Writes sons to a gzipped file, as BSON documents or as one extended JSON document a
+    line, by the extension of the path
+
+    :return: Number of documents written
+    """
+    n = 0
+    with gzip.open(path, 'wb') as f:
+        for son in sons:
+            if path.endswith(file_formats['json']):
+                f.write((json_util.dumps(son) + '\n').encode('utf-8'))
+            else:
+                f.write(BSON.encode(son))
+            n += 1
+    return n
+
+
+def read_file(path):
+    # Yields the sons written to an archive file by write_file()
+    with gzip.open(path, 'rb') as f:
+        if path.endswith(file_formats['json']):
+            for line in f:
+                yield json_util.loads(line.decode('utf-8'))
+        else:
+            for son in decode_file_iter(f):
+                yield son
+
+
+def copy_sons(collection, sons, batch_size=1000):
+    """
+    Writes sons to a collection in unordered bulk writes, replacing the documents that
+    have the same id
+
+    :return: Number of documents written
+    """
+    n = 0
+    bulk = collection.initialize_unordered_bulk_op()
+    pending = 0
+    for son in sons:
+        bulk.find({'_id': son['_id']}).upsert().replace_one(son)
+        pending += 1
+        if pending >= batch_size:
+            bulk.execute()
+            n += pending
+            pending = 0
+            bulk = collection.initialize_unordered_bulk_op()
+    if pending:
+        bulk.execute()
+        n += pending
+    return n
+
+
+def get_datasource(datasource, db_alias):
+    with switch_db(DataSource, db_alias) as DS:
+        if isinstance(datasource, DataSource):
+            datasource = datasource.pk
+        return DS.objects.get(pk=datasource)
+
+
+def mark_archived(datasource, archive, db_alias, studies=()):
+    # Records where the features of the data source are, None being the main collections,
+    # and the studies of the features archived
+    archived_date = None if archive is None else datetime.now()
+    studies = sorted(studies)
+    with switch_db(DataSource, db_alias) as DS:
+        if archive is None:
+            DS.objects(pk=datasource.pk).update_one(
+                unset__archive=True, unset__archived_date=True, unset__archived_studies=True
+            )
+        else:
+            DS.objects(pk=datasource.pk).update_one(
+                set__archive=archive, set__archived_date=archived_date,
+                set__archived_studies=studies,
+            )
+    datasource.archive = archive
+    datasource.archived_date = archived_date
+    datasource.archived_studies = studies
+
+
+def archive_datasource(datasource, db_alias='default', directory=None, fmt='bson'):
+    """
+    Moves every Feature document of a data source out of the main feature collections
+
+    :param datasource: DataSource document or id
+    :param db_alias: Alias of database holding the data source
+    :param directory: Directory to write the archive files under, or None to move the
+                      features to the archive collections
+    :param fmt: 'bson' or 'json', the format of the archive files
+    :return: Dictionary of the number of features moved, by feature collection
+    """
+    datasource = get_datasource(datasource, db_alias)
+    if datasource.archive is not None:
+        raise ValueError("Data source %s is already archived to %s" % (datasource.pk, datasource.archive))
+    if fmt not in file_formats:
+        raise ValueError("Unknown archive format: %s. Use one of %s" % (fmt, ', '.join(sorted(file_formats))))
+    db = get_db(db_alias)
+    moved = {}
+    specs = {}
+    studies = set()
+    for document in feature_documents(db_alias):
+        collection = document._get_collection_name()
+        # only the documents of the feature classes, by the (_cls, datasource) index
+        spec = specs[collection] = dict(class_spec(document), datasource=datasource.pk)
+        if db[collection].find_one(spec, {'_id': 1}) is None:
+            continue
+        studies.update(study for study in db[collection].find(spec).distinct('study') if study)
+        sons = db[collection].find(spec)
+        if directory is None:
+            moved[collection] = copy_sons(archive_collection(db, collection), sons)
+        else:
+            path = archive_path(directory, datasource.pk, collection, fmt)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            moved[collection] = write_file(path, sons)
+    # the features are only removed once every copy is made and the data source says
+    # where they are
+    mark_archived(datasource, directory or in_collection, db_alias, studies)
+    for collection in moved:
+        delete_many(db[collection], specs[collection])
+        invalidate_headers(collection, datasource=datasource.pk, db_alias=db_alias)
+    Logger.Message("Archived data source %s to %s: %s" % (datasource.pk, datasource.archive, moved))
+    return moved
+
+
+def restore_datasource(datasource, db_alias='default'):
+    """
+    Moves the archived features of a data source back into the main feature collections
+
+    :param datasource: DataSource document or id
+    :param db_alias: Alias of database holding the data source
+    :return: Dictionary of the number of features restored, by feature collection
+    """
+    datasource = get_datasource(datasource, db_alias)
+    if datasource.archive is None:
+        raise ValueError("Data source %s is not archived" % datasource.pk)
+    db = get_db(db_alias)
+    restored = {}
+    specs = {}
+    for document in feature_documents(db_alias):
+        collection = document._get_collection_name()
+        spec = specs[collection] = dict(class_spec(document), datasource=datasource.pk)
+        if datasource.archive == in_collection:
+            archived = db[archive_name(collection)]
+            restored[collection] = copy_sons(db[collection], archived.find(spec))
+        else:
+            for path in archive_files(datasource.archive, datasource.pk, collection):
+                restored[collection] = restored.get(collection, 0) + copy_sons(
+                    db[collection], read_file(path)
+                )
+    for collection in restored:
+        invalidate_headers(collection, datasource=datasource.pk, db_alias=db_alias)
+    directory = datasource.archive
+    mark_archived(datasource, None, db_alias)
+    if directory == in_collection:
+        for collection in restored:
+            delete_many(db[archive_name(collection)], specs[collection])
+    else:
+        shutil.rmtree(os.path.join(directory, str(datasource.pk)), ignore_errors=True)
+    restored = dict((collection, n) for collection, n in restored.items() if n)
+    Logger.Message("Restored data source %s: %s" % (datasource.pk, restored))
+    return restored
+
+
+def inactive_datasources(before, db_alias='default'):
+    """
+    Data sources that are not active, not archived yet and were supplied before the
+    given date. is_active defaults to False, so the date is what keeps recent loads
+    in the main collections
+    """
+    with switch_db(DataSource, db_alias) as DS:
+        return list(DS.objects(is_active=False, archive=None, supplieddate__lt=before))
+
+
+def archived_datasources(db_alias='default'):
+    with switch_db(DataSource, db_alias) as DS:
+        return list(DS.objects(archive__ne=None))
+
+
+def matches(son, query):
+    # Top level equality matching of archive file documents
+    return all(son.get(key) == value for key, value in query.items())
+
+
+def is_class(son, classes):
+    # Whether an archive file document is of the classes of a class_spec() condition
+    if classes is None:
+        return True
+    if isinstance(classes, dict):
+        return son.get('_cls') in classes['$in']
+    return son.get('_cls') == classes
+
+
+def archived_features(document, query=None, db_alias='default'):
+    """
+    Yields the archived features of a feature class that match a query, from both the
+    archive collections and the archive files. Archive files are read whole, so only
+    those of the data sources a query's study or data source can match are opened. A
+    query by neither reads every archive file
+
+    :param document: Feature class of the features
+    :param query: Dictionary of field values the features must have, as stored by
+                  pymongo (eg. {'study': experiment.pk})
+    :param db_alias: Alias of database holding the data sources
+    """
+    query = dict(query or {})
+    db = get_db(db_alias)
+    collection = document._get_collection_name()
+    if archive_name(collection) in db.collection_names():
+        for son in db[archive_name(collection)].find(dict(class_spec(document), **query)):
+            yield document._from_son(fill_lean(document, son, db))
+    for datasource in archived_datasources(db_alias):
+        if datasource.archive == in_collection:
+            continue
+        if 'datasource' in query and query['datasource'] != datasource.pk:
+            continue
+        # data sources archived before their studies were recorded have none
+        study = query.get('study')
+        if isinstance(study, ObjectId) and datasource.archived_studies \
+                and study not in datasource.archived_studies:
+            continue
+        classes = class_spec(document).get('_cls')
+        for path in archive_files(datasource.archive, datasource.pk, collection):
+            for son in read_file(path):
+                if matches(son, query) and is_class(son, classes):
+                    yield document._from_son(fill_lean(document, son, db))
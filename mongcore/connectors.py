@@ -6,7 +6,11 @@ from django.db import connection, connections
 # import data serializers
 import gzip
 import csv
+import io
+import uuid
 import xlrd
+import openpyxl
+from itertools import islice
 
 # Project imports
 from .logger import *
@@ -31,6 +35,7 @@ class DataConnector:
     head_mapper = None
     current = None
     origin_name = None
+    header_index = None
 
     def __init__(self):
         pass
@@ -41,6 +46,25 @@ class DataConnector:
     def next(self):
         return self.__next__()
 
+    def chunks(self, size=1000, columns=False):
+        """
+        Yields the remaining rows in batches of up to size rows. Each batch is a list of
+        rows with the values in header order, or, if columns is True, a list of columns.
+        Use header_index to look up the position of a column.
+
+        Connectors that can read positional rows directly override this, so batch aware
+        import operators skip building a dict for every row
+        """
+        header = self.header
+        self.header_index = make_header_index(header)
+        if header is None:
+            return
+        while True:
+            batch = [tuple(row.get(h) for h in header) for row in islice(self, size)]
+            if not batch:
+                return
+            yield to_columns(batch, len(header)) if columns else batch
+
     def all(self):
         pass
 
@@ -48,12 +72,42 @@ class DataConnector:
         pass
 
 
+def make_header_index(header):
+    # Maps each column name to its position in a row
+    return dict((name, i) for i, name in enumerate(header or []))
+
+
+def to_columns(batch, width):
+    # Turns a batch of rows into a list of columns. Short rows are padded with None
+    rows = [row if len(row) >= width else list(row) + [None] * (width - len(row)) for row in batch]
+    return [list(column) for column in zip(*rows)][:width]
+
+
+def iter_chunks(rows, size, width, columns=False):
+    # Batches up the given iterator of positional rows for chunks()
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield to_columns(batch, width) if columns else batch
+
+
+def is_xlsx(fn):
+    return fn.lower().endswith(('.xlsx', '.xlsm'))
+
+
 class ExcelConnector(DataConnector):
+    """
+    Reads the rows of a sheet of a workbook, taking its first row as the header. .xlsx
+    workbooks are streamed a row at a time with openpyxl in read only mode, so the sheet
+    is never held in memory. Older .xls workbooks are read with xlrd, which only loads
+    the sheet asked for. Blank rows are skipped
+    """
     fn = None
     sheet_name = None
+    workbook = None
     sheet = None
-    curr_row = 0
-    max_row = 0
+    rows = None
     header = None
 
     def __init__(self, fn, sheet_name=None):
@@ -65,26 +119,32 @@ class ExcelConnector(DataConnector):
         return self
 
     def __next__(self):
-        num_rows = self.sheet.nrows - 1
-        self.curr_row += 1
-        if(self.curr_row < num_rows):
-            r = self.sheet.row_values(self.curr_row)
-            return dict(list(zip(self.header, r)))
-        else:
-            raise StopIteration
+        self.current = next(self.rows)
+        return dict(list(zip(self.header, self.current)))
 
     def load(self):
-        workbook = xlrd.open_workbook(self.fn)
-        if self.sheet_name:
-            self.sheet = workbook.sheet_by_name(self.sheet_name)
+        if is_xlsx(self.fn):
+            self.workbook = openpyxl.load_workbook(self.fn, read_only=True, data_only=True)
+            self.sheet = self.workbook[self.sheet_name or self.workbook.sheetnames[0]]
+            rows = ([cell.value for cell in row] for row in self.sheet.iter_rows())
         else:
-            sheet_names = workbook.sheet_names()
-            self.sheet = workbook.sheet_by_name(sheet_names[0])
-
-        self.header = self.get_header()
-
-    def get_header(self):
-        return self.sheet.row_values(0)
+            self.workbook = xlrd.open_workbook(self.fn, on_demand=True)
+            if self.sheet_name:
+                self.sheet = self.workbook.sheet_by_name(self.sheet_name)
+            else:
+                self.sheet = self.workbook.sheet_by_index(0)
+            rows = (self.sheet.row_values(i) for i in range(self.sheet.nrows))
+
+        self.header = next(rows, [])
+        self.header_index = make_header_index(self.header)
+        self.rows = (row for row in rows if any(value not in (None, '') for value in row))
+
+    def chunks(self, size=1000, columns=False):
+        """
+        Yields the remaining rows in batches of up to size rows, as lists of values in
+        header order, or as lists of columns if columns is True
+        """
+        return iter_chunks(self.rows, size, len(self.header), columns)
 
     def all(self):
         res = []
@@ -93,64 +153,154 @@ class ExcelConnector(DataConnector):
 
         return res
 
+    def close(self):
+        if is_xlsx(self.fn):
+            self.workbook.close()
+        else:
+            self.workbook.release_resources()
+
     @staticmethod
     def GetSheets(fn):
-        workbook = xlrd.open_workbook(fn)
-        return workbook.sheet_names()
+        # Only the workbook's index of sheets is read, not the sheets themselves
+        if is_xlsx(fn):
+            workbook = openpyxl.load_workbook(fn, read_only=True)
+            names = workbook.sheetnames
+            workbook.close()
+        else:
+            workbook = xlrd.open_workbook(fn, on_demand=True)
+            names = workbook.sheet_names()
+            workbook.release_resources()
+        return names
 
 
 class SqlConnector(DataConnector):
+    """
+    Reads the rows of a SQL query a batch at a time with fetchmany, so only batch_size
+    rows are held in memory at once.
+
+    With server_side=True the rows are read through a named (server side) Postgres
+    cursor and stay on the server until fetched. Otherwise the database driver may buffer
+    the whole result, which limit_mode avoids by querying it a page of limit rows at a
+    time, starting at offset. Give paged queries an ORDER BY so the pages don't overlap
+    """
     cursor = None
     db = None
     header = None
     limit_mode = False
     limit = 10000
+    offset = 0
+    # Rows fetched from the database at a time
+    batch_size = 2000
+    server_side = False
 
-    def __init__(self, qry, db=None):
+    def __init__(self, qry, db=None, server_side=None, batch_size=None, limit_mode=None,
+                 limit=None, offset=None):
         self.origin_name = qry
         self.db = db
+        if server_side is not None:
+            self.server_side = server_side
+        if batch_size:
+            self.batch_size = batch_size
+        if limit_mode is not None:
+            self.limit_mode = limit_mode
+        if limit:
+            self.limit = limit
+        if offset:
+            self.offset = offset
         self.load()
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        self.current = self.cursor.fetchone()
-        if(self.current):
-            return dict(list(zip(self.header, self.current)))
-        else:
-            raise StopIteration
+        self.current = next(self.rows)
+        return dict(list(zip(self.header, self.current)))
 
     def load(self):
-        if(self.db):
-            self.cursor = connections[self.db].cursor()
-        else:
-            self.cursor = connection.cursor()
+        try:
+            self.execute()
+            # Named cursors only describe their columns once rows have been fetched
+            first = self.fetch_batch()
+        except Exception:
+            self.close()
+            raise
+        self.header = self.get_header()
+        self.header_index = make_header_index(self.header)
+        self.rows = self.iter_rows(first)
 
+    def get_connection(self):
+        if(self.db):
+            return connections[self.db]
+        return connection
+
+    def make_cursor(self):
+        conn = self.get_connection()
+        if not self.server_side:
+            return conn.cursor()
+        # Declared WITH HOLD so the cursor can be used outside a transaction, as django
+        # runs in autocommit mode
+        conn.ensure_connection()
+        cursor = conn.connection.cursor(name='sql_connector_' + uuid.uuid4().hex, withhold=True)
+        cursor.itersize = self.batch_size
+        return cursor
+
+    def execute(self):
+        # Runs the query, or the page of it starting at offset in limit mode, on a new cursor
+        if self.cursor is not None:
+            self.cursor.close()
+        self.cursor = self.make_cursor()
+        qry = self.origin_name
         if(self.limit_mode):
-            # TODO Add limit functioality
-            self.cursor.execute(self.origin_name)
-        else:
-            self.cursor.execute(self.origin_name)
-        self.header = self.get_header()
+            qry = "SELECT * FROM (%s) AS page LIMIT %d OFFSET %d" % (
+                qry.strip().rstrip(';'), self.limit, self.offset
+            )
+        self.cursor.execute(qry)
+        self.page_rows = 0
+
+    def fetch_batch(self):
+        rows = self.cursor.fetchmany(self.batch_size)
+        if not rows and self.limit_mode and self.page_rows == self.limit:
+            # the page was full, so there may be more rows on the next one
+            self.offset += self.limit
+            self.execute()
+            rows = self.cursor.fetchmany(self.batch_size)
+        self.page_rows += len(rows)
+        return rows
+
+    def iter_rows(self, rows):
+        # Closes the cursor however reading stops: a WITH HOLD cursor outlives the
+        # transaction and would otherwise keep its result on the server
+        try:
+            while rows:
+                for row in rows:
+                    yield row
+                rows = self.fetch_batch()
+        finally:
+            self.close()
 
     def get_header(self):
-        return [desc[0] for desc in self.cursor.description]
+        return [desc[0] for desc in self.cursor.description or []]
+
+    def chunks(self, size=1000, columns=False):
+        """
+        Yields the remaining rows in batches of up to size rows, as the tuples the
+        database returns rather than a dict per row. With columns=True each batch is a
+        list of columns instead. Use header_index to look up a column's position
+        """
+        return iter_chunks(self.rows, size, len(self.header), columns)
 
     def all(self):
-        "Returns all rows from a cursor as a dict"
-        desc = self.cursor.description
-        return [
-            dict(list(zip([col[0] for col in desc], row)))
-            for row in self.cursor.fetchall()
-        ]
+        "Returns all remaining rows from a cursor as a dict"
+        return list(self)
 
     def close(self):
-        self.cursor.close()
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
 
 
 class PgsqlConnector(SqlConnector):
-    pass
+    server_side = True
 
 
 class CsvConnector(DataConnector):
@@ -159,13 +309,17 @@ class CsvConnector(DataConnector):
     gzipped = False
     delimiter = ','
     header = None
+    # Bytes read (and decompressed) from the file at a time
+    block_size = 1 << 20
 
-    def __init__(self, fn, delimiter=',', gzipped=False, header=None):
+    def __init__(self, fn, delimiter=',', gzipped=False, header=None, block_size=None):
         Logger.Message("CsvConnector: Loading " + fn)
         self.origin_name = fn
         self.gzipped = gzipped
         self.delimiter = delimiter
         self.header=header
+        if block_size:
+            self.block_size = block_size
         self.load()
 
     def __iter__(self):
@@ -173,11 +327,13 @@ class CsvConnector(DataConnector):
 
     def load(self):
         if(self.gzipped):
-            self.f = gzip.open(self.origin_name, 'rt')
+            raw = io.BufferedReader(gzip.open(self.origin_name, 'rb'), buffer_size=self.block_size)
+            self.f = io.TextIOWrapper(raw, newline='')
         else:
-            self.f = open(self.origin_name, 'rb')
+            self.f = open(self.origin_name, 'r', newline='', buffering=self.block_size)
         self.reader = csv.DictReader(self.f, delimiter=self.delimiter, fieldnames=self.header)
         self.header = self.reader.fieldnames
+        self.header_index = make_header_index(self.header)
 
     def __next__(self):
         self.current = next(self.reader)
@@ -186,6 +342,28 @@ class CsvConnector(DataConnector):
         else:
             raise StopIteration
 
+    def chunks(self, size=1000, columns=False):
+        """
+        Yields the remaining rows in batches of up to size rows, parsed straight into
+        lists of values without building a dict per row. With columns=True each batch
+        is a list of columns instead. Use header_index to look up a column's position.
+        Shares its position in the file with __next__()
+        """
+        if self.header is None:
+            # an empty file, without even a header
+            return
+        # The csv.reader underneath the DictReader, which has already read the header
+        rows = self.reader.reader
+        width = len(self.header)
+        while True:
+            read = list(islice(rows, size))
+            if not read:
+                return
+            # blank lines are skipped, but only the end of the file ends the batches
+            batch = [row for row in read if row]
+            if batch:
+                yield to_columns(batch, width) if columns else batch
+
     def all(self):
         d = []
         for row in self:
@@ -40,3 +40,15 @@ class QueryBadDateError(ExperiSearchError):
                + "\nInvalid date(s)." \
                + "\nCheck that the 'from' date precedes the 'to' date and that all dates" \
                + " have values for year, month and day"
+
+
+class QueryBadRegionError(ExperiSearchError):
+
+    def __init__(self, region, reason):
+        self.region = region
+        self.reason = reason
+
+    def __str__(self):
+        return "Region chrom=%s, start=%s, stop=%s can't be queried.\n%s" % (
+            self.region + (self.reason,)
+        )
@@ -0,0 +1,213 @@
+"""
+Header discovery for csv exports of features that don't all store the same fields or
+obs keys. The union of the fields of the documents a query matches, and on request of
+the keys of their obs, is worked out inside the database with an aggregation over
+$objectToArray, instead of by reading every document into Python. Encoded obs (see
+mongcore.obs_keys) take their keys from the key dictionaries their data sources were
+loaded with.
+
+The field names of queries limited to a study and/or data source are cached in the
+ExportHeader collection, so every web process shares them. A cached header is used
+until it is removed: code that writes or removes features (the loaders, rollbacks and
+the archive) calls invalidate_headers()
+"""
+
+from bson.son import SON
+from pymongo.errors import OperationFailure
+from mongoengine.context_managers import switch_db
+from .models import ExportHeader, name_copies
+from .obs_keys import get_keys
+from .imports import delete_many
+
+copy_fields = set(name_copies.values())
+# Query fields a header is cached by
+cache_fields = ('study', 'datasource')
+
+
+def window_stages(query_set):
+    # Pipeline stages limiting the documents matched to the slice of a sliced query set
+    stages = []
+    if query_set._ordering:
+        stages.append({'$sort': SON(query_set._ordering)})
+    if query_set._skip:
+        stages.append({'$skip': query_set._skip})
+    if query_set._limit:
+        stages.append({'$limit': query_set._limit})
+    return stages
+
+
+def window_cursor(collection, spec, stages, projection=None):
+    # Cursor over the documents of spec, limited as by window_stages()
+    cursor = collection.find(spec, projection)
+    for stage in stages:
+        if '$sort' in stage:
+            cursor = cursor.sort(list(stage['$sort'].items()))
+        elif '$skip' in stage:
+            cursor = cursor.skip(stage['$skip'])
+        else:
+            cursor = cursor.limit(stage['$limit'])
+    return cursor
+
+
+def aggregate_keys(collection, spec, path, stages=()):
+    """
+    Union of the keys of an object of the documents matching spec, worked out by the
+    database (MongoDB 3.4.4 or later)
+
+    :param path: '$$ROOT' for the fields of the documents, or eg. '$obs'
+    :param stages: Stages limiting the documents to a slice (see window_stages())
+    :return: Set of the keys, or None when the server can't work them out
+    """
+    match = spec
+    if path != '$$ROOT' and not stages:
+        match = {'$and': [spec, {path[1:]: {'$type': 'object'}}]}
+    pipeline = [{'$match': match}] + list(stages)
+    if path != '$$ROOT' and stages:
+        # the documents without an object are only left out once the slice is taken
+        pipeline.append({'$match': {path[1:]: {'$type': 'object'}}})
+    pipeline += [
+        {'$project': {'_id': 0, 'keys': {'$objectToArray': path}}},
+        {'$unwind': '$keys'},
+        {'$group': {'_id': None, 'keys': {'$addToSet': '$keys.k'}}},
+    ]
+    try:
+        # servers from MongoDB 3.6 only answer aggregations asking for a cursor
+        result = collection.aggregate(pipeline, allowDiskUse=True, cursor={})
+    except OperationFailure:
+        return None
+    # pymongo 2 returns a cursor when asked for one, later versions always do
+    docs = result.get('result', []) if isinstance(result, dict) else list(result)
+    return set(docs[0]['keys']) if docs else set()
+
+
+def present_fields(document, collection, spec, stages=()):
+    # Declared fields stored by any document matching spec, one find_one() per field.
+    # For servers without $objectToArray. Slices are read whole, being small
+    if stages:
+        present = set()
+        for son in window_cursor(collection, spec, stages):
+            present.update(son)
+        return present
+    present = set()
+    for field in document._fields.values():
+        query = {'$and': [spec, {field.db_field: {'$ne': None}}]}
+        if collection.find_one(query, {'_id': 1}) is not None:
+            present.add(field.db_field)
+    return present
+
+
+def document_fields(document, collection, spec, stages=()):
+    """
+    Names of the fields of the documents matching spec as they are exported: the fields
+    the documents store, and the fields with a default, which are set on every document
+    read. Encoded obs are exported as obs, and the copies of referenced names are left
+    out
+    """
+    declared = dict((field.db_field, field) for field in document._fields.values())
+    stored = aggregate_keys(collection, spec, '$$ROOT', stages)
+    if stored is None:
+        stored = present_fields(document, collection, spec, stages)
+    keys = set(key for key in stored if key in declared or key == '_cls')
+    keys.update(key for key, field in declared.items() if field.default is not None)
+    keys.add('_id')
+    return set('obs' if key == 'obs_values' else key for key in keys if key not in copy_fields)
+
+
+def obs_keys(collection, spec, db_alias='default', stages=()):
+    # Union of the keys of the plain and the encoded obs of the documents matching spec
+    keys = aggregate_keys(collection, spec, '$obs', stages)
+    if keys is None:
+        keys = set()
+        for son in window_cursor(collection, spec, stages, {'obs': 1}):
+            keys.update(son.get('obs') or {})
+    encoded = {'$and': [spec, {'obs_values': {'$exists': True}}]}
+    if stages:
+        datasources = set(
+            son['datasource'] for son in
+            window_cursor(collection, spec, stages, {'datasource': 1, 'obs_values': 1})
+            if 'obs_values' in son and son.get('datasource') is not None
+        )
+    else:
+        datasources = collection.find(encoded).distinct('datasource')
+    for datasource in datasources:
+        keys.update(get_keys(datasource, db_alias))
+    return keys
+
+
+def cache_key(spec):
+    # The study and data source a query is limited to, or None if it is limited by
+    # anything else, when its header can't be cached
+    if any(key not in cache_fields and key != '_cls' for key in spec):
+        return None
+    values = tuple(spec.get(field) for field in cache_fields)
+    if any(isinstance(value, dict) for value in values):
+        return None
+    return values
+
+
+def discover_header(query_set, db_alias='default', obs=False):
+    """
+    Header of a csv export of a query set, from the cache when it has one. The header
+    of a sliced query set (eg. a page) is worked out from its slice, and not cached
+
+    :param query_set: Query set of the documents to export
+    :param db_alias: Alias of database holding the query set's collection
+    :param obs: Also works out the union of the keys of the documents' obs, which
+                isn't cached
+    :return: Dictionary of the sorted field names, under 'fields', and, if obs is True,
+             the sorted obs keys, under 'obs'
+    """
+    document = query_set._document
+    collection = query_set._collection
+    spec = query_set._query
+    stages = window_stages(query_set) if query_set._skip or query_set._limit else []
+    header = {}
+    if obs:
+        header['obs'] = sorted(obs_keys(collection, spec, db_alias, stages))
+    if stages:
+        header['fields'] = sorted(document_fields(document, collection, spec, stages))
+        return header
+    key = cache_key(spec)
+    if key is not None:
+        cached = cached_header(collection.name, key, db_alias)
+        if cached is not None:
+            header['fields'] = list(cached.fields)
+            return header
+    if collection.find_one(spec, {'_id': 1}) is None:
+        header['fields'] = []
+    else:
+        header['fields'] = sorted(document_fields(document, collection, spec))
+    if key is not None:
+        with switch_db(ExportHeader, db_alias) as Header:
+            Header._get_collection().update(
+                {'collection_name': collection.name, 'study': key[0], 'datasource': key[1]},
+                {'$set': {'fields': header['fields']}},
+                upsert=True,
+            )
+    return header
+
+
+def cached_header(collection_name, key, db_alias='default'):
+    with switch_db(ExportHeader, db_alias) as Header:
+        return Header.objects(
+            collection_name=collection_name, study=key[0], datasource=key[1]
+        ).only('fields').first()
+
+
+def invalidate_headers(collection_name, study=None, datasource=None, db_alias='default'):
+    """
+    Removes the cached headers that data loaded for, or removed from, the given study
+    and data source can change: theirs and those of queries not limited by them
+
+    :param collection_name: Name of the collection the data was written to
+    :param study: Study (or its id) of the data, or None for any study
+    :param datasource: Data source (or its id) of the data, or None for any
+    :return: Number of cached headers removed
+    """
+    spec = {'collection_name': collection_name}
+    if study is not None:
+        spec['study'] = {'$in': [getattr(study, 'pk', study), None]}
+    if datasource is not None:
+        spec['datasource'] = {'$in': [getattr(datasource, 'pk', datasource), None]}
+    with switch_db(ExportHeader, db_alias) as Header:
+        return delete_many(Header._get_collection(), spec)
@@ -2,7 +2,12 @@
 # from .models import *
 # from .logger import *
 from .algorithms import accumulate
+from .logger import Logger
+from .lean import lean_son
 #from .connectors import *
+import time
+from bson import BSON, ObjectId
+from mongoengine.context_managers import switch_db
 
 
 def is_float(s):
@@ -22,6 +27,10 @@ def is_int(s):
 class GenericImport:
     conn = None
     load_op = None
+    # Optional operator called with (rows, header_index, succ) for each batch of
+    # positional rows, used by Load() instead of load_op when set
+    batch_op = None
+    chunk_size = 1000
     clean_op = None
     ds = None
     header = None
@@ -38,6 +47,10 @@ class GenericImport:
     def Load(self):
         self.header = self.conn.header
         succ = False
+        if self.batch_op:
+            for rows in self.conn.chunks(self.chunk_size):
+                succ = self.batch_op(rows, self.conn.header_index, succ)
+            return succ
         succ = accumulate(self.conn, self.load_op, succ)
         return succ
 
@@ -54,4 +67,110 @@ class ImportOp:
     #     pass
 
 
-
+def insert_many(collection, sons):
+    """
+    Writes the given list of SON documents to the collection in one unordered
+    bulk write and returns the ids of the written documents.
+    Uses collection.insert_many() where pymongo provides it and falls back to
+    an unordered bulk operation for older pymongo versions
+
+    :param collection: pymongo collection to write to
+    :param sons: List of SON documents (eg. from document.to_mongo())
+    :return: List of the ids of the written documents
+    """
+    for son in sons:
+        if '_id' not in son:
+            son['_id'] = ObjectId()
+    if hasattr(collection, 'insert_many'):
+        return collection.insert_many(sons, ordered=False).inserted_ids
+    bulk = collection.initialize_unordered_bulk_op()
+    for son in sons:
+        bulk.insert(son)
+    bulk.execute()
+    return [son['_id'] for son in sons]
+
+
+def update_many(collection, spec, update):
+    """
+    Applies the update to every document of the collection matching spec, with
+    collection.update_many() where pymongo provides it and update(multi=True) otherwise
+
+    :return: Number of documents updated
+    """
+    if hasattr(collection, 'update_many'):
+        return collection.update_many(spec, update).modified_count
+    return collection.update(spec, update, multi=True).get('nModified', 0)
+
+
+def delete_many(collection, spec):
+    """
+    Removes every document of the collection matching spec, with
+    collection.delete_many() where pymongo provides it and remove() otherwise
+
+    :return: Number of documents removed
+    """
+    if hasattr(collection, 'delete_many'):
+        return collection.delete_many(spec).deleted_count
+    return collection.remove(spec).get('n', 0)
+
+
+class BulkInserter:
+    """
+    Collects validated documents of one document class into batches and writes
+    each batch with a single unordered bulk insert, instead of making one
+    save() round trip per document.
+
+    Keeps count of the documents written and the time taken so that the
+    rows/second of a load can be reported. The optional on_insert callback
+    gets called with the list of ids of every written batch. With measure set,
+    also adds up the BSON size of the documents written in bytes
+    """
+
+    def __init__(self, document, db_alias='default', batch_size=1000, on_insert=None, lean=False,
+                 measure=False):
+        self.document = document
+        self.batch_size = batch_size
+        self.on_insert = on_insert
+        # leaves out the fields that can be filled back in on read (see mongcore.lean)
+        self.lean = lean
+        self.measure = measure
+        self.bytes = 0
+        self.batch = []
+        self.inserted = 0
+        self.started = time.time()
+        with switch_db(document, db_alias) as Col:
+            self.collection = Col._get_collection()
+
+    def add(self, doc):
+        doc.validate()
+        son = doc.to_mongo()
+        if self.lean:
+            lean_son(self.document, son, doc._data.get('study'))
+        self.batch.append(son)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        if self.measure:
+            self.bytes += sum(len(BSON.encode(son)) for son in self.batch)
+        ids = insert_many(self.collection, self.batch)
+        self.inserted += len(ids)
+        self.batch = []
+        if self.on_insert:
+            self.on_insert(ids)
+
+    def rate(self):
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.inserted / elapsed
+
+    def report(self, name):
+        msg = "%s: wrote %d %s documents in %.1fs (%.0f rows/s)" % (
+            name, self.inserted, self.document.__name__,
+            time.time() - self.started, self.rate()
+        )
+        Logger.Message(msg)
+        return msg
@@ -0,0 +1,165 @@
+"""
+Building, deferring and reporting on the indexes declared in the meta of the document
+classes. mongoengine creates the declared indexes the first time a collection is used,
+in the background for the classes that set index_background. build_indexes() does the
+same on demand, for collections that already hold data, and deferred_indexes() drops
+them for the duration of a bulk load so inserts don't have to maintain them.
+
+QUERIES lists the queries the views and loaders make, and index_report() asks the
+database which index each one is served by
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+from bson import ObjectId
+from mongoengine import Document
+from mongoengine.base.common import get_document, _document_registry
+from mongoengine.context_managers import switch_db
+
+# (description, document class name, query kwargs) of the queries the indexes are for
+QUERIES = [
+    ("genotype reports: genotypes of an experiment", 'Genotype', {'study': ObjectId()}),
+    ("fetch_or_save: genotype of an experiment by name", 'Genotype', {'study': ObjectId(), 'name': ''}),
+    ("load_from_config: genotypes of a replaced data source", 'Genotype', {'datasource': ObjectId()}),
+    ("genotypes by name", 'Genotype', {'name': ''}),
+    ("genotypes by date created", 'Genotype', {'createddate__gte': datetime(1970, 1, 1)}),
+    ("RunTracker.roll_back: genotypes of an ingest run", 'Genotype', {'ingest_run': ObjectId()}),
+    ("genotype_region_report: genotypes on a region", 'Genotype', {'chrom': '', 'pos__gte': 0, 'pos__lte': 0}),
+    ("marker loaders: markers of a data source", 'Marker', {'datasource': ObjectId()}),
+    ("primer loaders: primers of a data source", 'Primer', {'datasource': ObjectId()}),
+    ("primer loaders: primer obs of a data source", 'PrimerOb', {'datasource': ObjectId()}),
+    ("experiment search: by name", 'Experiment', {'name': ''}),
+    ("experiment search: by primary investigator", 'Experiment', {'pi': ''}),
+    ("experiment search: by date created", 'Experiment', {'createddate__gte': datetime(1970, 1, 1)}),
+    ("data source lookups by name", 'DataSource', {'name': ''}),
+    ("load_from_config: data sources loaded from a file", 'DataSource', {'source': ''}),
+    ("genotypes_for_study: matrices of an experiment", 'GenotypeMatrix', {'study': ObjectId()}),
+    ("delete_matrices: matrices of a data source", 'GenotypeMatrix', {'datasource': ObjectId()}),
+    ("GenotypeMatrix.chunks: chunks of a matrix", 'GenotypeMatrixChunk', {'matrix': ObjectId(), 'stop__gt': 0}),
+    ("get_keys: key dictionary of a data source", 'ObsKeys', {'datasource': ObjectId()}),
+    ("experiment_summaries: data summaries of experiments", 'DataSummary', {'study__in': [ObjectId()]}),
+    ("ExpressionMatrix.chunks: chunks of an expression matrix", 'ExpressionMatrixChunk', {'matrix': ObjectId(), 'stop__gt': 0}),
+]
+
+
+def indexed_documents():
+    # Document classes with a collection of their own that declare indexes
+    documents = []
+    for document in _document_registry.values():
+        if not issubclass(document, Document) or document._meta.get('abstract'):
+            continue
+        if document._meta.get('index_specs') and document not in documents:
+            documents.append(document)
+    return sorted(documents, key=lambda document: document.__name__)
+
+
+def get_collection(document, db_alias='default'):
+    with switch_db(document, db_alias) as Col:
+        return Col._get_collection()
+
+
+def build_indexes(document, db_alias='default', background=True):
+    """
+    Creates the indexes declared in the meta of a document class. Indexes that already
+    exist are left as they are
+
+    :param document: Document class whose indexes to build
+    :param db_alias: Alias of database holding the collection
+    :param background: Builds the indexes without blocking other operations on the
+                       collection
+    """
+    with switch_db(document, db_alias) as Col:
+        declared = Col._meta.get('index_background', False)
+        Col._meta['index_background'] = background
+        try:
+            Col.ensure_indexes()
+        finally:
+            Col._meta['index_background'] = declared
+
+
+def drop_indexes(document, db_alias='default'):
+    # Drops every index of the document class's collection but the one on _id
+    get_collection(document, db_alias).drop_indexes()
+
+
+@contextmanager
+def deferred_indexes(documents, db_alias='default'):
+    """
+    Drops the indexes of the given document classes for the duration of a bulk load,
+    then builds them again in the background. mongoengine doesn't create them when the
+    collections are used in the meantime, including by worker processes started inside
+    the with block
+
+    :param documents: Document classes whose indexes to defer
+    :param db_alias: Alias of database the load writes to
+    """
+    auto_create = {}
+    for document in documents:
+        auto_create[document] = document._meta.get('auto_create_index', True)
+        document._meta['auto_create_index'] = False
+        drop_indexes(document, db_alias)
+    try:
+        yield
+    finally:
+        for document in documents:
+            document._meta['auto_create_index'] = auto_create[document]
+            build_indexes(document, db_alias)
+
+
+def plan_indexes(explain):
+    """
+    Names of the indexes used by the winning plan of a query's explain output, for
+    both the MongoDB 3.0+ and the older explain formats. An empty list means the query
+    scans the whole collection
+    """
+    if 'queryPlanner' in explain:
+        names = []
+        stages = [explain['queryPlanner']['winningPlan']]
+        while stages:
+            stage = stages.pop()
+            if 'indexName' in stage:
+                names.append(stage['indexName'])
+            stages.extend(stage.get('inputStages', []))
+            if 'inputStage' in stage:
+                stages.append(stage['inputStage'])
+        return names
+    plans = explain.get('clauses', [explain])
+    return [plan['cursor'].split()[1] for plan in plans if plan.get('cursor', '').startswith('BtreeCursor')]
+
+
+def index_report(db_alias='default', queries=QUERIES):
+    """
+    Finds which index serves each of the given queries
+
+    :param db_alias: Alias of database to explain the queries against
+    :param queries: (description, document class name, query kwargs) tuples
+    :return: Dictionary of index names, including None for queries that scan the whole
+             collection, to lists of the descriptions of the queries each serves, per
+             document class name. Declared indexes no query uses are listed with an
+             empty list
+    """
+    report = {}
+    for document in indexed_documents():
+        collection = get_collection(document, db_alias)
+        uses = report[document.__name__] = {}
+        for name in collection.index_information():
+            if name != '_id_':
+                uses[name] = []
+    for description, name, query in queries:
+        with switch_db(get_document(name), db_alias) as Col:
+            explain = Col.objects(**query).explain()
+        uses = report.setdefault(name, {})
+        for index in plan_indexes(explain) or [None]:
+            uses.setdefault(index, []).append(description)
+    return report
+
+
+def format_report(report):
+    lines = []
+    for name in sorted(report):
+        lines.append(name)
+        for index in sorted(report[name], key=str):
+            descriptions = report[name][index]
+            label = 'collection scan' if index is None else index
+            lines.append("  %s: %s" % (label, '; '.join(descriptions) or 'no queries'))
+    return '\n'.join(lines)
@@ -0,0 +1,161 @@
+"""
+Keeps track of the documents a run of a loading script creates. Each run is
+recorded as an IngestRun document, and every document the run creates is stamped
+with the run's id, so a failed or unwanted run can be rolled back with a single
+indexed delete per collection instead of deleting its documents one by one
+"""
+
+from datetime import datetime
+import mongoengine
+from mongoengine.base import get_document
+from mongoengine.base.common import _document_registry
+from mongoengine.context_managers import switch_db
+from .models import IngestRun, DataError
+from .headers import invalidate_headers
+from .logger import Logger
+
+
+class RunTracker:
+    """
+    Stamps documents with the id of an IngestRun and counts them per document
+    class. The first time a document class is seen it is added to the run's
+    collections straight away, so a rollback finds it even if the run never
+    finishes. The counts are written when save_counts() or finish() is called
+    """
+
+    def __init__(self, name=None, db_alias='default', run_id=None):
+        """
+        :param name: Name to record a new run under
+        :param db_alias: Alias of database the run writes to
+        :param run_id: Id of an existing run to carry on tracking (eg. in a worker process)
+        """
+        self.db_alias = db_alias
+        self.seen = set()
+        self.counts = {}
+        with switch_db(IngestRun, db_alias) as Runs:
+            if run_id is None:
+                self.run = Runs(name=name)
+                self.run.save()
+            else:
+                self.run = Runs.objects.get(id=run_id)
+                self.seen.update(self.run.collections)
+
+    @property
+    def id(self):
+        return self.run.id
+
+    def stamp(self, doc):
+        doc.ingest_run = self.run.id
+        return doc
+
+    def created(self, document, n=1):
+        name = document.__name__
+        if name not in self.seen:
+            self.seen.add(name)
+            with switch_db(IngestRun, self.db_alias) as Runs:
+                Runs.objects(id=self.run.id).update_one(add_to_set__collections=name)
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def save_counts(self):
+        if not self.counts:
+            return
+        inc = {}
+        for name in self.counts:
+            inc['inc__counts__' + name] = self.counts[name]
+        with switch_db(IngestRun, self.db_alias) as Runs:
+            Runs.objects(id=self.run.id).update_one(**inc)
+        self.counts = {}
+
+    def finish(self, status='done', message=''):
+        self.save_counts()
+        with switch_db(IngestRun, self.db_alias) as Runs:
+            Runs.objects(id=self.run.id).update_one(
+                set__status=status, set__finished=datetime.now(), set__message=message
+            )
+
+    def roll_back(self, message=''):
+        self.save_counts()
+        roll_back_run(self.run.id, self.db_alias)
+        with switch_db(IngestRun, self.db_alias) as Runs:
+            Runs.objects(id=self.run.id).update_one(set__message=message)
+
+
+def referenced_ids(document, ids, db_alias='default'):
+    """
+    The ids among the given ones of documents of the given class that a document of
+    any collection still references
+
+    :param document: Document class, eg. Experiment
+    :param ids: Ids of documents of that class
+    :return: Set of the ids referenced
+    """
+    referenced = set()
+    seen = set()
+    for cls in list(_document_registry.values()):
+        if not issubclass(cls, mongoengine.Document) or cls._meta.get('abstract'):
+            continue
+        for field in cls._fields.values():
+            if not isinstance(field, mongoengine.ReferenceField) \
+                    or field.document_type is not document:
+                continue
+            key = (cls._get_collection_name(), field.db_field)
+            if key in seen:
+                continue
+            seen.add(key)
+            with switch_db(cls, db_alias) as Col:
+                query = {field.db_field: {'$in': list(set(ids) - referenced)}}
+                referenced.update(Col._get_collection().find(query).distinct(field.db_field))
+    return referenced
+
+
+def roll_back_run(run_id, db_alias='default'):
+    """
+    Removes every document stamped with the given run id, with one delete per
+    collection the run wrote to, and marks the run as rolled back. Experiments and
+    data sources the run created are kept while documents of other runs reference
+    them
+
+    :param run_id: Id of the IngestRun to roll back
+    :param db_alias: Alias of database the run wrote to
+    :return: Dictionary of the number of documents removed per document class
+    """
+    with switch_db(IngestRun, db_alias) as Runs:
+        run = Runs.objects.get(id=run_id)
+    if run.status == 'rolled back':
+        raise DataError("Ingest run %s has already been rolled back" % run.id)
+    removed = {}
+    kept = {}
+    # Features are removed before the data sources and experiments they reference, so
+    # only references from documents of other runs are left when those are checked
+    order = {'DataSource': 1, 'Experiment': 2}
+    for name in sorted(run.collections, key=lambda n: order.get(n, 0)):
+        document = get_document(name)
+        with switch_db(document, db_alias) as Col:
+            query = Col.objects(ingest_run=run.id)
+            if name in order:
+                ids = Col._get_collection().find({'ingest_run': run.id}).distinct('_id')
+                shared = referenced_ids(document, ids, db_alias)
+                if shared:
+                    kept[name] = len(shared)
+                    query = query.filter(id__nin=list(shared))
+            removed[name] = query.delete()
+        invalidate_headers(document._get_collection_name(), db_alias=db_alias)
+    message = "kept, referenced by other runs: " + str(kept) if kept else ""
+    with switch_db(IngestRun, db_alias) as Runs:
+        Runs.objects(id=run.id).update_one(
+            set__status='rolled back', set__finished=datetime.now(), set__message=message
+        )
+    Logger.Message("Rolled back ingest run " + str(run.id) + ": " + str(removed) + (
+        "; " + message if message else ""
+    ))
+    return removed
+
+
+def list_runs(db_alias='default'):
+    with switch_db(IngestRun, db_alias) as Runs:
+        return list(Runs.objects.order_by('-started'))
+
+
+def get_run(run_id, db_alias='default'):
+    with switch_db(IngestRun, db_alias) as Runs:
+        return Runs.objects.get(id=run_id)
@@ -0,0 +1,121 @@
+"""
+Lean storage of Feature documents. Bulk loaded features mostly repeat the same values:
+the defaults of geom, alias, statuscode and name, the study's createddate and
+description, and time stamps that are no more than the time the document was made.
+lean_son() leaves out of a feature's son every field that can be worked out again when
+the document is read:
+
+- fields equal to a constant default, which mongoengine fills back in by itself
+- dtt, when it is the time the document was made, and lastupdateddate, when it was
+  never set. Both are filled in from the creation time held in the document's ObjectId,
+  to the second
+- createddate and description, when they are the study's. Filled in from the study
+
+fill_lean() puts the fields back into a son. Feature calls it for every document read
+through mongoengine, and code reading sons straight from pymongo calls it itself
+"""
+
+from datetime import datetime, timedelta
+from bson import ObjectId, DBRef
+from mongoengine import Document
+
+# Fields left out when equal to the study's, and filled in from it
+inherited_fields = ('createddate', 'description')
+# Fields filled in from the creation time of the document's ObjectId
+creation_time_fields = ('dtt', 'lastupdateddate')
+
+# Sons of the constant field defaults, per document class
+defaults_cache = {}
+# createddate and description of studies, by (database name, study id)
+study_cache = {}
+
+
+def constant_defaults(document):
+    # The to_mongo() values of the fields of the document class with a constant default
+    defaults = defaults_cache.get(document)
+    if defaults is None:
+        defaults = {}
+        for name, field in document._fields.items():
+            default = field.default
+            if name in inherited_fields or name in creation_time_fields or name == 'id':
+                continue
+            if default is None or callable(default) or isinstance(default, datetime):
+                # defaults of datetime.now() differ from process to process
+                continue
+            defaults[field.db_field] = field.to_mongo(default)
+        defaults_cache[document] = defaults
+    return defaults
+
+
+def creation_time(_id):
+    # Time the ObjectId was made, as the naive local time that dtt is stored in
+    return datetime.fromtimestamp(_id.generation_time.timestamp())
+
+
+def lean_son(document, son, study=None):
+    """
+    Leaves the fields that fill_lean() can put back out of a feature's son. Gives the
+    son an ObjectId if it has none, as dtt is only left out when the id's creation time
+    matches it
+
+    :param document: Feature class of the son
+    :param son: Son of the feature as from to_mongo(). Changed in place
+    :param study: The feature's Experiment document, or None to keep createddate and
+                  description
+    :return: The son
+    """
+    for key, default in constant_defaults(document).items():
+        if key in son and son[key] == default:
+            del son[key]
+    if '_id' not in son:
+        son['_id'] = ObjectId()
+    dtt = son.get('dtt')
+    if dtt is not None and abs(dtt - creation_time(son['_id'])) < timedelta(seconds=1):
+        del son['dtt']
+    never_updated = document._fields['lastupdateddate'].default
+    if 'lastupdateddate' in son and son['lastupdateddate'] == never_updated:
+        del son['lastupdateddate']
+    if isinstance(study, Document):
+        for key in inherited_fields:
+            if key in son and son[key] == getattr(study, key):
+                del son[key]
+    return son
+
+
+def study_values(db, collection, study_id):
+    key = (db.name, study_id)
+    values = study_cache.get(key)
+    if values is None:
+        fields = dict((field, 1) for field in inherited_fields)
+        son = db[collection].find_one({'_id': study_id}, fields)
+        values = study_cache[key] = dict(
+            (field, son[field]) for field in inherited_fields if son and field in son
+        )
+    return values
+
+
+def fill_lean(document, son, db):
+    """
+    Puts the fields lean_son() left out back into a feature's son. Sons stored in full
+    are returned as they are
+
+    :param document: Feature class of the son
+    :param son: Son of the feature as read from the collection. Changed in place
+    :param db: Database holding the feature's study
+    :return: The son
+    """
+    if '_id' in son:
+        for key in creation_time_fields:
+            if key not in son:
+                son[key] = creation_time(son['_id'])
+    study = son.get('study')
+    missing = [key for key in inherited_fields if key not in son]
+    if study is not None and missing:
+        if isinstance(study, DBRef):
+            study = study.id
+        collection = document._fields['study'].document_type._get_collection_name()
+        values = study_values(db, collection, study)
+        for key in missing:
+            if key in values:
+                son[key] = values[key]
+    return son
@@ -1,7 +1,4 @@
 from django.db import models
-from django.db.models.signals import pre_save
-from django.dispatch import receiver
-from django.core.exceptions import ObjectDoesNotExist
 from django.db.models.base import *
 
 from djorm_pgfulltext.models import SearchManager
@@ -18,8 +15,15 @@ import re
 import collections 
 from jsonfield import JSONField
 from djgeojson.fields import PointField
+import threading
 import mongoengine
+from mongoengine.base.common import _document_registry
+from mongoengine.errors import OperationError
+from mongoengine.queryset import QuerySet, QuerySetNoCache
+from mongoengine.connection import get_db
+from bson import DBRef
 from datetime import datetime
+from .lean import fill_lean
 
 # Create your models here.
 
@@ -63,6 +67,25 @@ class DataSource(mongoengine.Document):
     is_active = mongoengine.BooleanField(default=False)
     values = JSONField(load_kwargs={'object_pairs_hook': collections.OrderedDict})
     search_index = VectorField()
+    ingest_run = mongoengine.ObjectIdField()
+    # sha1 and size in bytes of the file the data source was loaded from, so unchanged
+    # files can be skipped when their directory is loaded again
+    fingerprint = mongoengine.StringField()
+    size = mongoengine.LongField()
+    # Where the features of the data source were moved when it was archived: 'collection'
+    # for the archive collections, or the directory of the archive files. None while the
+    # features are in the main collections (see mongcore.archive)
+    archive = mongoengine.StringField()
+    archived_date = mongoengine.DateTimeField()
+    # Studies of the archived features, so searches of a study only read the archive
+    # files of the data sources that have features of it
+    archived_studies = mongoengine.ListField(mongoengine.ObjectIdField())
+
+    # see mongcore.indexes for the queries each index serves
+    meta = {
+        'indexes': ['name', 'source', {'fields': ['ingest_run'], 'sparse': True}],
+        'index_background': True,
+    }
 
     def GetName(self):
         return self.name
@@ -121,11 +144,97 @@ class Experiment(mongoengine.Document):
     createddate = mongoengine.DateTimeField(default=datetime.now())
     createdby = mongoengine.StringField(max_length=255)
     description = mongoengine.StringField(default="")
+    ingest_run = mongoengine.ObjectIdField()
+
+    meta = {
+        'indexes': ['name', 'pi', 'createddate', {'fields': ['ingest_run'], 'sparse': True}],
+        'index_background': True,
+    }
+
+    def __unicode__(self):
+        return self.name
+
+
+""" Record of one run of a loading script. Every document the run creates is
+stamped with the run's id in its ingest_run field, so the run can be
+rolled back with one delete per collection.
+
+"""
+class IngestRun(mongoengine.Document):
+    name = mongoengine.StringField(max_length=2048)
+    status = mongoengine.StringField(max_length=32, default="running")
+    started = mongoengine.DateTimeField(default=datetime.now)
+    finished = mongoengine.DateTimeField()
+    # class names of the documents created by the run, and how many of each
+    collections = mongoengine.ListField(mongoengine.StringField(max_length=255))
+    counts = mongoengine.DictField()
+    message = mongoengine.StringField(default="")
 
     def __unicode__(self):
         return self.name
 
 
+""" Key dictionary for the obs of the features loaded from a data source. Features
+with encoded obs store only the values, in obs_values, in the order of these keys,
+so the key strings are stored once per data source instead of once per feature.
+
+"""
+class ObsKeys(mongoengine.Document):
+    datasource = mongoengine.ReferenceField(DataSource, unique=True)
+    keys = mongoengine.ListField(mongoengine.StringField())
+    ingest_run = mongoengine.ObjectIdField()
+
+    meta = {
+        'indexes': [{'fields': ['ingest_run'], 'sparse': True}]
+    }
+
+    def __unicode__(self):
+        return str(self.datasource)
+
+
+class DataSummary(mongoengine.Document):
+    """
+    Counts kept up to date as the features of a data source are loaded, so they can be
+    shown without reading the features (see mongcore.summaries). called holds the number
+    of calls that aren't missing for each sample, out of n_markers, and
+    missing_histogram the number of markers by the fraction of their calls that are
+    missing, in tenths
+    """
+    study = mongoengine.ReferenceField(Experiment)
+    datasource = mongoengine.ReferenceField(DataSource, unique=True)
+    n_documents = mongoengine.LongField(default=0)
+    n_markers = mongoengine.LongField(default=0)
+    called = mongoengine.DictField()
+    missing_histogram = mongoengine.ListField(mongoengine.LongField())
+    n_bytes = mongoengine.LongField(default=0)
+    lastupdateddate = mongoengine.DateTimeField()
+    ingest_run = mongoengine.ObjectIdField()
+
+    meta = {
+        'indexes': ['study', {'fields': ['ingest_run'], 'sparse': True}]
+    }
+
+    def __unicode__(self):
+        return str(self.datasource)
+
+
+class ExportHeader(mongoengine.Document):
+    """
+    Cached csv export header of the features of a collection, of one study and/or data
+    source or of all of them (see mongcore.headers). fields are the names of the fields
+    the features store
+    """
+    collection_name = mongoengine.StringField()
+    study = mongoengine.ObjectIdField()
+    datasource = mongoengine.ObjectIdField()
+    fields = mongoengine.ListField(mongoengine.StringField())
+    createddate = mongoengine.DateTimeField(default=datetime.now)
+
+    meta = {
+        'indexes': [('collection_name', 'study', 'datasource')]
+    }
+
+
 class ExperimentForTable(models.Model):
 
     data_source_url = "data_source/"
@@ -133,7 +242,7 @@ class ExperimentForTable(models.Model):
 
     field_names = [
         'Name', 'Primary Investigator', 'Date Created', 'Data Source',
-        'Download Link',
+        'Download Link', 'Markers', 'Samples',
     ]
 
     name = models.CharField(field_names[0], max_length=200)
@@ -141,6 +250,9 @@ class ExperimentForTable(models.Model):
     date_created = models.DateTimeField(field_names[2])  # When
     data_source = models.CharField(field_names[3], max_length=200)
     download_link = models.CharField(field_names[4], max_length=200)
+    # From the experiment's data summaries, None when it has none
+    markers = models.IntegerField(field_names[5], null=True)
+    samples = models.IntegerField(field_names[6], null=True)
 
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
@@ -150,21 +262,75 @@ class ExperimentForTable(models.Model):
         app_label = 'experimentsearch'
 
 
-def make_table_experiment(experiment):
+def make_table_experiment(experiment, summary=None):
     name = experiment.name
     id = str(experiment.id)
     data_source = ExperimentForTable.data_source_url + name + "/"
     download_link = ExperimentForTable.download_url + id + "/"
+    summary = summary or {}
 
     return ExperimentForTable(
         name=name, primary_investigator=experiment.pi,
         date_created=experiment.createddate, data_source=data_source,
-        download_link=download_link,
+        download_link=download_link, markers=summary.get('markers'),
+        samples=summary.get('samples'),
     )
 
 
+# Fields of Feature holding copies of the names of the documents it references
+name_copies = {'study': 'study_name', 'datasource': 'datasource_name'}
+
+
 """ Class that holds features with observations attached
 """
+# Database of the query set a feature is being read from, per thread, for _from_son()
+reading = threading.local()
+
+
+def read_from(query_set, read):
+    """
+    Calls read() to read a document of the query set, filling lean sons from the query
+    set's database. Query sets are often made inside a switch_db() block and read after
+    it, when the class is back on the default database. The document read is bound to
+    the query set's database, as Document.switch_db() would
+    """
+    collection = query_set._collection
+    db = collection.database
+    reading.db = db
+    try:
+        doc = read()
+    finally:
+        reading.db = None
+    if isinstance(doc, mongoengine.Document):
+        doc._get_db = lambda: db
+        doc._get_collection = lambda: collection
+    return doc
+
+
+class ReadsOwnDatabase:
+    # Reads the documents of a Feature query set through read_from()
+
+    def __next__(self):
+        return read_from(self, super(ReadsOwnDatabase, self).__next__)
+
+    def __getitem__(self, key):
+        return read_from(self, lambda: super(ReadsOwnDatabase, self).__getitem__(key))
+
+
+class FeatureQuerySet(ReadsOwnDatabase, QuerySet):
+
+    def no_cache(self):
+        if self._result_cache is not None:
+            raise OperationError("QuerySet already cached")
+        return self.clone_into(FeatureQuerySetNoCache(self._document, self._collection))
+
+
+class FeatureQuerySetNoCache(ReadsOwnDatabase, QuerySetNoCache):
+
+    def cache(self):
+        return self.clone_into(FeatureQuerySet(self._document, self._collection))
+
+
 class Feature(mongoengine.Document):
     fmt = "csv"
 
@@ -184,9 +350,15 @@ class Feature(mongoengine.Document):
     obkeywords = mongoengine.StringField()
     statuscode = mongoengine.IntField(default=1)
     search_index = VectorField()
+    ingest_run = mongoengine.ObjectIdField()
+    # copies of the names of the study and data source, kept in step by name_copies
+    study_name = mongoengine.StringField()
+    datasource_name = mongoengine.StringField()
 
 
     obs = mongoengine.DictField()
+    # obs encoded as a list of values in the order of the data source's ObsKeys
+    obs_values = mongoengine.ListField(default=None)
 
     def GetData(self, fmt="csv"):
         res = []
@@ -196,17 +368,26 @@ class Feature(mongoengine.Document):
 
     @classmethod
     def InitOntology(cls):
-        name = cls.__name__
-        app = cls._meta.app_label
+        return get_ontology(cls)
+
+    def clean(self):
+        # Copies the names of the study and data source into the feature when it is
+        # validated, so exports and GetName() don't have to look them up
+        for field, copy in name_copies.items():
+            value = self._data.get(field)
+            if isinstance(value, mongoengine.Document):
+                self._data[copy] = value.name
+            elif value is not None and self._data.get(copy) is None:
+                self._data[copy] = ref_name(self, field)
 
-        tname = app + '_' + name.lower()
-
-        obt = Ontology.objects.get_or_create(
-            name=name,
-            classname=name,
-            tablename=tname,
-            owner=app,
-            group=app)
+    @classmethod
+    def _from_son(cls, son, *args, **kwargs):
+        # Fills in the fields of documents stored lean (see mongcore.lean). The study is
+        # looked up in the database of the query set reading the son, or else the one
+        # the class is switched to
+        db = getattr(reading, 'db', None)
+        fill_lean(cls, son, cls._get_db() if db is None else db)
+        return super(Feature, cls)._from_son(son, *args, **kwargs)
 
     def GetName(self):
         return self.name
@@ -215,7 +396,14 @@ class Feature(mongoengine.Document):
         return True
 
     meta = {
-        'allow_inheritance': True, 'abstract': True
+        'allow_inheritance': True, 'abstract': True,
+        'queryset_class': FeatureQuerySet,
+        # (study, name) also serves queries on study alone
+        'indexes': [
+            ('study', 'name'), 'datasource', 'name', 'createddate',
+            {'fields': ['ingest_run'], 'sparse': True},
+        ],
+        'index_background': True,
     }
 
 
@@ -298,35 +486,108 @@ def convert(name):
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
 
 
-# SIGNALS
-@receiver(pre_save)
-def set_ontology(sender, instance, **kwargs):
-    class_name = instance.__class__.__name__
-    try:
-        instance.IsOntology()
-    except Exception:
-        return
-
-    try:
+# Ontology terms keyed by database alias and document class, built by get_ontology()
+ontology_cache = {}
+# Names of referenced documents keyed by database name, collection and id, filled by
+# ref_name()
+ref_name_cache = {}
+
+
+def clear_caches():
+    """
+    Empties the ontology and reference name caches, which may hold values of documents
+    changed or deleted since. Called at the start of each load
+    """
+    ontology_cache.clear()
+    ref_name_cache.clear()
+
+
+def get_ontology(cls):
+    """
+    Returns the Ontology term for the given document class. The term only depends
+    on the class, so its values are worked out once per database the class is saved
+    to. Each call gets its own copy, as every document embeds its own term
+    """
+    key = (cls._meta.get('db_alias', 'default'), cls)
+    values = ontology_cache.get(key)
+    if values is None:
+        class_name = cls.__name__
         try:
-            grp = instance._meta.app_label
+            grp = cls._meta.app_label
         except:
             grp = 'core'
-
-        table_name = grp + '_' + convert(class_name)
-
-        obt, created = Ontology.objects.get_or_create(
+        values = ontology_cache[key] = dict(
             classname=class_name,
             name=class_name,
-            tablename=table_name,
+            tablename=grp + '_' + convert(class_name),
             owner=grp,
             group=grp
         )
-        instance.ontology = obt
-        instance.xreflsid = class_name + "." + instance.GetName()
-        instance.obkeywords = class_name + " " + instance.GetName()
-
-    except ObjectDoesNotExist:
-        msg = "ERROR in signal set_ontology. Uknown class: %s." % class_name
-        Logger.Warning(msg)
-        raise DataError(msg)
+    return Ontology(**values)
+
+
+def feature_documents(db_alias='default'):
+    """
+    The Feature classes whose collections exist in the database, one per collection:
+    the class the collection belongs to, whose queries (see class_spec()) also match
+    its subclasses
+    """
+    existing = set(get_db(db_alias).collection_names())
+    documents = {}
+    for document in _document_registry.values():
+        if issubclass(document, Feature) and not document._meta.get('abstract'):
+            name = document._get_collection_name()
+            if name in existing and (name not in documents or issubclass(documents[name], document)):
+                documents[name] = document
+    return [documents[name] for name in sorted(documents)]
+
+
+def class_spec(document):
+    """
+    The condition on _cls that mongoengine adds to the queries of a class that allows
+    inheritance, for raw pymongo queries. Every index of such a class starts with _cls,
+    so a raw query without it can't use them, and would match other classes stored in
+    the collection
+    """
+    if not document._meta.get('allow_inheritance'):
+        return {}
+    subclasses = list(document._subclasses)
+    return {'_cls': subclasses[0] if len(subclasses) == 1 else {'$in': subclasses}}
+
+
+def ref_name(instance, field):
+    """
+    Returns the name of the document referenced by the given field of instance
+    without dereferencing the field. Unloaded references are looked up once per
+    database, fetching only the name, from the database instance lives in
+    """
+    value = instance._data.get(field)
+    if value is None:
+        return None
+    if isinstance(value, mongoengine.Document):
+        return value.GetName() if hasattr(value, 'GetName') else value.name
+    if isinstance(value, DBRef):
+        collection, ref_id = value.collection, value.id
+    else:
+        collection = instance._fields[field].document_type._get_collection_name()
+        ref_id = value
+    db = instance._get_db()
+    key = (db.name, collection, ref_id)
+    if key not in ref_name_cache:
+        son = db[collection].find_one({'_id': ref_id}, {'name': 1})
+        ref_name_cache[key] = son.get('name') if son else None
+    return ref_name_cache[key]
+
+
+def set_ontology_fields(instance, name=None):
+    """
+    Sets the ontology, xreflsid and obkeywords fields of a Feature. Pass the
+    instance's name if it is already known, so GetName() does not get called
+    """
+    class_name = instance.__class__.__name__
+    if name is None:
+        name = instance.GetName()
+    instance.ontology = get_ontology(instance.__class__)
+    instance.xreflsid = class_name + "." + name
+    instance.obkeywords = class_name + " " + name
+    return instance
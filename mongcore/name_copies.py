@@ -0,0 +1,45 @@
+"""
+Keeps the study_name and datasource_name copies on Feature documents in step with the
+names of the experiments and data sources they reference. Features get the copies when
+they are validated, so exports and names don't look the references up. After an
+Experiment or DataSource is renamed, propagate_names() updates the copies with one
+indexed update per referenced document and feature collection. Features saved before
+they carried copies get them the same way
+"""
+
+from mongoengine.connection import get_db
+from mongoengine.context_managers import switch_db
+from .models import Experiment, DataSource, name_copies, ref_name_cache, feature_documents, class_spec
+from .imports import update_many
+
+# Feature field referencing each class of document whose name is copied
+reference_fields = {Experiment: 'study', DataSource: 'datasource'}
+
+
+def propagate_names(Document, ids=None, db_alias='default'):
+    """
+    Updates the copies of the names of the given experiments or data sources on every
+    feature that references them and holds an out of date copy, or none
+
+    :param Document: Experiment or DataSource
+    :param ids: Ids of the documents renamed, or None for all of them
+    :param db_alias: Alias of database to update
+    :return: Number of features updated
+    """
+    field = reference_fields[Document]
+    copy = name_copies[field]
+    with switch_db(Document, db_alias) as Ref:
+        query = Ref.objects if ids is None else Ref.objects(id__in=ids)
+        names = [(ref.id, ref.name) for ref in query.only('name')]
+    db = get_db(db_alias)
+    updated = 0
+    for document in feature_documents(db_alias):
+        collection = db[document._get_collection_name()]
+        for ref_id, name in names:
+            # with the _cls condition that leads the (_cls, study) and (_cls, datasource)
+            # indexes
+            spec = dict(class_spec(document), **{field: ref_id, copy: {'$ne': name}})
+            updated += update_many(collection, spec, {'$set': {copy: name}}) or 0
+    # names looked up before the rename are out of date too
+    ref_name_cache.clear()
+    return updated
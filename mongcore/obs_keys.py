@@ -0,0 +1,116 @@
+"""
+Dictionary encoding of Feature.obs. Every feature loaded from a data source tends to
+have the same several hundred obs keys (sample names for genotype data), so instead of
+storing the keys in every document they are stored once per data source, in an ObsKeys
+document, and each feature stores only its values as a list in obs_values.
+
+ObsKeyEncoder encodes obs while loading, and decode_obs() turns a document's son back
+into one with a plain obs dict, so exports read encoded and plain documents alike
+"""
+
+from mongoengine.context_managers import switch_db
+from .models import ObsKeys
+
+
+class ObsKeyEncoder:
+    """
+    Encodes the obs of the features of one data source. Keys not seen before are added
+    to the end of the data source's key dictionary, so values encoded earlier still line
+    up with their keys. Call save() once the features have been written
+    """
+
+    def __init__(self, datasource, db_alias='default', ingest_run=None):
+        """
+        :param datasource: Data source of the features to encode
+        :param db_alias: Alias of database to keep the key dictionary in
+        :param ingest_run: Id of the ingest run to stamp a new key dictionary with
+        """
+        self.db_alias = db_alias
+        self.created = False
+        with switch_db(ObsKeys, db_alias) as Keys:
+            self.doc = Keys.objects(datasource=datasource).first()
+            if self.doc is None:
+                self.doc = Keys(datasource=datasource, keys=[], ingest_run=ingest_run)
+                self.doc.save()
+                self.created = True
+        self.keys = list(self.doc.keys)
+        self.saved = len(self.keys)
+        self.index = dict((key, i) for i, key in enumerate(self.keys))
+
+    def position(self, key):
+        i = self.index.get(key)
+        if i is None:
+            i = self.index[key] = len(self.keys)
+            self.keys.append(key)
+        return i
+
+    def encode(self, obs):
+        # The values of the obs dict in key dictionary order. None marks a missing key
+        values = [None] * len(self.keys)
+        for key in obs:
+            i = self.position(key)
+            if i >= len(values):
+                values.extend([None] * (i + 1 - len(values)))
+            values[i] = obs[key]
+        while values and values[-1] is None:
+            values.pop()
+        return values
+
+    def encode_row(self, keys, row):
+        """
+        Encodes a positional row with the given column keys. When the keys are the key
+        dictionary, as they are for every row of a file, the row is used as it is. None
+        keys, such as the earlier of two columns with the same name, are left out
+        """
+        if not self.keys and None not in keys:
+            # the first row encoded sets the key dictionary
+            for key in keys:
+                self.position(key)
+        if keys == self.keys:
+            return list(row)
+        return self.encode(dict((key, value) for key, value in zip(keys, row) if key is not None))
+
+    def save(self):
+        if len(self.keys) == self.saved:
+            return
+        with switch_db(ObsKeys, self.db_alias) as Keys:
+            Keys.objects(id=self.doc.id).update_one(
+                push_all__keys=self.keys[self.saved:]
+            )
+        self.saved = len(self.keys)
+
+
+# Key dictionaries by data source id, per database
+keys_cache = {}
+
+
+def get_keys(datasource_id, db_alias='default', min_length=0):
+    # Keys only ever get added, so a cached dictionary is refetched only when it is
+    # shorter than the values being decoded
+    cache_key = (db_alias, datasource_id)
+    keys = keys_cache.get(cache_key)
+    if keys is None or len(keys) < min_length:
+        with switch_db(ObsKeys, db_alias) as Keys:
+            doc = Keys.objects(datasource=datasource_id).first()
+        keys = keys_cache[cache_key] = list(doc.keys) if doc else []
+    return keys
+
+
+def decode_values(keys, values):
+    return dict((key, value) for key, value in zip(keys, values) if value is not None)
+
+
+def decode_obs(son, db_alias='default'):
+    """
+    Replaces the obs_values of a feature's son with the obs dict they encode. Sons with
+    plain obs are returned as they are
+
+    :param son: Dictionary of a feature document's fields, as from to_mongo().to_dict()
+    :param db_alias: Alias of database holding the data source's key dictionary
+    :return: The son
+    """
+    values = son.pop('obs_values', None)
+    if values is not None:
+        keys = get_keys(son.get('datasource'), db_alias, len(values))
+        son['obs'] = decode_values(keys, values)
+    return son
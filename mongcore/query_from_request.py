@@ -4,6 +4,7 @@ from kaka.settings import TEST_DB_ALIAS
 from experimentsearch import forms as my_forms
 from mongcore.models import Experiment, make_table_experiment
 from mongcore.errors import QueryBadKeysError, QueryBadDateError
+from mongcore.summaries import experiment_summaries
 from mongoengine.context_managers import switch_db
 from experimentsearch.tables import ExperimentTable
 from django_tables2 import RequestConfig
@@ -347,8 +348,10 @@ class QueryRequestHandler:
             table = None
         else:
             table_list = []
+            # counts come from the experiments' data summaries, not from their features
+            summaries = experiment_summaries(self.search_list, self.db_alias)
             for experiment in self.search_list:
-                table_list.append(make_table_experiment(experiment))
+                table_list.append(make_table_experiment(experiment, summaries.get(experiment.pk)))
             table = ExperimentTable(table_list)
             RequestConfig(self.request, paginate={"per_page": 25}).configure(table)
         advanced = isinstance(self.form, my_forms.AdvancedSearchForm)
@@ -1,7 +1,20 @@
 from mongoengine.context_managers import switch_db
-from .models import Experiment, DataSource, Feature
+from mongoengine.queryset import QuerySet
+from mongoengine.queryset.base import BaseQuerySet
+from .models import Feature, name_copies
+from .obs_keys import decode_obs
+from .lean import fill_lean
+from .headers import discover_header
+from .references import RefNames
 from kaka.settings import TEST_DB_ALIAS
 
+# Copies of referenced names, which are exported as the references' __name columns
+copy_fields = set(name_copies.values())
+# Reference fields exported as the names of the documents they reference
+ref_fields = tuple(name_copies)
+# Documents read per round trip to the server by export_sons()
+raw_batch_size = 5000
+
 
 def fetch_or_save(Document, db_alias='default', search_dict=None, **kwargs):
     """
@@ -36,7 +49,7 @@ def fetch_or_save(Document, db_alias='default', search_dict=None, **kwargs):
         return doc, False
 
 
-def build_dict(document, testing=False):
+def build_dict(document, testing=False, ref_names=None):
     """
     Returns a dictionary built from a document's fields. Does not include keys
     which start with '_' as they are metadata fields. For document values in
@@ -44,22 +57,50 @@ def build_dict(document, testing=False):
     :param document: Document to build dictionary from
     :param testing: If method called in unit test (to determine which db to get
                     reference values from)
+    :param ref_names: RefNames to take the names of references from, shared by the
+                      documents of an export so each reference is looked up once
     :return: Dictionary representation of document
     """
-    object_dict = document.to_mongo().to_dict()
-    to_return = {}
+    names = None
     if isinstance(document, Feature):
-        ref_fields = get_ref_fields(document, testing)
+        if ref_names is None:
+            ref_names = RefNames(TEST_DB_ALIAS if testing else 'default')
+        names = ref_names.of(document)
+    return export_dict(document_dict(document, testing), names)
+
+
+def export_dict(object_dict, names=None):
+    # The exported dictionary of a document's son, see build_dict()
+    to_return = {}
     for key in object_dict:
-        if key[0] == '_':
+        if key[0] == '_' or key in copy_fields:
             pass
-        elif key is "study" or key is "datasource":
-            to_return.update({key + "__name": ref_fields[key].name})
+        elif key in ref_fields:
+            to_return.update({key + "__name": names[key]})
         else:
             to_return.update({key: object_dict[key]})
     return to_return
 
 
+def export_dicts(query, testing=False, ref_names=None, raw=True):
+    """
+    Yields the dictionary build_dict() gives for each document of a query set or list.
+    Query sets of features are read raw (see export_sons()) unless raw is False
+    """
+    db_alias = TEST_DB_ALIAS if testing else 'default'
+    if ref_names is None:
+        ref_names = RefNames(db_alias)
+    ref_names.prefetch(query)
+    if raw and is_feature_query(query):
+        for son in export_sons(query, db_alias=db_alias):
+            yield export_dict(son, ref_names.names_of(son))
+        return
+    if isinstance(query, QuerySet):
+        query = query.no_cache()
+    for document in query:
+        yield build_dict(document, testing, ref_names)
+
+
 def query_to_csv_rows_list(query, testing=False):
     """
     Builds a list of string representations of rows of a csv file that represents
@@ -69,53 +110,124 @@ def query_to_csv_rows_list(query, testing=False):
                     reference values from)
     :return: List of string rows of csv file representing query
     """
-    header_row, sorted_keys = write_header_row(query)
-    rows = [header_row]
-    rows.extend(rows_from_query(query, sorted_keys, testing=testing))
-    return rows
+    return list(query_to_csv_rows(query, testing))
+
+
+def query_to_csv_rows(query, testing=False, raw=True):
+    """
+    Yields the string representations of the rows of a csv file that represents the
+    given query set, the header row first. The documents are read from the cursor as
+    the rows are taken, without being cached, so a response can stream any number of
+    rows in constant memory
+    :param query: Query set or list of documents
+    :param testing: If method called in unit test (to determine which db to get
+                    reference values from)
+    :param raw: Reads query sets of features raw (see export_sons()) rather than as
+                documents
+    """
+    header_row, sorted_keys = write_header_row(query, TEST_DB_ALIAS if testing else 'default')
+    yield header_row
+    for row in iter_rows_from_query(query, sorted_keys, testing=testing, raw=raw):
+        yield row
+
+
+def is_empty(query):
+    # Whether a query set or list has no documents, without reading them all
+    if isinstance(query, BaseQuerySet):
+        return query.first() is None
+    return len(query) == 0
+
+
+def is_feature_query(query):
+    return isinstance(query, BaseQuerySet) and issubclass(query._document, Feature)
 
 
 def rows_from_query(query, sorted_keys, testing=False):
-    rows = []
+    return list(iter_rows_from_query(query, sorted_keys, testing))
+
+
+def iter_rows_from_query(query, sorted_keys, testing=False, raw=False):
+    db_alias = TEST_DB_ALIAS if testing else 'default'
+    # names of the references of all the rows, looked up in bulk before the first row
+    ref_names = RefNames(db_alias)
+    ref_names.prefetch(query)
+    if raw and is_feature_query(query):
+        for son in export_sons(query, sorted_keys, db_alias):
+            yield csv_row(son, sorted_keys, ref_names.names_of(son))
+        return
+    if isinstance(query, QuerySet):
+        query = query.no_cache()
     # csv row for each document
     for gen in query:
-        if isinstance(gen, Feature):
-            ref_fields = get_ref_fields(gen, testing)
-
-        gen_dic = gen.to_mongo().to_dict()
-        row = []
-
-        for key in sorted_keys:
-            if key[0] != '_':
-                if key not in gen_dic.keys():
-                    row.append("")
-                elif key is "study" or key is "datasource":
-                    row.append(ref_fields[key].name)
-                elif key is 'obs' or isinstance(gen_dic[key], dict):
-                    row.append('"' + print_ordered_dict(gen_dic[key]) + '"')
-                else:
-                    row.append(str(gen_dic[key]).strip())
-
-        row_string = ','.join(row)
-        rows.append(row_string)
-
-    return rows
-
-
-def get_ref_fields(gen, testing):
-    ref_fields = {"study": gen.study, "datasource": gen.datasource}
-    if testing:
-        # Reference fields would only hold database references instead of the actual
-        # document, so need to query the test database for the documents
-        study_son = ref_fields['study'].as_doc()
-        ds_son = ref_fields['datasource'].as_doc()
-        study_id = study_son.get('$id')
-        with switch_db(Experiment, TEST_DB_ALIAS) as Exper:
-            ref_fields['study'] = Exper.objects.get(id=study_id)
-        ds_id = ds_son.get('$id')
-        with switch_db(DataSource, TEST_DB_ALIAS) as Dat:
-            ref_fields['datasource'] = Dat.objects.get(id=ds_id)
-    return ref_fields
+        names = ref_names.of(gen) if isinstance(gen, Feature) else None
+        yield csv_row(document_dict(gen, testing), sorted_keys, names)
+
+
+def csv_row(gen_dic, sorted_keys, names=None):
+    # csv row of a document's son, with the names of its references from names
+    row = []
+    for key in sorted_keys:
+        if key[0] != '_':
+            if key not in gen_dic:
+                row.append("")
+            elif key in ref_fields:
+                row.append(names[key])
+            elif key == 'obs' or isinstance(gen_dic[key], dict):
+                row.append('"' + print_ordered_dict(gen_dic[key]) + '"')
+            else:
+                row.append(str(gen_dic[key]).strip())
+    return ','.join(row)
+
+
+def export_sons(query_set, fields=None, db_alias='default'):
+    """
+    Yields the son of each document of a query set as document_dict() gives it, read
+    with a raw pymongo cursor, raw_batch_size documents at a time, instead of being
+    built into a document and turned back into a son: lean fields are filled in,
+    fields with defaults set, undeclared and null fields left out and encoded obs
+    decoded
+
+    :param query_set: Query set of the documents
+    :param fields: Names of the fields to read, as in the header of write_header_row(),
+                   or None for every field
+    :param db_alias: Alias of database holding the key dictionaries of encoded obs
+    """
+    document = query_set._document
+    declared = dict((field.db_field, field) for field in document._fields.values())
+    projection = None
+    if fields is not None:
+        # with the fields the sons are filled in and named from
+        keys = set(fields) | set(ref_fields) | copy_fields | set(['obs_values', 'study'])
+        projection = dict((key, 1) for key in keys if key in declared)
+        projection['_id'] = 1
+    defaults = [
+        (key, field.default) for key, field in declared.items()
+        if field.default is not None and (projection is None or key in projection)
+    ]
+    collection = query_set._collection
+    cursor = collection.find(query_set._query, projection)
+    if query_set._ordering:
+        cursor = cursor.sort(query_set._ordering)
+    if query_set._skip:
+        cursor = cursor.skip(query_set._skip)
+    if query_set._limit:
+        cursor = cursor.limit(query_set._limit)
+    for son in cursor.batch_size(raw_batch_size):
+        son = fill_lean(document, son, collection.database)
+        son = dict(
+            (key, value) for key, value in son.items()
+            if value is not None and (key in declared or key == '_cls')
+        )
+        for key, default in defaults:
+            if key not in son:
+                son[key] = default() if callable(default) else default
+        yield decode_obs(son, db_alias)
+
+
+def document_dict(document, testing=False):
+    # The document's fields as a dictionary, with encoded obs decoded
+    db_alias = TEST_DB_ALIAS if testing else 'default'
+    return decode_obs(document.to_mongo().to_dict(), db_alias)
 
 
 def print_ordered_dict(dictionary):
@@ -127,31 +239,37 @@ def print_ordered_dict(dictionary):
     return "{" + ','.join(strings) + "}"
 
 
-def write_header_row(query_set):
+def write_header_row(query_set, db_alias='default'):
     # builds top row of csv file with names of all the fields
-    header = []
-    # Gets name of all the fields of the first document in the queryset
-    head_dict = query_set[0].to_mongo().to_dict()
-    dict_keys = head_dict.keys()
-    keys = []
-    for key in dict_keys:
-        keys.append(key)
-    # Checks the other documents in the queryset for fields the first document
-    # did not have
-    for doc in query_set[1:]:
-        doc_keys = doc.to_mongo().to_dict().keys()
-        for key in doc_keys:
-            if key not in keys:
-                keys.append(key)
+    if isinstance(query_set, BaseQuerySet):
+        # worked out by the database, or read from the cache (see mongcore.headers)
+        keys = discover_header(query_set, db_alias)['fields']
+    else:
+        # lists (eg. of genotypes read from matrices) are walked
+        keys = set()
+        for doc in query_set:
+            keys.update(field_keys(doc))
+    return header_row_of(keys)
 
+
+def header_row_of(keys):
     # Builds a string of the sorted keys without metadata keys and '__name' appended
-    # to keys for reference fields
+    # to keys for reference fields. Returns it with the sorted keys
+    header = []
     sorted_keys = sorted(keys)
     for key in sorted_keys:
         if key[0] != '_':
-            if key is "study" or key is "datasource":
+            if key in ref_fields:
                 header.append(key + "__name")
             else:
                 header.append(key)
     header_row = ','.join(header)
     return header_row, sorted_keys
+
+
+def field_keys(document):
+    # Names of the fields the document stores, with encoded obs named obs
+    return [
+        'obs' if key == 'obs_values' else key for key in document.to_mongo().keys()
+        if key not in copy_fields
+    ]
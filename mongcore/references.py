@@ -0,0 +1,94 @@
+"""
+Bulk lookup of the names of the studies and data sources referenced by the features of
+an export. Features carry copies of the names (see mongcore.models.name_copies), so only
+the references of features saved without them are looked up: the distinct ids of a
+query set are read with one distinct() per field and their names with one query per
+referenced collection, instead of dereferencing the references of every row
+"""
+
+from bson import DBRef
+from mongoengine import Document
+from mongoengine.context_managers import switch_db
+from mongoengine.queryset.base import BaseQuerySet
+from .models import Experiment, DataSource, name_copies
+
+# Document class referenced by each field whose name is exported
+ref_documents = {'study': Experiment, 'datasource': DataSource}
+
+
+def ref_id(value):
+    # Id of a reference, whether it was read as a document, a DBRef or an id
+    if isinstance(value, Document):
+        return value.pk
+    if isinstance(value, DBRef):
+        return value.id
+    return value
+
+
+class RefNames:
+    """
+    Names of referenced documents, keyed by field and id. Ids not prefetched are looked
+    up the first time they are asked for, so each is read at most once
+    """
+
+    def __init__(self, db_alias='default'):
+        """
+        :param db_alias: Alias of database holding the referenced documents
+        """
+        self.db_alias = db_alias
+        self.names = dict((field, {}) for field in ref_documents)
+
+    def add(self, field, document):
+        # Adds the name of a document already read, eg. the experiment of an export
+        self.names[field][document.pk] = document.name
+
+    def prefetch(self, query):
+        """
+        Looks up the names of every reference of a query set, or list of features,
+        whose features don't carry a copy of the name, with one query per field.
+        Iterators of features are left to be looked up as they are read
+        """
+        for field, copy in name_copies.items():
+            if isinstance(query, BaseQuerySet):
+                missing = {'$and': [query._query, {copy: None}, {field: {'$ne': None}}]}
+                ids = query._collection.find(missing).distinct(field)
+            elif not isinstance(query, (list, tuple)):
+                return
+            else:
+                ids = set(
+                    ref_id(feature._data.get(field)) for feature in query
+                    if feature._data.get(copy) is None and feature._data.get(field) is not None
+                )
+            self.lookup(field, ids)
+
+    def lookup(self, field, ids):
+        ids = [ref_id(i) for i in ids if ref_id(i) not in self.names[field]]
+        if not ids:
+            return
+        known = self.names[field]
+        with switch_db(ref_documents[field], self.db_alias) as Ref:
+            for son in Ref._get_collection().find({'_id': {'$in': ids}}, {'name': 1}):
+                known[son['_id']] = son.get('name')
+        for i in ids:
+            known.setdefault(i, None)
+
+    def of(self, feature):
+        """
+        Names of the feature's study and data source, keyed by field, from the copies
+        the feature carries or else the names looked up
+        """
+        return self.names_of(feature._data)
+
+    def names_of(self, data):
+        # As of(), from a feature's field values or its son as read by pymongo
+        names = {}
+        for field, copy in name_copies.items():
+            names[field] = data.get(copy)
+            value = data.get(field)
+            if names[field] is None and value is not None:
+                if isinstance(value, Document):
+                    names[field] = value.name
+                else:
+                    self.lookup(field, [value])
+                    names[field] = self.names[field][ref_id(value)]
+        return names
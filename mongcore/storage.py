@@ -0,0 +1,103 @@
+"""
+Creates the collections of document classes with the WiredTiger storage options given
+for them in settings.COLLECTION_STORAGE: the block compressor of the collection's data
+and whether its indexes use prefix compression. The options only take effect when a
+collection is created, so ensure_collections() has to run before mongoengine first
+writes to the collection, or the collection has to be dropped and loaded again
+"""
+
+import re
+from django.conf import settings
+from mongoengine.base.common import get_document
+from mongoengine.connection import get_db
+from .logger import Logger
+
+block_compressors = ('none', 'snappy', 'zlib', 'zstd')
+
+
+def storage_options(name):
+    # Storage options of the named document class in the settings, if any
+    return dict(getattr(settings, 'COLLECTION_STORAGE', {}).get(name, {}))
+
+
+def create_options(options):
+    """
+    Turns storage options into the options of MongoDB's create command
+
+    :param options: Dictionary with a block_compressor and/or prefix_compression
+    :return: Keyword arguments for pymongo's create_collection()
+    """
+    kwargs = {}
+    compressor = options.get('block_compressor')
+    if compressor is not None:
+        if compressor not in block_compressors:
+            raise ValueError("Unknown block compressor: %s. Use one of %s" % (
+                compressor, ', '.join(block_compressors)
+            ))
+        kwargs['storageEngine'] = {
+            'wiredTiger': {'configString': 'block_compressor=' + compressor}
+        }
+    if 'prefix_compression' in options:
+        prefix = 'true' if options['prefix_compression'] else 'false'
+        kwargs['indexOptionDefaults'] = {
+            'storageEngine': {'wiredTiger': {'configString': 'prefix_compression=' + prefix}}
+        }
+    return kwargs
+
+
+def create_collection(document, db_alias='default', options=None):
+    """
+    Creates the collection of a document class with the given storage options
+
+    :param document: Document class whose collection to create
+    :param db_alias: Alias of database to create the collection in
+    :param options: Storage options, or None for those in the settings
+    :return: True if the collection was created, False if it already existed
+    """
+    if options is None:
+        options = storage_options(document.__name__)
+    return create_named_collection(get_db(db_alias), document._get_collection_name(), options)
+
+
+def create_named_collection(db, name, options):
+    """
+    Creates the named collection of a pymongo database with the given storage options
+
+    :return: True if the collection was created, False if it already existed
+    """
+    if name in db.collection_names():
+        return False
+    db.create_collection(name, **create_options(options))
+    return True
+
+
+def ensure_collections(db_alias='default'):
+    """
+    Creates the collections of the document classes in settings.COLLECTION_STORAGE that
+    don't exist yet. Existing collections keep the storage they were created with
+
+    :return: Names of the document classes whose collections were created
+    """
+    created = []
+    for name in sorted(getattr(settings, 'COLLECTION_STORAGE', {})):
+        if create_collection(get_document(name), db_alias):
+            Logger.Message("Created the %s collection with %s" % (name, storage_options(name)))
+            created.append(name)
+    return created
+
+
+def storage_stats(collection):
+    """
+    Sizes in bytes of a collection: size is of its uncompressed documents, storage_size
+    of the documents on disk and index_size of its indexes on disk. compressor is the
+    collection's WiredTiger block compressor, or None for other storage engines
+    """
+    stats = collection.database.command('collstats', collection.name)
+    creation = stats.get('wiredTiger', {}).get('creationString', '')
+    compressor = re.search(r'block_compressor=(\w*)', creation)
+    return {
+        'size': stats.get('size', 0),
+        'storage_size': stats.get('storageSize', 0),
+        'index_size': stats.get('totalIndexSize', 0),
+        'compressor': (compressor.group(1) or 'none') if compressor else None,
+    }
@@ -0,0 +1,156 @@
+"""
+Summary statistics of the data loaded for each data source, kept in DataSummary
+documents as the loaders write their batches: the number of documents and markers, the
+calls made for each sample, a histogram of the markers by their fraction of missing
+calls, and the size of the documents written. The experiment search table and the
+summary API read them instead of the features. experiment_summaries() adds up the
+summaries of the data sources of experiments
+"""
+
+from datetime import datetime
+from mongoengine.context_managers import switch_db
+from .models import DataSummary
+
+# Calls that count as missing
+missing_calls = frozenset(['', 'N', 'NN', '-', '--', '?', './.', 'NA', None])
+histogram_bins = 10
+
+
+class SummaryWriter:
+    """
+    Counts the calls of the rows of one data source as they are loaded, and adds the
+    counts to its DataSummary each time flush() is called
+    """
+
+    def __init__(self, header, info_columns, study, datasource, db_alias='default',
+                 ingest_run=None):
+        """
+        :param header: Column names of the rows that will be added
+        :param info_columns: Columns describing the marker rather than a sample
+        :param study: Experiment of the data source
+        :param datasource: Data source whose summary to update
+        :param db_alias: Alias of database to keep the summary in
+        :param ingest_run: Id of the ingest run to stamp a new summary with
+        """
+        self.db_alias = db_alias
+        self.header = header
+        self.positions = [i for i, h in enumerate(header) if h not in info_columns]
+        # keys of the called dict, which can't hold dots
+        self.samples = [header[i].replace(".", "-") for i in self.positions]
+        self.created = False
+        with switch_db(DataSummary, db_alias) as Summary:
+            self.doc = Summary.objects(datasource=datasource).first()
+            if self.doc is None:
+                self.doc = Summary(
+                    study=study, datasource=datasource, missing_histogram=[0] * histogram_bins,
+                    ingest_run=ingest_run,
+                )
+                self.doc.save()
+                self.created = True
+        self.reset()
+
+    def reset(self):
+        self.called = [0] * len(self.samples)
+        self.histogram = [0] * histogram_bins
+        self.markers = 0
+        self.documents = 0
+        self.bytes = 0
+
+    def add(self, row, documents=1):
+        """
+        Counts the calls of a positional row. Samples past the end of a short row count
+        as missing
+
+        :param documents: Number of documents the row was written as
+        """
+        n = len(self.samples)
+        missing = 0
+        called = self.called
+        for j, i in enumerate(self.positions):
+            if i < len(row) and row[i] not in missing_calls:
+                called[j] += 1
+            else:
+                missing += 1
+        if n:
+            self.histogram[min(histogram_bins - 1, missing * histogram_bins // n)] += 1
+        self.markers += 1
+        self.documents += documents
+
+    def add_documents(self, n, n_bytes=0):
+        # Counts documents written for rows added with documents=0, and their size
+        self.documents += n
+        self.bytes += n_bytes
+
+    def flush(self):
+        # Adds the counts since the last flush to the summary, with one update
+        if not (self.markers or self.documents or self.bytes):
+            return
+        inc = {
+            'n_documents': self.documents, 'n_markers': self.markers, 'n_bytes': self.bytes
+        }
+        for sample, called in zip(self.samples, self.called):
+            inc['called.' + sample] = called
+        for i, count in enumerate(self.histogram):
+            if count:
+                inc['missing_histogram.%d' % i] = count
+        with switch_db(DataSummary, self.db_alias) as Summary:
+            Summary._get_collection().update(
+                {'_id': self.doc.id}, {'$inc': inc, '$set': {'lastupdateddate': datetime.now()}}
+            )
+        self.reset()
+
+
+def combine(summaries):
+    """
+    Adds up data summaries. The call rate of a sample is the fraction of its calls
+    that aren't missing, over the markers of the data sources it is in
+
+    :param summaries: DataSummary documents
+    :return: Dictionary of the totals
+    """
+    histogram = [0] * histogram_bins
+    called = {}
+    sample_markers = {}
+    totals = {'datasources': 0, 'documents': 0, 'markers': 0, 'bytes': 0}
+    for summary in summaries:
+        totals['datasources'] += 1
+        totals['documents'] += summary.n_documents
+        totals['markers'] += summary.n_markers
+        totals['bytes'] += summary.n_bytes
+        for i, count in enumerate(summary.missing_histogram):
+            histogram[i] += count
+        for sample, n in summary.called.items():
+            called[sample] = called.get(sample, 0) + n
+            sample_markers[sample] = sample_markers.get(sample, 0) + summary.n_markers
+    totals['samples'] = len(called)
+    totals['call_rate'] = dict(
+        (sample, float(n) / sample_markers[sample] if sample_markers[sample] else 0.0)
+        for sample, n in called.items()
+    )
+    totals['missing_histogram'] = histogram
+    return totals
+
+
+def experiment_summaries(experiments, db_alias='default'):
+    """
+    Totals of the data summaries of each of the given experiments, read with a single
+    query of the summaries
+
+    :param experiments: Experiment documents or ids
+    :return: Dictionary of experiment id to totals (see combine()), for the experiments
+             that have any summaries
+    """
+    ids = [getattr(experiment, 'pk', experiment) for experiment in experiments]
+    by_study = {}
+    with switch_db(DataSummary, db_alias) as Summary:
+        for summary in Summary.objects(study__in=ids):
+            study = summary._data['study']
+            by_study.setdefault(getattr(study, 'id', study), []).append(summary)
+    return dict((study, combine(summaries)) for study, summaries in by_study.items())
+
+
+def datasource_summary(datasource, db_alias='default'):
+    # Totals of the summary of one data source, or None if it has none
+    with switch_db(DataSummary, db_alias) as Summary:
+        summary = Summary.objects(datasource=datasource).first()
+    return None if summary is None else combine([summary])
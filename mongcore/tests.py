@@ -1,5 +1,10 @@
+import csv
 import os
 import pathlib
+import shutil
+import sqlite3
+import tempfile
+import openpyxl
 import datetime
 
 from django.test import TestCase, Client
@@ -7,13 +12,29 @@ from mongoengine import register_connection
 from kaka.settings import TEST_DB_NAME, TEST_DB_ALIAS
 from mongoengine.context_managers import switch_db
 from .models import Experiment, DataSource, ExperimentForTable, DataSourceForTable
-from mongenotype.models import Genotype
+from .models import get_ontology, set_ontology_fields, ObsKeys, DataSummary, ExportHeader
+from .models import ref_name, clear_caches, class_spec, ontology_cache
+from mongenotype.models import Genotype, GenotypeMatrix, GenotypeMatrixChunk
 from bson import DBRef
 from . import test_db_setup
 from .query_set_helpers import fetch_or_save, query_to_csv_rows_list
 from .csv_to_doc_strategy import ExperimentCsvToDoc, AbstractCsvToDocStrategy
 from .csv_to_doc import CsvToDocConverter
 from .errors import CsvFindError
+from .connectors import CsvConnector, SqlConnector, ExcelConnector
+from .imports import BulkInserter
+from .obs_keys import ObsKeyEncoder, decode_obs
+from .indexes import build_indexes, deferred_indexes, get_collection, index_report
+from .lean import lean_son, fill_lean, study_cache
+from .name_copies import propagate_names
+from .storage import create_options, create_collection, storage_stats
+from .query_set_helpers import build_dict, query_to_csv_rows, export_dicts
+from .archive import archive_datasource, restore_datasource, archived_features
+from .archive import archive_name, inactive_datasources, archive_path, write_file
+from mongenotype.matrix import genotypes_for_study
+from .summaries import SummaryWriter, experiment_summaries
+from .headers import discover_header, invalidate_headers
+from .references import RefNames
 
 expected_experi_model = Experiment(
     name='What is up', pi='Badi James', createdby='Badi James',
@@ -73,6 +94,16 @@ class MasterTestCase(TestCase):
             TestDs.objects.all().delete()
         with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
             TestGen.objects.all().delete()
+        with switch_db(GenotypeMatrix, TEST_DB_ALIAS) as TestMatrix:
+            TestMatrix.objects.all().delete()
+        with switch_db(GenotypeMatrixChunk, TEST_DB_ALIAS) as TestChunk:
+            TestChunk.objects.all().delete()
+        with switch_db(ObsKeys, TEST_DB_ALIAS) as TestKeys:
+            TestKeys.objects.all().delete()
+        with switch_db(DataSummary, TEST_DB_ALIAS) as TestSummary:
+            TestSummary.objects.all().delete()
+        with switch_db(ExportHeader, TEST_DB_ALIAS) as TestHeader:
+            TestHeader.objects.all().delete()
 
     # ---------------------Helper methods------------------------
 
@@ -114,8 +145,13 @@ class MasterTestCase(TestCase):
         as time stamps that default to datetime.now()
         """
         for key in doc1._fields_ordered:
-            # ignores metadata fields and datetime fields that default to datetime.now()
-            if key != 'id' and key[0] != '_' and key != 'dtt' and key != 'lastupdateddate':
+            # ignores metadata fields, the id of the ingest run that created the document,
+            # the fingerprint of the file it was loaded from, copies of the names of the
+            # referenced documents (compared with the documents themselves) and datetime
+            # fields that default to datetime.now()
+            if key != 'id' and key[0] != '_' and key != 'dtt' and key != 'lastupdateddate' \
+                    and key not in ('ingest_run', 'fingerprint', 'size') \
+                    and key not in ('study_name', 'datasource_name'):
                 with self.subTest(key=key):
                     val = doc1[key]
                     if isinstance(doc1[key], dict):
@@ -272,6 +308,60 @@ class ModelsTestCase(MasterTestCase):
             dummy.save()
 
 
+class OntologyTestCase(MasterTestCase):
+    """
+    Tests for resolving the ontology fields of Feature documents
+    """
+
+    def setUp(self):
+        super(OntologyTestCase, self).setUp()
+        test_db_setup.set_up_test_db()
+
+    def test_ontology_built_once(self):
+        """
+        Tests that the Ontology term of a document class is only worked out once, and
+        that each call gets its own copy
+        """
+        ontology = get_ontology(Genotype)
+        self.assertEqual(ontology.tablename, 'core_genotype')
+        self.assertEqual(get_ontology(Genotype), ontology)
+        self.assertIsNot(get_ontology(Genotype), ontology)
+        ontology.description = 'Changed'
+        self.assertEqual(get_ontology(Genotype).description, '')
+
+    def test_ontology_fields_from_reference(self):
+        """
+        Tests that xreflsid and obkeywords get set from the name of a genotype's
+        data source when the data source reference has not been dereferenced
+        """
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            gen = TestGen.objects.get(name='S1_8658')
+            set_ontology_fields(gen)
+        self.assertEqual(gen.xreflsid, 'Genotype.S1_8658/What is up')
+        self.assertEqual(gen.obkeywords, 'Genotype S1_8658/What is up')
+
+    def test_caches_by_database(self):
+        """
+        Tests that the ontology and reference name caches are kept per database, and
+        that clear_caches() drops names that have changed since they were cached
+        """
+        clear_caches()
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            get_ontology(TestGen)
+        get_ontology(Genotype)
+        self.assertEqual(
+            set(ontology_cache), {('default', Genotype), (TEST_DB_ALIAS, Genotype)}
+        )
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            gen = TestGen.objects.get(name='S1_8658')
+            self.assertEqual(ref_name(gen, 'datasource'), 'What is up')
+            with switch_db(DataSource, TEST_DB_ALIAS) as TestDs:
+                TestDs.objects(name='What is up').update(set__name='Renamed')
+            self.assertEqual(ref_name(gen, 'datasource'), 'What is up')
+            clear_caches()
+            self.assertEqual(ref_name(gen, 'datasource'), 'Renamed')
+
+
 class QuerySetHelpersTestCase(MasterTestCase):
     """
     Tests for the module query_set_helpers
@@ -331,7 +421,655 @@ class QuerySetHelpersTestCase(MasterTestCase):
         actual_rows = query_to_csv_rows_list(query, testing=True)
         self.assertEqual(len(expected_rows), len(actual_rows))
         self.assertEqual(actual_rows[0], expected_rows[0])  # Checks header rows are equal
+        # the header worked out from the document class is the one of the documents read
+        self.assertEqual(query_to_csv_rows_list(list(query), testing=True)[0], expected_rows[0])
         # Checks csv representations of genotype docs are in actual_rows
         for row in expected_rows:
             with self.subTest(row=row):
                 self.assertIn(row, actual_rows)
+
+
+class ConnectorsTestCase(MasterTestCase):
+    """
+    Tests for the data connectors in the module connectors
+    """
+
+    gz_path = 'test_resources/script_data/Foo/a_test_source.hmp.txt.gz'
+    txt_path = 'test_resources/script_data/Foo/a_test_source.hmp.txt'
+
+    def test_csv_dict_rows(self):
+        """
+        Tests that iterating a CsvConnector gives a dictionary per row, for both gzipped
+        and plain text files
+        """
+        expected = [{'rs#': 'Test source', 'foo': '1', 'bar': '2', 'baz': '3'}]
+        self.assertEqual(CsvConnector(self.gz_path, delimiter='\t', gzipped=True).all(), expected)
+        self.assertEqual(CsvConnector(self.txt_path, delimiter='\t').all(), expected)
+
+    def test_csv_chunks(self):
+        """
+        Tests that CsvConnector.chunks() gives batches of positional rows or columns along
+        with a map of the header to the column positions
+        """
+        conn = CsvConnector(self.gz_path, delimiter='\t', gzipped=True)
+        self.assertEqual(conn.header_index, {'rs#': 0, 'foo': 1, 'bar': 2, 'baz': 3})
+        self.assertEqual(list(conn.chunks(10)), [[['Test source', '1', '2', '3']]])
+        conn = CsvConnector(self.txt_path, delimiter='\t')
+        self.assertEqual(
+            list(conn.chunks(10, columns=True)), [[['Test source'], ['1'], ['2'], ['3']]]
+        )
+
+    def test_csv_chunks_blank_lines(self):
+        """
+        Tests that a batch read as nothing but blank lines doesn't end the chunks while
+        rows follow, and that an empty file gives no chunks
+        """
+        path = tempfile.mkdtemp()
+        fn = os.path.join(path, 'blank.txt')
+        try:
+            with open(fn, 'w') as f:
+                f.write("a\tb\n1\t2\n\n\n\n3\t4\n")
+            conn = CsvConnector(fn, delimiter='\t')
+            self.assertEqual(list(conn.chunks(2)), [[['1', '2']], [['3', '4']]])
+            conn.close()
+            open(fn, 'w').close()
+            conn = CsvConnector(fn, delimiter='\t')
+            self.assertIsNone(conn.header)
+            self.assertEqual(list(conn.chunks(2, columns=True)), [])
+            conn.close()
+        finally:
+            shutil.rmtree(path)
+
+
+class ExcelConnectorTestCase(TestCase):
+    """
+    Tests that ExcelConnector streams the rows of .xlsx workbooks
+    """
+
+    def setUp(self):
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.title = 'markers'
+        sheet.append(['name', 'value'])
+        for i in range(5):
+            sheet.append(['m' + str(i), i])
+        workbook.create_sheet('samples').append(['sample'])
+        self.fn = os.path.join(tempfile.mkdtemp(), 'markers.xlsx')
+        workbook.save(self.fn)
+
+    def tearDown(self):
+        os.remove(self.fn)
+        os.rmdir(os.path.dirname(self.fn))
+
+    def test_sheet_names(self):
+        self.assertEqual(ExcelConnector.GetSheets(self.fn), ['markers', 'samples'])
+
+    def test_all_rows(self):
+        """
+        Tests that every row after the header is read, including the last one
+        """
+        conn = ExcelConnector(self.fn)
+        rows = conn.all()
+        conn.close()
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[-1], {'name': 'm4', 'value': 4})
+
+    def test_chunks(self):
+        conn = ExcelConnector(self.fn, 'markers')
+        self.assertEqual(conn.header_index, {'name': 0, 'value': 1})
+        self.assertEqual([len(batch) for batch in conn.chunks(2)], [2, 2, 1])
+        conn.close()
+
+
+class SqliteConnector(SqlConnector):
+    """
+    SqlConnector reading from an in memory sqlite database, so it can be tested without
+    a Postgres server
+    """
+    sqlite_db = sqlite3.connect(':memory:')
+    sqlite_db.execute("CREATE TABLE marker (id INTEGER, name TEXT)")
+    sqlite_db.executemany("INSERT INTO marker VALUES (?, ?)", [(i, 'm' + str(i)) for i in range(25)])
+
+    def get_connection(self):
+        return SqliteConnector.sqlite_db
+
+
+class SqlConnectorTestCase(TestCase):
+    """
+    Tests that SqlConnector reads query results a batch, or a page, at a time
+    """
+
+    qry = "SELECT id, name FROM marker ORDER BY id;"
+
+    def test_fetchmany_rows(self):
+        """
+        Tests that iterating gives a dictionary per row, however many rows are fetched at a time
+        """
+        conn = SqliteConnector(self.qry, batch_size=4)
+        self.assertEqual(conn.header, ['id', 'name'])
+        rows = conn.all()
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[7], {'id': 7, 'name': 'm7'})
+
+    def test_limit_offset_pages(self):
+        """
+        Tests that limit mode queries the rows a page at a time, starting at the offset
+        """
+        conn = SqliteConnector(self.qry, batch_size=3, limit_mode=True, limit=10, offset=5)
+        self.assertEqual([row['id'] for row in conn], list(range(5, 25)))
+
+    def test_chunks(self):
+        """
+        Tests that chunks() gives the remaining rows as positional batches
+        """
+        conn = SqliteConnector(self.qry, batch_size=4, limit_mode=True, limit=10)
+        next(conn)
+        batches = list(conn.chunks(10))
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 4])
+        self.assertEqual(batches[0][0], (1, 'm1'))
+        self.assertEqual(conn.header_index, {'id': 0, 'name': 1})
+
+    def test_cursor_closed(self):
+        """
+        Tests that the cursor is closed once the rows are read, and when reading them fails
+        """
+        conn = SqliteConnector(self.qry, batch_size=10)
+        conn.all()
+        self.assertIsNone(conn.cursor)
+        conn = SqliteConnector(self.qry, batch_size=10)
+        conn.fetch_batch = lambda: 1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            conn.all()
+        self.assertIsNone(conn.cursor)
+
+
+class ObsKeysTestCase(MasterTestCase):
+    """
+    Tests that obs encoded against a data source's key dictionary decode back to the same
+    obs, and that exports read encoded documents like plain ones
+    """
+
+    def setUp(self):
+        super(ObsKeysTestCase, self).setUp()
+        self.ds, created = fetch_or_save(DataSource, TEST_DB_ALIAS, name='Encoded')
+
+    def test_encode_decode(self):
+        encoder = ObsKeyEncoder(self.ds, TEST_DB_ALIAS)
+        self.assertEqual(encoder.encode_row(['a', 'b', 'c'], ['1', '2', '3']), ['1', '2', '3'])
+        self.assertEqual(encoder.encode({'c': '6', 'd': '7'}), [None, None, '6', '7'])
+        encoder.save()
+        with switch_db(ObsKeys, TEST_DB_ALIAS) as TestKeys:
+            self.assertEqual(TestKeys.objects.get(datasource=self.ds).keys, ['a', 'b', 'c', 'd'])
+        son = {'datasource': self.ds.id, 'obs_values': [None, None, '6', '7']}
+        self.assertEqual(
+            decode_obs(son, TEST_DB_ALIAS), {'datasource': self.ds.id, 'obs': {'c': '6', 'd': '7'}}
+        )
+
+    def test_export_encoded(self):
+        """
+        Tests that the csv row of an encoded genotype is the same as that of the plain one
+        """
+        study, created = fetch_or_save(Experiment, TEST_DB_ALIAS, name='Encoded')
+        obs = {'foo': '1', 'bar': '2'}
+        encoder = ObsKeyEncoder(self.ds, TEST_DB_ALIAS)
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            TestGen(name='gen', study=study, datasource=self.ds, obs=obs).save()
+            TestGen(
+                name='gen', study=study, datasource=self.ds, obs=None,
+                obs_values=encoder.encode(obs)
+            ).save()
+            encoder.save()
+            rows = list(csv.reader(query_to_csv_rows_list(TestGen.objects.all(), testing=True)))
+        self.assertIn('obs', rows[0])
+        self.assertNotIn('obs_values', rows[0])
+        # only the time stamps can differ
+        dtt = rows[0].index('dtt')
+        del rows[1][dtt], rows[2][dtt]
+        self.assertEqual(rows[1], rows[2])
+
+
+class IndexesTestCase(MasterTestCase):
+    """
+    Tests building, deferring and reporting on the declared indexes
+    """
+
+    def index_names(self, document):
+        return list(get_collection(document, TEST_DB_ALIAS).index_information())
+
+    def test_build_indexes(self):
+        build_indexes(Genotype, TEST_DB_ALIAS)
+        names = self.index_names(Genotype)
+        self.assertTrue(any(name.endswith('study_1_name_1') for name in names))
+        self.assertTrue(any(name.endswith('datasource_1') for name in names))
+
+    def test_deferred_indexes(self):
+        """
+        Tests that deferred indexes stay dropped while the collection is used, and are
+        built again afterwards
+        """
+        build_indexes(Genotype, TEST_DB_ALIAS)
+        with deferred_indexes([Genotype], TEST_DB_ALIAS):
+            with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+                TestGen(name='Deferred').save()
+            self.assertEqual(self.index_names(Genotype), ['_id_'])
+        self.assertTrue(any(name.endswith('study_1_name_1') for name in self.index_names(Genotype)))
+
+    def test_index_report(self):
+        """
+        Tests that the queries the genotype views and loaders make are all served by an index
+        """
+        build_indexes(Genotype, TEST_DB_ALIAS)
+        uses = index_report(TEST_DB_ALIAS)['Genotype']
+        self.assertNotIn(None, uses)
+        study_index = [name for name in uses if name.endswith('study_1_name_1')][0]
+        self.assertIn("genotype reports: genotypes of an experiment", uses[study_index])
+
+
+class LeanTestCase(MasterTestCase):
+    """
+    Tests that features stored lean read back with the values left out filled in
+    """
+
+    def setUp(self):
+        super(LeanTestCase, self).setUp()
+        self.study, created = fetch_or_save(
+            Experiment, TEST_DB_ALIAS, name='Lean', description='Lean study',
+            createddate=datetime.datetime(2016, 1, 7),
+        )
+
+    def make_genotype(self, **fields):
+        return Genotype(
+            name='S1_1', study=self.study, createddate=self.study.createddate,
+            description=self.study.description, obs={'S1': 'A'}, **fields
+        )
+
+    def test_lean_son(self):
+        son = lean_son(Genotype, self.make_genotype().to_mongo(), self.study)
+        for key in ('alias', 'statuscode', 'dtt', 'lastupdateddate', 'createddate', 'description'):
+            self.assertNotIn(key, son)
+        self.assertEqual(son['name'], 'S1_1')
+        self.assertEqual(son['obs'], {'S1': 'A'})
+
+    def test_lean_son_keeps_own_values(self):
+        """
+        Tests that values set on the feature itself, rather than its defaults or study's,
+        are kept
+        """
+        gen = self.make_genotype(alias='mine', statuscode=2)
+        gen.description = 'Not the study\'s'
+        son = lean_son(Genotype, gen.to_mongo(), self.study)
+        self.assertEqual(son['alias'], 'mine')
+        self.assertEqual(son['statuscode'], 2)
+        self.assertEqual(son['description'], 'Not the study\'s')
+
+    def test_read_lean(self):
+        """
+        Tests that a feature bulk inserted lean reads back through mongoengine, and through
+        fill_lean(), with the same values as one stored in full
+        """
+        gen = self.make_genotype()
+        inserter = BulkInserter(Genotype, db_alias=TEST_DB_ALIAS, lean=True)
+        inserter.add(gen)
+        inserter.flush()
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            son = TestGen._get_collection().find_one()
+            read = TestGen.objects.get()
+            filled = fill_lean(Genotype, son, TestGen._get_db())
+        self.document_compare(read, gen)
+        self.assertEqual(filled['description'], 'Lean study')
+        self.assertEqual(filled['dtt'], read.dtt)
+
+    def test_read_lean_after_switch(self):
+        """
+        Tests that a query set made inside a switch_db block and read after it fills in
+        the lean fields from its own database, and binds the features read to it
+        """
+        inserter = BulkInserter(Genotype, db_alias=TEST_DB_ALIAS, lean=True)
+        inserter.add(self.make_genotype())
+        inserter.flush()
+        study_cache.clear()
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            query = TestGen.objects(study=self.study)
+        for read in [query.first(), list(query.no_cache())[0]]:
+            self.assertEqual(read.description, 'Lean study')
+            self.assertEqual(read._get_db().name, TEST_DB_NAME)
+
+
+class NameCopiesTestCase(MasterTestCase):
+    """
+    Tests that features carry copies of the names of their study and data source, and
+    that renames are propagated to them
+    """
+
+    def setUp(self):
+        super(NameCopiesTestCase, self).setUp()
+        self.study, created = fetch_or_save(Experiment, TEST_DB_ALIAS, name='Copied')
+        self.ds, created = fetch_or_save(DataSource, TEST_DB_ALIAS, name='Copied source')
+        gen = Genotype(name='S1_1', study=self.study, datasource=self.ds, obs={'S1': 'A'})
+        gen.switch_db(TEST_DB_ALIAS)
+        gen.save()
+
+    def get_genotype(self):
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            return TestGen.objects.get()
+
+    def test_copies_saved(self):
+        gen = self.get_genotype()
+        self.assertEqual(gen.study_name, 'Copied')
+        self.assertEqual(gen.datasource_name, 'Copied source')
+        self.assertEqual(gen.GetName(), 'S1_1/Copied source')
+        exported = build_dict(gen, testing=True)
+        self.assertEqual(exported['study__name'], 'Copied')
+        self.assertNotIn('study_name', exported)
+
+    def test_propagate_names(self):
+        with switch_db(Experiment, TEST_DB_ALIAS) as TestEx:
+            TestEx.objects(id=self.study.id).update_one(set__name='Renamed')
+        self.assertEqual(propagate_names(Experiment, [self.study.id], TEST_DB_ALIAS), 1)
+        self.assertEqual(self.get_genotype().study_name, 'Renamed')
+        # copies already up to date are left alone
+        self.assertEqual(propagate_names(Experiment, db_alias=TEST_DB_ALIAS), 0)
+
+
+class StorageTestCase(MasterTestCase):
+    """
+    Tests creating collections with the storage options of the settings
+    """
+
+    def test_create_options(self):
+        options = create_options({'block_compressor': 'zlib', 'prefix_compression': False})
+        self.assertEqual(
+            options['storageEngine'], {'wiredTiger': {'configString': 'block_compressor=zlib'}}
+        )
+        self.assertEqual(
+            options['indexOptionDefaults']['storageEngine']['wiredTiger']['configString'],
+            'prefix_compression=false'
+        )
+        self.assertRaises(ValueError, create_options, {'block_compressor': 'lz4'})
+
+    def test_create_collection(self):
+        """
+        Tests that a collection is created with the given compressor, and that an existing
+        collection is left as it is
+        """
+        get_collection(GenotypeMatrixChunk, TEST_DB_ALIAS).drop()
+        options = {'block_compressor': 'zlib', 'prefix_compression': True}
+        self.assertTrue(create_collection(GenotypeMatrixChunk, TEST_DB_ALIAS, options))
+        self.assertFalse(create_collection(GenotypeMatrixChunk, TEST_DB_ALIAS, options))
+        stats = storage_stats(get_collection(GenotypeMatrixChunk, TEST_DB_ALIAS))
+        # None when the server doesn't use WiredTiger
+        self.assertIn(stats['compressor'], ('zlib', None))
+
+
+class ArchiveTestCase(MasterTestCase):
+    """
+    Tests moving the features of a data source to the archive and back
+    """
+
+    def setUp(self):
+        super(ArchiveTestCase, self).setUp()
+        self.study, created = fetch_or_save(Experiment, TEST_DB_ALIAS, name='Archived')
+        self.old, created = fetch_or_save(DataSource, TEST_DB_ALIAS, name='Old load')
+        self.new, created = fetch_or_save(DataSource, TEST_DB_ALIAS, name='New load')
+        for ds in (self.old, self.new):
+            gen = Genotype(name='S1_1', study=self.study, datasource=ds, obs={'S1': 'A'})
+            gen.switch_db(TEST_DB_ALIAS)
+            gen.save()
+        self.directory = tempfile.mkdtemp(prefix='archive_test_')
+
+    def tearDown(self):
+        get_collection(Genotype, TEST_DB_ALIAS).database.drop_collection(
+            archive_name(Genotype._get_collection_name())
+        )
+        shutil.rmtree(self.directory)
+        super(ArchiveTestCase, self).tearDown()
+
+    def hot_genotypes(self):
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            return list(TestGen.objects(study=self.study))
+
+    def check_round_trip(self, directory=None, fmt='bson'):
+        moved = archive_datasource(self.old, TEST_DB_ALIAS, directory, fmt)
+        self.assertEqual(moved, {Genotype._get_collection_name(): 1})
+        hot = self.hot_genotypes()
+        self.assertEqual([gen.datasource_name for gen in hot], ['New load'])
+        archived = list(archived_features(Genotype, {'study': self.study.pk}, TEST_DB_ALIAS))
+        self.assertEqual([gen.datasource_name for gen in archived], ['Old load'])
+        self.assertEqual(archived[0].obs, {'S1': 'A'})
+        self.assertEqual(len(genotypes_for_study(self.study, TEST_DB_ALIAS, include_archived=True)), 2)
+        self.assertRaises(ValueError, archive_datasource, self.old.pk, TEST_DB_ALIAS)
+
+        restore_datasource(self.old.pk, TEST_DB_ALIAS)
+        self.assertEqual(len(self.hot_genotypes()), 2)
+        self.assertEqual(list(archived_features(Genotype, db_alias=TEST_DB_ALIAS)), [])
+        with switch_db(DataSource, TEST_DB_ALIAS) as TestDs:
+            self.assertIsNone(TestDs.objects.get(pk=self.old.pk).archive)
+
+    def test_archive_collection(self):
+        self.check_round_trip()
+
+    def test_archive_files(self):
+        self.check_round_trip(self.directory, 'bson')
+        self.check_round_trip(self.directory, 'json')
+
+    def test_restore_both_formats(self):
+        """
+        Tests that the features of both archive files of a collection are counted
+        """
+        collection = Genotype._get_collection_name()
+        archive_datasource(self.old, TEST_DB_ALIAS, self.directory, 'bson')
+        son = {'_cls': class_spec(Genotype)['_cls'], 'name': 'S1_2', 'study': self.study.pk,
+               'datasource': self.old.pk, 'obs': {'S1': 'C'}}
+        write_file(archive_path(self.directory, self.old.pk, collection, 'json'), [son])
+        self.assertEqual(restore_datasource(self.old, TEST_DB_ALIAS), {collection: 2})
+        self.assertEqual(len(self.hot_genotypes()), 3)
+
+    def test_other_study_files_skipped(self):
+        """
+        Tests that searching the archive for a study doesn't read the files of data sources
+        without features of it
+        """
+        other, created = fetch_or_save(Experiment, TEST_DB_ALIAS, name='Not archived')
+        archive_datasource(self.old, TEST_DB_ALIAS, self.directory, 'bson')
+        path = archive_path(self.directory, self.old.pk, Genotype._get_collection_name(), 'bson')
+        with open(path, 'wb') as f:
+            f.write(b'not gzip')
+        self.assertEqual(list(archived_features(Genotype, {'study': other.pk}, TEST_DB_ALIAS)), [])
+        self.assertRaises(
+            IOError, list, archived_features(Genotype, {'study': self.study.pk}, TEST_DB_ALIAS)
+        )
+        os.remove(path)
+
+    def test_others_left(self):
+        """
+        Tests that archiving and restoring leave the features of other data sources, and
+        documents of other classes in the collection, where they are
+        """
+        collection = get_collection(Genotype, TEST_DB_ALIAS)
+        collection.insert({'_cls': 'Other', 'name': 'other', 'datasource': self.old.pk})
+        archive_datasource(self.old, TEST_DB_ALIAS)
+        self.assertEqual(collection.find({'_cls': 'Other'}).count(), 1)
+        self.assertEqual([gen.datasource_name for gen in self.hot_genotypes()], ['New load'])
+        restore_datasource(self.old, TEST_DB_ALIAS)
+        self.assertEqual(collection.find({'_cls': 'Other'}).count(), 1)
+        self.assertEqual(len(self.hot_genotypes()), 2)
+        collection.remove({'_cls': 'Other'})
+
+    def test_inactive_datasources(self):
+        """
+        Tests that data sources supplied before the date and not active are picked
+        """
+        with switch_db(DataSource, TEST_DB_ALIAS) as TestDs:
+            TestDs.objects(pk=self.new.pk).update_one(set__is_active=True)
+        before = datetime.datetime.now() + datetime.timedelta(days=1)
+        self.assertEqual(
+            [ds.pk for ds in inactive_datasources(before, TEST_DB_ALIAS)], [self.old.pk]
+        )
+        self.assertEqual(inactive_datasources(datetime.datetime(1970, 1, 2), TEST_DB_ALIAS), [])
+
+
+class SummaryTestCase(MasterTestCase):
+    """
+    Tests keeping the summary statistics of data sources as rows are loaded
+    """
+
+    def test_summary_writer(self):
+        """
+        Tests that the counts of every flush are added to the summary, and that the
+        summaries of an experiment's data sources are added up
+        """
+        study, created = fetch_or_save(Experiment, TEST_DB_ALIAS, name='Summarised')
+        header = ['rs#', 'S1', 'S2.a', 'S3', 'S4']
+        for name, rows in [('First', [['m0', 'A', 'C', 'N', 'G'], ['m1', '', '', '', '']]),
+                           ('Second', [['m2', 'A', 'C', 'T']])]:
+            ds, created = fetch_or_save(DataSource, TEST_DB_ALIAS, name=name)
+            writer = SummaryWriter(header, ['rs#'], study, ds, TEST_DB_ALIAS)
+            for row in rows:
+                writer.add(row)
+                writer.flush()
+            writer.add_documents(0, 100)
+            writer.flush()
+        totals = experiment_summaries([study], TEST_DB_ALIAS)[study.pk]
+        self.assertEqual(totals['datasources'], 2)
+        self.assertEqual((totals['documents'], totals['markers'], totals['bytes']), (3, 3, 200))
+        self.assertEqual(totals['samples'], 4)
+        self.assertEqual(totals['call_rate']['S2-a'], 2.0 / 3)
+        self.assertEqual(totals['call_rate']['S4'], 1.0 / 3)
+        # 1 of 4 calls missing from m0 and m2, all of them from m1
+        self.assertEqual(totals['missing_histogram'], [0, 0, 2, 0, 0, 0, 0, 0, 0, 1])
+
+
+class HeadersTestCase(MasterTestCase):
+    """
+    Tests working out export headers in the database and caching them
+    """
+
+    def setUp(self):
+        super(HeadersTestCase, self).setUp()
+        self.study, created = fetch_or_save(Experiment, TEST_DB_ALIAS, name='Headers')
+        self.ds, created = fetch_or_save(DataSource, TEST_DB_ALIAS, name='Headers')
+        encoder = ObsKeyEncoder(self.ds, TEST_DB_ALIAS)
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            TestGen(name='a', study=self.study, datasource=self.ds, obs={'S1': 'A'}).save()
+            TestGen(
+                name='b', study=self.study, datasource=self.ds, xreflsid='x', obs={'S2': 'C'}
+            ).save()
+            TestGen(
+                name='c', study=self.study, datasource=self.ds, obs=None,
+                obs_values=encoder.encode({'S3': 'G'})
+            ).save()
+        encoder.save()
+
+    def query(self):
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            return TestGen.objects(study=self.study.id)
+
+    def test_discover_header(self):
+        header = discover_header(self.query(), TEST_DB_ALIAS, obs=True)
+        self.assertEqual(header['obs'], ['S1', 'S2', 'S3'])
+        self.assertIn('xreflsid', header['fields'])
+        self.assertIn('obs', header['fields'])
+        self.assertNotIn('obs_values', header['fields'])
+        self.assertNotIn('createdby', header['fields'])
+        # matches the header of walking the documents
+        walked = query_to_csv_rows_list(list(self.query()), testing=True)[0]
+        self.assertEqual(query_to_csv_rows_list(self.query(), testing=True)[0], walked)
+
+    def test_sliced_header(self):
+        """
+        Tests that the header of a slice of the documents is worked out from the slice
+        alone, and isn't cached
+        """
+        header = discover_header(self.query().order_by('name')[1:2], TEST_DB_ALIAS, obs=True)
+        self.assertEqual(header['obs'], ['S2'])
+        self.assertIn('xreflsid', header['fields'])
+        header = discover_header(self.query().order_by('name')[:1], TEST_DB_ALIAS)
+        self.assertNotIn('xreflsid', header['fields'])
+        with switch_db(ExportHeader, TEST_DB_ALIAS) as TestHeader:
+            self.assertEqual(TestHeader.objects.count(), 0)
+
+    def test_raw_export(self):
+        """
+        Tests that reading the documents raw exports the same rows and dictionaries as
+        reading them as documents, encoded obs and all
+        """
+        documents = list(query_to_csv_rows(self.query(), testing=True, raw=False))
+        self.assertEqual(list(query_to_csv_rows(self.query(), testing=True)), documents)
+        self.assertEqual(
+            list(export_dicts(self.query(), testing=True)),
+            list(export_dicts(self.query(), testing=True, raw=False))
+        )
+
+    def test_cache(self):
+        """
+        Tests that the header is cached, used until invalidate_headers() removes it, and
+        then worked out again with the documents added
+        """
+        self.assertNotIn('kea_id', discover_header(self.query(), TEST_DB_ALIAS)['fields'])
+        with switch_db(ExportHeader, TEST_DB_ALIAS) as TestHeader:
+            self.assertEqual(TestHeader.objects.count(), 1)
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            TestGen(
+                name='d', study=self.study, datasource=self.ds, kea_id='k', obs={'S4': 'T'}
+            ).save()
+        self.assertEqual(
+            discover_header(self.query(), TEST_DB_ALIAS, obs=True)['obs'], ['S1', 'S2', 'S3', 'S4']
+        )
+        self.assertNotIn('obs', discover_header(self.query(), TEST_DB_ALIAS))
+        self.assertNotIn('kea_id', discover_header(self.query(), TEST_DB_ALIAS)['fields'])
+        collection = Genotype._get_collection_name()
+        self.assertEqual(invalidate_headers(collection, datasource=self.ds, db_alias=TEST_DB_ALIAS), 1)
+        self.assertIn('kea_id', discover_header(self.query(), TEST_DB_ALIAS)['fields'])
+
+
+class RefNamesTestCase(MasterTestCase):
+    """
+    Tests looking up the names of the references of an export in bulk
+    """
+
+    def setUp(self):
+        super(RefNamesTestCase, self).setUp()
+        self.study, created = fetch_or_save(Experiment, TEST_DB_ALIAS, name='Referenced')
+        self.ds, created = fetch_or_save(DataSource, TEST_DB_ALIAS, name='Referenced source')
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            # saved without the copies of the names, as by older loaders
+            TestGen._get_collection().insert([
+                dict(
+                    class_spec(TestGen), name=name, study=self.study.id,
+                    datasource=self.ds.id, obs={}
+                )
+                for name in ['a', 'b', 'c']
+            ])
+
+    def test_prefetch(self):
+        """
+        Tests that prefetch() looks up every name the rows need, so no more lookups are
+        made once the referenced documents are gone
+        """
+        ref_names = RefNames(TEST_DB_ALIAS)
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            query = TestGen.objects(study=self.study.id)
+            ref_names.prefetch(query)
+            self.assertEqual(ref_names.names['study'], {self.study.id: 'Referenced'})
+            with switch_db(Experiment, TEST_DB_ALIAS) as TestEx:
+                TestEx.objects.delete()
+            with switch_db(DataSource, TEST_DB_ALIAS) as TestDs:
+                TestDs.objects.delete()
+            genotypes = list(query)
+        self.assertEqual(len(genotypes), 3)
+        for gen in genotypes:
+            self.assertEqual(
+                ref_names.of(gen), {'study': 'Referenced', 'datasource': 'Referenced source'}
+            )
+        rows = query_to_csv_rows_list(genotypes, testing=True)
+        self.assertEqual(len(rows), 4)
+
+    def test_lookup_once(self):
+        # Names not prefetched are looked up the first time they are asked for
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            gen = TestGen.objects(name='a').first()
+        self.assertIsNotNone(gen)
+        ref_names = RefNames(TEST_DB_ALIAS)
+        ref_names.add('study', self.study)
+        self.assertEqual(ref_names.of(gen)['datasource'], 'Referenced source')
+        self.assertEqual(ref_names.names['datasource'], {self.ds.id: 'Referenced source'})
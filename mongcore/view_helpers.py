@@ -14,6 +14,15 @@ class Echo(object):
         return value
 
 
+def csv_writer():
+    # csv writer that returns each row it writes, with unix line endings off Windows
+    if 'Windows' in platform():
+        return csv.writer(Echo())
+    unix_dialect = csv.excel()
+    unix_dialect.lineterminator = '\n'
+    return csv.writer(Echo(), dialect=unix_dialect)
+
+
 def write_stream_response(rows, experi_name):
     """
     Builds a csv file from the given list of string representations of csv rows and
@@ -22,15 +31,20 @@ def write_stream_response(rows, experi_name):
     :param experi_name: Used to name the csv file
     :return: StreamingHttpResponse with csv file as attachment
     """
-    if 'Windows' in platform():
-        writer = csv.writer(Echo())
-    else:
-        unix_dialect = csv.excel()
-        unix_dialect.lineterminator = '\n'
-        writer = csv.writer(Echo(), dialect=unix_dialect)
-    reader = csv.reader(rows)
+    return write_rows_response(csv.reader(rows), experi_name)
+
+
+def write_rows_response(rows, experi_name):
+    """
+    Returns a StreamingHttpResponse with a csv file of the given rows as an attachment.
+    The rows are written as the response is streamed, so they can come from a generator
+    :param rows: iterable of rows, each a list of values
+    :param experi_name: Used to name the csv file
+    :return: StreamingHttpResponse with csv file as attachment
+    """
+    writer = csv_writer()
     # Write query results to csv response
-    response = StreamingHttpResponse((writer.writerow(r) for r in reader),
+    response = StreamingHttpResponse((writer.writerow(r) for r in rows),
                                      content_type="text/csv")
     content = 'attachment; filename="' + experi_name + '.csv"'
     response['Content-Disposition'] = content
@@ -0,0 +1,245 @@
+"""
+Writes genotype files to GenotypeMatrix storage, and reads the genotypes of an experiment
+whether they are stored as Genotype documents or as matrices
+"""
+
+from itertools import chain
+from bson import BSON
+from operator import itemgetter
+from mongoengine.context_managers import switch_db
+from mongcore.models import DataError, set_ontology_fields
+from mongcore.archive import archived_features
+from mongcore.headers import discover_header
+from mongcore.query_set_helpers import header_row_of, field_keys, iter_rows_from_query
+from .models import Genotype, GenotypeMatrix, GenotypeMatrixChunk
+from .regions import find_column, chrom_columns, pos_columns
+
+# Columns of HapMap files that describe the marker rather than a sample
+hapmap_info_columns = [
+    'rs#', 'alleles', 'chrom', 'pos', 'strand', 'assembly#', 'center', 'protLSID',
+    'assayLSID', 'panelLSID', 'QCcode'
+]
+
+
+class MatrixWriter:
+    """
+    Writes positional rows of a genotype file to a new GenotypeMatrix. The name column
+    and any HapMap info columns are kept as strings, every other column is a sample.
+    Markers are written about chunk_bytes at a time, counting both their calls and
+    their info values, each chunk as one GenotypeMatrixChunk
+    """
+
+    def __init__(self, header, name_column, db_alias='default', chunk_bytes=4 << 20,
+                 on_insert=None, **fields):
+        """
+        :param header: Column names of the rows that will be added
+        :param name_column: Column holding the marker names
+        :param db_alias: Alias of database to write to
+        :param chunk_bytes: Size in bytes of the chunks written, well under the 16MB
+                            BSON document limit
+        :param on_insert: Called with the number of chunks each time chunks are written
+        :param fields: Values for the GenotypeMatrix fields, eg. study and datasource
+        """
+        info = [i for i, h in enumerate(header) if h == name_column or h in hapmap_info_columns]
+        samples = [i for i in range(len(header)) if i not in info]
+        self.width = len(header)
+        self.db_alias = db_alias
+        self.on_insert = on_insert
+        self.pick_info = positions_getter(info)
+        self.pick_samples = positions_getter(samples)
+        self.chunk_bytes = chunk_bytes
+        # most markers a chunk can hold, by their calls alone
+        self.chunk_rows = max(1, chunk_bytes // max(1, len(samples)))
+        self.matrix = GenotypeMatrix(
+            name_column=name_column, info_columns=[header[i] for i in info],
+            samples=[header[i] for i in samples], **fields
+        )
+        self.matrix.switch_db(db_alias)
+        self.matrix.save()
+        self.code_of = dict((call, code) for code, call in enumerate(self.matrix.codes))
+        self.info = []
+        self.calls = bytearray()
+        # size in bytes of the markers waiting to be written, as row_bytes() counts it
+        self.pending = 0
+        # BSON size in bytes of the chunks written
+        self.bytes = 0
+
+    def new_code(self, call):
+        if len(self.matrix.codes) == 256:
+            raise DataError("More than 256 different genotype calls, can't store as a matrix")
+        self.code_of[call] = len(self.matrix.codes)
+        self.matrix.codes.append(call)
+        return self.code_of[call]
+
+    def encode(self, call):
+        code = self.code_of.get(call)
+        return self.new_code(call) if code is None else code
+
+    def add(self, row):
+        if len(row) < self.width:
+            row = list(row) + [''] * (self.width - len(row))
+        info = list(self.pick_info(row))
+        self.info.append(info)
+        calls = self.pick_samples(row)
+        try:
+            self.calls.extend(bytes(map(self.code_of.__getitem__, calls)))
+        except KeyError:
+            self.calls.extend(bytes(self.encode(call) for call in calls))
+        self.pending += row_bytes(info, len(calls))
+        if self.pending >= self.chunk_bytes or len(self.info) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.info:
+            return
+        start = self.matrix.n_markers
+        chunk = GenotypeMatrixChunk(
+            matrix=self.matrix, start=start, stop=start + len(self.info), info=self.info,
+            calls=bytes(self.calls), ingest_run=self.matrix.ingest_run,
+        )
+        chunk.switch_db(self.db_alias)
+        chunk.save()
+        self.bytes += len(BSON.encode(chunk.to_mongo()))
+        self.matrix.n_markers = chunk.stop
+        with switch_db(GenotypeMatrix, self.db_alias) as Matrix:
+            Matrix.objects(id=self.matrix.id).update_one(
+                set__n_markers=self.matrix.n_markers, set__codes=self.matrix.codes
+            )
+        self.info = []
+        self.calls = bytearray()
+        self.pending = 0
+        if self.on_insert:
+            self.on_insert(1)
+
+
+def row_bytes(info, n_calls):
+    # BSON size a marker adds to a chunk, near enough: its calls, and its info values as
+    # an array of strings, with the type, key and length of each element
+    return n_calls + 16 + sum(len(str(value).encode('utf-8')) + 16 for value in info)
+
+
+def positions_getter(positions):
+    # Like itemgetter, but always gives a tuple
+    if len(positions) == 1:
+        i = positions[0]
+        return lambda row: (row[i],)
+    if not positions:
+        return lambda row: ()
+    return itemgetter(*positions)
+
+
+def genotypes_for_study(study, db_alias='default', include_archived=False):
+    """
+    Gets the genotypes of the given experiment, whether they are stored as Genotype
+    documents or in genotype matrices. Matrices are read as unsaved Genotype documents
+
+    :param study: Experiment to get the genotypes of
+    :param db_alias: Alias of database to read from
+    :param include_archived: Also gets the genotypes of archived data sources (see
+                             mongcore.archive)
+    :return: The Genotype query set when there are no matrices for the experiment and
+             archived genotypes aren't asked for, otherwise a list of the Genotype
+             documents
+    """
+    parts = genotype_parts(study, db_alias, include_archived)
+    if len(parts) == 1:
+        return parts[0]
+    return list(chain(*parts))
+
+
+def iter_genotypes_for_study(study, db_alias='default', include_archived=False):
+    """
+    Yields the genotypes of the given experiment as genotypes_for_study() gets them,
+    reading them as they are yielded rather than into a list first
+    """
+    parts = genotype_parts(study, db_alias, include_archived)
+    parts[0] = parts[0].no_cache()
+    return chain(*parts)
+
+
+def genotype_parts(study, db_alias='default', include_archived=False):
+    # The Genotype query set of the experiment, then an iterator of each of its matrices
+    # and of its archived genotypes
+    with switch_db(Genotype, db_alias) as Gen:
+        query = Gen.objects.filter(study=study)
+    parts = [query] + [matrix.genotypes(db_alias) for matrix in study_matrices(study, db_alias)]
+    if include_archived:
+        parts.append(archived_features(Genotype, {'study': study.pk}, db_alias))
+    return parts
+
+
+def study_matrices(study, db_alias='default'):
+    with switch_db(GenotypeMatrix, db_alias) as Matrix:
+        return list(Matrix.objects(study=study))
+
+
+def matrix_fields(matrix):
+    """
+    Names of the fields of the genotypes read from a matrix, as field_keys() gives
+    them, worked out from the matrix's columns without reading its chunks
+    """
+    keys = [key.replace(".", "-") for key in matrix.info_columns]
+    gen = Genotype(
+        name=matrix.name_column, study=matrix._data['study'],
+        datasource=matrix._data['datasource'], createddate=matrix.createddate,
+        description=matrix.description, obs={'': ''},
+        chrom='' if find_column(keys, chrom_columns) is not None else None,
+        pos=0 if find_column(keys, pos_columns) is not None else None,
+    )
+    return field_keys(set_ontology_fields(gen, gen.name))
+
+
+def study_header_keys(study, db_alias='default', include_archived=False):
+    """
+    Field names of the csv export of an experiment's genotypes, worked out without
+    holding the genotypes: by the database for the Genotype documents (see
+    mongcore.headers), from the columns of each matrix, and in a pass over the archived
+    genotypes
+    """
+    with switch_db(Genotype, db_alias) as Gen:
+        keys = set(discover_header(Gen.objects(study=study), db_alias)['fields'])
+    for matrix in study_matrices(study, db_alias):
+        keys.update(matrix_fields(matrix))
+    if include_archived:
+        for gen in archived_features(Genotype, {'study': study.pk}, db_alias):
+            keys.update(field_keys(gen))
+    return keys
+
+
+def study_csv_rows(study, db_alias='default', include_archived=False, testing=False):
+    """
+    Yields the rows of the csv export of an experiment's genotypes, the header row
+    first, as query_to_csv_rows() does for a query set. The Genotype documents, each
+    matrix and the archived genotypes are read one after another as the rows are taken,
+    so a response can stream them in constant memory
+    """
+    header_row, sorted_keys = header_row_of(study_header_keys(study, db_alias, include_archived))
+    yield header_row
+    for part in genotype_parts(study, db_alias, include_archived):
+        for row in iter_rows_from_query(part, sorted_keys, testing, raw=True):
+            yield row
+
+
+def has_genotypes(study, db_alias='default', include_archived=False):
+    """
+    Whether the given experiment has any genotypes, found with existence queries that
+    read at most one document of each kind of storage
+    """
+    with switch_db(Genotype, db_alias) as Gen:
+        if Gen.objects(study=study).only('id').first() is not None:
+            return True
+    with switch_db(GenotypeMatrix, db_alias) as Matrix:
+        if Matrix.objects(study=study, n_markers__gt=0).only('id').first() is not None:
+            return True
+    if include_archived:
+        return next(archived_features(Genotype, {'study': study.pk}, db_alias), None) is not None
+    return False
+
+
+def delete_matrices(datasource, db_alias='default'):
+    # Removes the matrices loaded from the given data source, with their chunks
+    with switch_db(GenotypeMatrix, db_alias) as Matrix:
+        ids = [matrix.id for matrix in Matrix.objects(datasource=datasource).only('id')]
+        with switch_db(GenotypeMatrixChunk, db_alias) as Chunk:
+            Chunk.objects(matrix__in=ids).delete()
+        return Matrix.objects(id__in=ids).delete()
@@ -1,6 +1,8 @@
 import mongoengine
+from mongoengine.context_managers import switch_db
 from django.db import models
-from mongcore.models import Feature
+from mongcore.models import Feature, Experiment, DataSource, ref_name, set_ontology_fields
+from .regions import coordinates
 
 from django.core.urlresolvers import reverse
 
@@ -18,6 +20,13 @@ class Chromosome(Feature):
 class Genotype(Feature):
     ebrida_id = mongoengine.StringField(max_length=255)
     kea_id = mongoengine.StringField(max_length=255)
+    # genomic coordinates, filled in at ingest from the chrom and pos columns (see regions)
+    chrom = mongoengine.StringField(max_length=64)
+    pos = mongoengine.LongField()
+
+    meta = {
+        'indexes': [{'fields': ['chrom', 'pos'], 'sparse': True}]
+    }
 
     def __unicode__(self):
         return self.GetName()
@@ -26,14 +35,134 @@ class Genotype(Feature):
         name = self.name
         if self.kea_id is not None and self.ebrida_id is not None:
             name = name + '/' + self.kea_id + '/' + self.ebrida_id
-        name = name + '/' + self.datasource.GetName()
+        name = name + '/' + (self.datasource_name or ref_name(self, 'datasource'))
         return name
 
 
+class GenotypeMatrix(mongoengine.Document):
+    """
+    Genotype calls of one data source stored as a matrix instead of a Genotype document
+    per marker. The sample names are kept once, in column order, and the calls are
+    stored a chunk of markers at a time in GenotypeMatrixChunk documents, as one byte
+    per call. codes maps each byte back to the call it stands for, with 0 standing for
+    a missing call. Columns that describe the marker rather than a sample (its name,
+    alleles, position and so on) are kept as strings in info_columns order
+    """
+    study = mongoengine.ReferenceField(Experiment)
+    datasource = mongoengine.ReferenceField(DataSource)
+    name_column = mongoengine.StringField()
+    info_columns = mongoengine.ListField(mongoengine.StringField())
+    samples = mongoengine.ListField(mongoengine.StringField())
+    codes = mongoengine.ListField(mongoengine.StringField(), default=lambda: [''])
+    n_markers = mongoengine.IntField(default=0)
+    createddate = mongoengine.DateTimeField()
+    description = mongoengine.StringField(default="")
+    ingest_run = mongoengine.ObjectIdField()
+
+    meta = {
+        'indexes': ['study', 'datasource', {'fields': ['ingest_run'], 'sparse': True}]
+    }
+
+    def chunks(self, start=0, stop=None, fields=None, db_alias='default'):
+        # Chunks holding markers start to stop, in marker order
+        with switch_db(GenotypeMatrixChunk, db_alias) as Chunk:
+            query = Chunk.objects(matrix=self.id, stop__gt=start)
+        if stop is not None:
+            query = query.filter(start__lt=stop)
+        if fields:
+            query = query.only(*fields)
+        return query.order_by('start')
+
+    def decode(self, calls):
+        codes = self.codes
+        return [codes[code] for code in bytearray(calls)]
+
+    def row_slice(self, start=0, stop=None, db_alias='default'):
+        """
+        Reads markers start to stop without building a dict per marker
+
+        :return: List of (info values, calls) tuples, one per marker, with the calls in
+                 the order of samples
+        """
+        stop = self.n_markers if stop is None else min(stop, self.n_markers)
+        width = len(self.samples)
+        rows = []
+        for chunk in self.chunks(start, stop, db_alias=db_alias):
+            first = max(start, chunk.start)
+            last = min(stop, chunk.stop)
+            for i in range(first - chunk.start, last - chunk.start):
+                rows.append((chunk.info[i], self.decode(chunk.calls[i * width:(i + 1) * width])))
+        return rows
+
+    def column_slice(self, samples, start=0, stop=None, db_alias='default'):
+        """
+        Reads the calls of the given samples for markers start to stop, reading only the
+        bytes of those samples out of each chunk
+
+        :return: Dictionary of sample name to list of calls, in marker order
+        """
+        stop = self.n_markers if stop is None else min(stop, self.n_markers)
+        width = len(self.samples)
+        positions = dict((sample, self.samples.index(sample)) for sample in samples)
+        columns = dict((sample, []) for sample in samples)
+        for chunk in self.chunks(start, stop, ['start', 'stop', 'calls'], db_alias):
+            first = (max(start, chunk.start) - chunk.start) * width
+            last = (min(stop, chunk.stop) - chunk.start) * width
+            for sample, j in positions.items():
+                columns[sample].extend(self.decode(chunk.calls[first + j:last:width]))
+        return columns
+
+    def genotypes(self, db_alias='default'):
+        """
+        Yields a Genotype document, not saved to the db, for every marker in the matrix,
+        so code that reads Genotype documents can read matrices in the same way
+        """
+        keys = [key.replace(".", "-") for key in self.info_columns + self.samples]
+        name_i = self.info_columns.index(self.name_column)
+        width = len(self.samples)
+        with switch_db(GenotypeMatrix, db_alias):
+            study_name = ref_name(self, 'study')
+            datasource_name = ref_name(self, 'datasource')
+        for chunk in self.chunks(db_alias=db_alias):
+            for i, info in enumerate(chunk.info):
+                calls = self.decode(chunk.calls[i * width:(i + 1) * width])
+                obs = dict(zip(keys, info + calls))
+                chrom, pos = coordinates(obs)
+                yield set_ontology_fields(Genotype(
+                    name=info[name_i], study=self._data['study'],
+                    datasource=self._data['datasource'], createddate=self.createddate,
+                    description=self.description, obs=obs, chrom=chrom, pos=pos,
+                    study_name=study_name, datasource_name=datasource_name,
+                ))
+
+
+class GenotypeMatrixChunk(mongoengine.Document):
+    """
+    The calls of markers start to stop of a GenotypeMatrix, as one byte per call with
+    the calls of a marker next to each other, and the marker's info column values
+    """
+    matrix = mongoengine.ReferenceField(GenotypeMatrix)
+    start = mongoengine.IntField()
+    stop = mongoengine.IntField()
+    info = mongoengine.ListField(mongoengine.ListField(mongoengine.StringField()))
+    calls = mongoengine.BinaryField()
+    ingest_run = mongoengine.ObjectIdField()
+
+    meta = {
+        'indexes': [('matrix', 'start'), {'fields': ['ingest_run'], 'sparse': True}]
+    }
+
+
 class Marker(Feature):
     ebrida_id = mongoengine.StringField(max_length=255)
     kea_id = mongoengine.StringField(max_length=255)
     sex = mongoengine.StringField(max_length=5)
+    chrom = mongoengine.StringField(max_length=64)
+    pos = mongoengine.LongField()
+
+    meta = {
+        'indexes': [{'fields': ['chrom', 'pos'], 'sparse': True}]
+    }
 
     def __unicode__(self):
         return self.GetName()
@@ -0,0 +1,143 @@
+"""
+Genomic coordinates of genotypes and markers. The chromosome and position columns of a
+genotype file are stored as the typed chrom and pos fields of each document as well as in
+its obs, so the documents on a region of a chromosome can be found with the (chrom, pos)
+index, in position order, instead of by reading the obs of every document
+"""
+
+from mongoengine.context_managers import switch_db
+from mongcore.errors import QueryBadRegionError
+from mongcore.models import ref_name
+from mongcore.obs_keys import decode_obs
+from mongcore.query_set_helpers import print_ordered_dict
+
+# Column names, compared lower case, that hold the chromosome and the position
+chrom_columns = ('chrom', 'chr', 'chromosome')
+pos_columns = ('pos', 'position', 'bp')
+
+
+def parse_position(value):
+    # Position as an int, or None when the value isn't one
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_chrom(value):
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+
+def find_column(keys, names):
+    for i, key in enumerate(keys):
+        if key is not None and key.lower() in names:
+            return i
+    return None
+
+
+def coordinate_getter(keys):
+    """
+    Returns a function that reads the chromosome and position out of a positional row
+    with the given column keys
+
+    :param keys: Column keys of the rows, in column order
+    :return: Function of a row that returns a (chrom, pos) tuple, with None for a
+             coordinate the row has no column or no valid value for
+    """
+    chrom_i = find_column(keys, chrom_columns)
+    pos_i = find_column(keys, pos_columns)
+
+    def get(row):
+        chrom = parse_chrom(row[chrom_i]) if chrom_i is not None and chrom_i < len(row) else None
+        pos = parse_position(row[pos_i]) if pos_i is not None and pos_i < len(row) else None
+        return chrom, pos
+    return get
+
+
+def coordinates(obs):
+    # (chrom, pos) of an obs dictionary
+    keys = list(obs)
+    return coordinate_getter(keys)([obs[key] for key in keys])
+
+
+def set_coordinates(feature, obs):
+    # Fills in the chrom and pos fields of a genotype or marker from its obs
+    feature.chrom, feature.pos = coordinates(obs)
+    return feature
+
+
+def parse_region(chrom, start=None, stop=None):
+    """
+    Checks the values of a region query, as given in GET data
+
+    :param chrom: Chromosome name
+    :param start: First position of the region, or None to start at the first marker
+    :param stop: Last position of the region, or None to end at the last marker
+    :return: (chrom, start, stop) with the positions as ints
+    """
+    region = (chrom, start, stop)
+    chrom = parse_chrom(chrom)
+    if chrom is None:
+        raise QueryBadRegionError(region, "No chromosome given")
+    positions = []
+    for value in (start, stop):
+        if value in (None, ''):
+            positions.append(None)
+            continue
+        position = parse_position(value)
+        if position is None or position < 0:
+            raise QueryBadRegionError(region, "Positions must be whole numbers")
+        positions.append(position)
+    start, stop = positions
+    if start is not None and stop is not None and start > stop:
+        raise QueryBadRegionError(region, "The start position comes after the stop position")
+    return chrom, start, stop
+
+
+def region_query(Document, chrom, start=None, stop=None, study=None, db_alias='default'):
+    """
+    Queries the documents of the given class on a region of a chromosome, in position
+    order. Served by the (chrom, pos) index
+
+    :param Document: Genotype or Marker
+    :param chrom: Chromosome name
+    :param start: First position of the region, inclusive, or None for no lower bound
+    :param stop: Last position of the region, inclusive, or None for no upper bound
+    :param study: Experiment to limit the query to, or None for every experiment
+    :param db_alias: Alias of database to query
+    :return: Query set of the documents on the region
+    """
+    with switch_db(Document, db_alias) as Doc:
+        query = Doc.objects(chrom=chrom)
+    if start is not None:
+        query = query.filter(pos__gte=start)
+    if stop is not None:
+        query = query.filter(pos__lte=stop)
+    if study is not None:
+        query = query.filter(study=study)
+    return query.order_by('pos')
+
+
+# Columns of the csv rows of region_rows()
+region_columns = ['name', 'chrom', 'pos', 'study__name', 'datasource__name', 'obs']
+
+
+def region_rows(query, db_alias='default'):
+    """
+    Yields the header then a csv row per document of a region query, as the documents
+    are read, so the rows can be streamed in position order without holding the query
+    set in memory
+
+    :param query: Query set from region_query()
+    :param db_alias: Alias of database holding the obs key dictionaries
+    """
+    yield region_columns
+    for doc in query.no_cache():
+        son = decode_obs(doc.to_mongo().to_dict(), db_alias)
+        yield [
+            doc.name, doc.chrom, doc.pos, doc.study_name or ref_name(doc, 'study'),
+            doc.datasource_name or ref_name(doc, 'datasource'),
+            print_ordered_dict(son.get('obs', {})),
+        ]
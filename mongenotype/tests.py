@@ -1,3 +1,166 @@
-from django.test import TestCase
+from bson import BSON
+from kaka.settings import TEST_DB_ALIAS
+from mongoengine.context_managers import switch_db
+from mongcore.models import Experiment, DataSource
+from mongcore.query_set_helpers import fetch_or_save
+from mongcore.tests import MasterTestCase
+from .matrix import MatrixWriter, genotypes_for_study, iter_genotypes_for_study, has_genotypes, \
+    delete_matrices, study_csv_rows
+from mongcore.query_set_helpers import query_to_csv_rows_list
+from .models import Genotype, GenotypeMatrix, GenotypeMatrixChunk
+from .regions import coordinate_getter, parse_region, region_query, region_rows
+from mongcore.errors import QueryBadRegionError
 
-# Create your tests here.
+header = ['rs#', 'alleles', 'S1.a', 'S2', 'S3']
+rows = [
+    ['m0', 'A/C', 'A', 'C', 'M'],
+    ['m1', 'G/T', 'G', 'T', 'N'],
+    ['m2', 'A/G', 'R', 'A', 'G'],
+    ['m3', 'C/T', 'C'],
+    ['m4', 'A/T', 'A', 'A', 'T'],
+]
+
+
+class GenotypeMatrixTestCase(MasterTestCase):
+    """
+    Tests storing genotype calls as a GenotypeMatrix and reading them back
+    """
+
+    def setUp(self):
+        super(GenotypeMatrixTestCase, self).setUp()
+        self.study, created = fetch_or_save(Experiment, TEST_DB_ALIAS, name='Matrix')
+        self.ds, created = fetch_or_save(DataSource, TEST_DB_ALIAS, name='Matrix')
+        # 112 bytes per chunk, two markers of row_bytes() 56, so the rows are split over
+        # 3 chunks
+        writer = MatrixWriter(
+            header, 'rs#', db_alias=TEST_DB_ALIAS, chunk_bytes=112,
+            study=self.study, datasource=self.ds,
+        )
+        for row in rows:
+            writer.add(row)
+        writer.flush()
+        self.matrix = writer.matrix
+
+    def test_layout(self):
+        self.assertEqual(self.matrix.info_columns, ['rs#', 'alleles'])
+        self.assertEqual(self.matrix.samples, ['S1.a', 'S2', 'S3'])
+        self.assertEqual(self.matrix.n_markers, 5)
+        with switch_db(GenotypeMatrixChunk, TEST_DB_ALIAS) as TestChunk:
+            self.assertEqual(TestChunk.objects(matrix=self.matrix.id).count(), 3)
+
+    def test_chunk_size(self):
+        """
+        Tests that chunks are sized by the info values of their markers as well as their
+        calls, for a file with one sample and long info values
+        """
+        writer = MatrixWriter(
+            ['rs#', 'center', 'S1'], 'rs#', db_alias=TEST_DB_ALIAS, chunk_bytes=4096,
+            study=self.study, datasource=self.ds,
+        )
+        for i in range(10):
+            writer.add(['m%d' % i, 'x' * 1000, 'A'])
+        writer.flush()
+        with switch_db(GenotypeMatrixChunk, TEST_DB_ALIAS) as TestChunk:
+            chunks = list(TestChunk.objects(matrix=writer.matrix.id).order_by('start'))
+        self.assertEqual([chunk.stop - chunk.start for chunk in chunks], [4, 4, 2])
+        for chunk in chunks:
+            self.assertLess(len(BSON.encode(chunk.to_mongo())), 2 * 4096)
+
+    def test_row_slice(self):
+        """
+        Tests that a slice of markers spanning several chunks reads back as stored, with
+        missing calls as empty strings
+        """
+        self.assertEqual(self.matrix.row_slice(1, 4, db_alias=TEST_DB_ALIAS), [
+            (['m1', 'G/T'], ['G', 'T', 'N']),
+            (['m2', 'A/G'], ['R', 'A', 'G']),
+            (['m3', 'C/T'], ['C', '', '']),
+        ])
+
+    def test_column_slice(self):
+        columns = self.matrix.column_slice(['S2', 'S3'], 2, db_alias=TEST_DB_ALIAS)
+        self.assertEqual(columns, {'S2': ['A', '', 'A'], 'S3': ['G', '', 'T']})
+
+    def test_genotypes_for_study(self):
+        """
+        Tests that the genotypes of an experiment stored as a matrix read as Genotype
+        documents, with the same obs the loader would have given them
+        """
+        genotypes = genotypes_for_study(self.study, TEST_DB_ALIAS)
+        self.assertEqual([gen.name for gen in genotypes], ['m0', 'm1', 'm2', 'm3', 'm4'])
+        self.assertEqual(
+            genotypes[0].obs, {'rs#': 'm0', 'alleles': 'A/C', 'S1-a': 'A', 'S2': 'C', 'S3': 'M'}
+        )
+
+    def test_iter_genotypes_for_study(self):
+        genotypes = iter_genotypes_for_study(self.study, TEST_DB_ALIAS)
+        self.assertEqual([gen.name for gen in genotypes], ['m0', 'm1', 'm2', 'm3', 'm4'])
+
+    def test_has_genotypes(self):
+        other, created = fetch_or_save(Experiment, TEST_DB_ALIAS, name='No genotypes')
+        self.assertTrue(has_genotypes(self.study, TEST_DB_ALIAS))
+        self.assertFalse(has_genotypes(other, TEST_DB_ALIAS))
+
+    def test_study_csv_rows(self):
+        """
+        Tests that streaming the csv rows of an experiment a part at a time, with the
+        header worked out from the matrix's columns, gives the rows of walking the list of
+        its genotypes
+        """
+        walked = query_to_csv_rows_list(genotypes_for_study(self.study, TEST_DB_ALIAS), testing=True)
+        self.assertEqual(list(study_csv_rows(self.study, TEST_DB_ALIAS, testing=True)), walked)
+
+    def test_delete_matrices(self):
+        delete_matrices(self.ds.id, TEST_DB_ALIAS)
+        with switch_db(GenotypeMatrix, TEST_DB_ALIAS) as TestMatrix:
+            self.assertEqual(TestMatrix.objects.count(), 0)
+        with switch_db(GenotypeMatrixChunk, TEST_DB_ALIAS) as TestChunk:
+            self.assertEqual(TestChunk.objects.count(), 0)
+
+
+class RegionTestCase(MasterTestCase):
+    """
+    Tests reading and querying the genomic coordinates of genotypes
+    """
+
+    def setUp(self):
+        super(RegionTestCase, self).setUp()
+        self.study, created = fetch_or_save(Experiment, TEST_DB_ALIAS, name='Region')
+        self.ds, created = fetch_or_save(DataSource, TEST_DB_ALIAS, name='Region')
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            for name, chrom, pos in [('a', '5', 2000000), ('b', '5', 1500), ('c', '4', 1700),
+                                     ('d', '5', 1000000), ('e', '5', 999)]:
+                TestGen(
+                    name=name, chrom=chrom, pos=pos, study=self.study, datasource=self.ds,
+                    obs={'chrom': chrom, 'pos': str(pos)},
+                ).save()
+
+    def test_coordinate_getter(self):
+        get = coordinate_getter(['rs#', 'alleles', 'Chrom', 'pos', 'S1'])
+        self.assertEqual(get(['m0', 'A/C', ' 5 ', '1234', 'A']), ('5', 1234))
+        self.assertEqual(get(['m0', 'A/C', '', 'NA', 'A']), (None, None))
+        self.assertEqual(coordinate_getter(['rs#', 'S1'])(['m0', 'A']), (None, None))
+
+    def test_parse_region(self):
+        self.assertEqual(parse_region('5', '1000', ''), ('5', 1000, None))
+        self.assertRaises(QueryBadRegionError, parse_region, '', '1', '2')
+        self.assertRaises(QueryBadRegionError, parse_region, '5', 'one', '2')
+        self.assertRaises(QueryBadRegionError, parse_region, '5', '3', '2')
+
+    def test_region_query(self):
+        """
+        Tests that a region query finds the genotypes between the positions, inclusive, in
+        position order
+        """
+        query = region_query(Genotype, '5', 1500, 2000000, db_alias=TEST_DB_ALIAS)
+        self.assertEqual([gen.name for gen in query], ['b', 'd', 'a'])
+        query = region_query(Genotype, '5', stop=1500, db_alias=TEST_DB_ALIAS)
+        self.assertEqual([gen.name for gen in query], ['e', 'b'])
+
+    def test_region_rows(self):
+        query = region_query(Genotype, '4', db_alias=TEST_DB_ALIAS)
+        rows = list(region_rows(query, TEST_DB_ALIAS))
+        self.assertEqual(rows, [
+            ['name', 'chrom', 'pos', 'study__name', 'datasource__name', 'obs'],
+            ['c', '4', 1700, 'Region', 'Region', "{'chrom':'4','pos':'1700'}"],
+        ])
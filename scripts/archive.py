@@ -0,0 +1,74 @@
+"""
+Moves the features of inactive data sources out of the main feature collections, into
+the compressed archive collections or into gzipped files under a directory, and moves
+them back (see mongcore.archive). Data sources are given by id, or with inactive and a
+before date, which archives every inactive data source supplied before that date.
+
+Usage:
+    ./manage.py runscript archive --script-args list
+    ./manage.py runscript archive --script-args archive 56a1b2c3d4e5f6a7b8c9d0e1
+    ./manage.py runscript archive --script-args archive inactive before=2016-01-01
+    ./manage.py runscript archive --script-args archive inactive before=2016-01-01 \\
+        to=files dir=/data/archive format=json
+    ./manage.py runscript archive --script-args restore 56a1b2c3d4e5f6a7b8c9d0e1
+"""
+
+from datetime import datetime
+from bson import ObjectId
+from django.conf import settings
+from mongcore.archive import (
+    archive_datasource, restore_datasource, inactive_datasources, archived_datasources
+)
+from mongcore.logger import Logger
+
+db_alias = 'default'
+commands = ('archive', 'restore', 'list')
+
+
+def parse_args(args):
+    options = {
+        'command': 'list', 'ids': [], 'inactive': False, 'before': None,
+        'to': 'collection', 'dir': getattr(settings, 'ARCHIVE_DIR', 'archive'), 'format': 'bson',
+    }
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if arg in commands:
+            options['command'] = arg
+        elif arg == 'inactive':
+            options['inactive'] = True
+        elif key == 'before':
+            options['before'] = datetime.strptime(value, '%Y-%m-%d')
+        elif key in ('to', 'dir', 'format'):
+            options[key] = value
+        elif ObjectId.is_valid(arg):
+            options['ids'].append(ObjectId(arg))
+        else:
+            raise ValueError("Unknown argument: " + arg + "\n" + __doc__)
+    if options['to'] not in ('collection', 'files'):
+        raise ValueError("to is one of collection or files\n" + __doc__)
+    if options['inactive'] and options['before'] is None:
+        # every data source is inactive unless marked otherwise, so a date is required
+        raise ValueError("inactive needs a before date\n" + __doc__)
+    return options
+
+
+def run(*args):
+    options = parse_args(args)
+    if options['command'] == 'list':
+        for datasource in archived_datasources(db_alias):
+            print("%s %s: %s, %s" % (
+                datasource.pk, datasource.name, datasource.archive, datasource.archived_date
+            ))
+        return
+    ids = list(options['ids'])
+    if options['inactive']:
+        ids += [datasource.pk for datasource in inactive_datasources(options['before'], db_alias)]
+    for _id in ids:
+        if options['command'] == 'archive':
+            directory = options['dir'] if options['to'] == 'files' else None
+            counts = archive_datasource(_id, db_alias, directory, options['format'])
+        else:
+            counts = restore_datasource(_id, db_alias)
+        msg = "archive: %s data source %s: %s" % (options['command'], _id, counts)
+        Logger.Message(msg)
+        print(msg)
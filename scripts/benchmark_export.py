@@ -0,0 +1,148 @@
+"""
+Compares the export paths of the Genotype collection. Loads a synthetic GBS experiment
+(see benchmark_ingest) into a scratch database, then times exporting it, for each path:
+
+    csv_documents_s   csv export reading the genotypes as mongoengine documents
+    csv_raw_s         csv export reading the genotypes' sons with a raw pymongo cursor
+    json_documents_s  dictionaries of the JSON report, from documents
+    json_raw_s        dictionaries of the JSON report, from raw sons
+
+and the speedup of the raw paths. Each export is timed repeat times and the fastest
+run is kept. The scratch database is dropped afterwards. The results are appended to a
+JSON file so runs can be compared over time.
+
+Usage:
+    ./manage.py runscript benchmark_export
+    ./manage.py runscript benchmark_export --script-args markers=100000 samples=200 \\
+        repeat=3 batch_size=1000 out=benchmark_export.json keep
+"""
+
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from mongoengine import register_connection
+from mongoengine.connection import get_connection
+from mongoengine.context_managers import switch_db
+from kaka.settings import MONGODB_HOST
+from mongcore.logger import Logger
+from mongcore.query_set_helpers import query_to_csv_rows, export_dicts
+from mongenotype.models import Genotype
+from . import load_from_config
+from .benchmark_ingest import make_gbs_dir, git_commit, save_results
+
+# Scratch database the experiment is loaded into, dropped before each run
+db_alias = 'benchmark_export'
+db_name = 'kaka_benchmark_export'
+out_path = "benchmark_export.json"
+
+
+def genotypes():
+    with switch_db(Genotype, db_alias) as Gen:
+        return Gen.objects.all()
+
+
+def time_csv(raw):
+    # Builds the csv export of every genotype, as genotype_csv_report does
+    start = time.time()
+    rows = sum(1 for row in query_to_csv_rows(genotypes(), raw=raw)) - 1
+    return time.time() - start, rows
+
+
+def time_json(raw):
+    # Builds the dictionary of every genotype, as genotype_json_report does
+    start = time.time()
+    rows = sum(1 for doc in export_dicts(genotypes(), raw=raw))
+    return time.time() - start, rows
+
+
+def fastest(timer, raw, repeat):
+    runs = [timer(raw) for i in range(repeat)]
+    return min(run[0] for run in runs), runs[0][1]
+
+
+def benchmark(n_markers, n_samples, repeat=3, batch_size=1000):
+    """
+    Loads a synthetic experiment into the scratch database and times its exports
+
+    :return: Dictionary of the results
+    """
+    get_connection(db_alias).drop_database(db_name)
+    path = Path(tempfile.mkdtemp(prefix="benchmark_export_")) / (
+        "GBS_%d_x_%d" % (n_markers, n_samples)
+    )
+    make_gbs_dir(path, n_markers, n_samples)
+    saved = load_from_config.db_alias, load_from_config.batch_size, load_from_config.workers
+    load_from_config.db_alias = db_alias
+    load_from_config.batch_size = batch_size
+    load_from_config.workers = 1
+    try:
+        load_from_config.load_in_dir(path)
+    finally:
+        load_from_config.db_alias, load_from_config.batch_size, load_from_config.workers = saved
+        shutil.rmtree(str(path.parent))
+
+    # the loader saves copies of the names, so the exports don't look any up
+    csv_documents, rows = fastest(time_csv, False, repeat)
+    csv_raw, raw_rows = fastest(time_csv, True, repeat)
+    json_documents, docs = fastest(time_json, False, repeat)
+    json_raw, raw_docs = fastest(time_json, True, repeat)
+    if (rows, docs) != (raw_rows, raw_docs):
+        raise ValueError("Raw export gave %d rows and %d documents, not %d and %d" % (
+            raw_rows, raw_docs, rows, docs
+        ))
+    result = {
+        'date': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'markers': n_markers,
+        'samples': n_samples,
+        'repeat': repeat,
+        'rows': rows,
+        'csv_documents_s': round(csv_documents, 3),
+        'csv_raw_s': round(csv_raw, 3),
+        'csv_speedup': round(csv_documents / csv_raw, 2) if csv_raw else None,
+        'json_documents_s': round(json_documents, 3),
+        'json_raw_s': round(json_raw, 3),
+        'json_speedup': round(json_documents / json_raw, 2) if json_raw else None,
+    }
+    Logger.Message("benchmark_export: " + str(result))
+    return result
+
+
+def parse_args(args):
+    options = {
+        'markers': 10000, 'samples': 50, 'repeat': 3, 'batch_size': 1000,
+        'out': out_path, 'keep': False,
+    }
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if key in ('markers', 'samples', 'repeat', 'batch_size'):
+            options[key] = int(value)
+        elif key == 'out':
+            options[key] = value
+        elif key == 'keep':
+            options[key] = True
+        else:
+            raise ValueError("Unknown argument: " + arg + "\n" + __doc__)
+    return options
+
+
+def run(*args):
+    options = parse_args(args)
+    register_connection(db_alias, name=db_name, host=MONGODB_HOST)
+    try:
+        result = benchmark(
+            options['markers'], options['samples'], options['repeat'], options['batch_size']
+        )
+    finally:
+        if not options['keep']:
+            get_connection(db_alias).drop_database(db_name)
+    print("csv:  %8.2fs documents  %8.2fs raw  %6.2fx" % (
+        result['csv_documents_s'], result['csv_raw_s'], result['csv_speedup'] or 0
+    ))
+    print("json: %8.2fs documents  %8.2fs raw  %6.2fx" % (
+        result['json_documents_s'], result['json_raw_s'], result['json_speedup'] or 0
+    ))
+    save_results([result], options['out'])
+    print("Results appended to " + options['out'])
@@ -0,0 +1,294 @@
+"""
+Measures how fast load_from_config ingests genotype data. Generates directories of
+synthetic gzipped GBS (HapMap format) tab files in the same layout as the directories
+in 'config examples/', loads each one into the database and rolls the load back again.
+
+For every size it reports rows/s, documents/s, the peak resident memory of the process
+and the time spent on each stage of the load:
+
+    decompress  reading the gzipped files
+    parse       splitting the lines into rows of values
+    build       making and validating the Genotype documents
+    write       inserting the documents into MongoDB
+
+Each stage is timed on its own pass over the files, and is the time the pass took less
+the time of the pass before it. It also reports how many bytes the loaded genotypes take
+up in the collection, per document, and in the collection's indexes, so storage modes
+such as lean (see mongcore.lean) can be compared. The results are appended to a JSON
+file so runs can be compared over time.
+
+Usage:
+    ./manage.py runscript benchmark_ingest
+    ./manage.py runscript benchmark_ingest --script-args markers=10000,100000 samples=50,500 \\
+        files=2 workers=2 batch_size=1000 db=default out=benchmark_ingest.json keep lean
+"""
+
+import gzip
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from . import load_from_config
+from .load_from_config import Import
+from mongcore.connectors import CsvConnector
+from mongcore.ingest_runs import RunTracker, get_run
+from mongcore.indexes import get_collection
+from mongenotype.models import Genotype
+from .encode_obs import collection_sizes
+from mongcore.logger import Logger
+
+# Alias of the database loaded into. Everything loaded is rolled back afterwards
+db_alias = 'default'
+out_path = "benchmark_ingest.json"
+
+hapmap_columns = [
+    'rs#', 'alleles', 'chrom', 'pos', 'strand', 'assembly#', 'center', 'protLSID',
+    'assayLSID', 'panelLSID', 'QCcode'
+]
+calls = ['A', 'C', 'G', 'T', 'R', 'Y', 'S', 'W', 'K', 'M', 'N']
+alleles = ['A/C', 'A/G', 'A/T', 'C/G', 'C/T', 'G/T']
+
+
+def write_gbs_file(fn, n_markers, n_samples, seed=0, pool_size=256):
+    """
+    Writes a gzipped HapMap file of random genotype calls. Rows of calls are drawn from a
+    pool made up front, so files of millions of markers can be written quickly
+
+    :param fn: Path of the file to write
+    :param n_markers: Number of rows (markers) in the file
+    :param n_samples: Number of sample columns
+    :param seed: Seed for the random calls, so the same arguments give the same file
+    :param pool_size: Number of different rows of calls to draw from
+    """
+    rng = random.Random(seed)
+    pool = [
+        '\t'.join(rng.choice(calls) for _ in range(n_samples))
+        for _ in range(min(pool_size, n_markers) or 1)
+    ]
+    samples = ['SAMPLE_%04d' % i for i in range(n_samples)]
+    # compressed at the level gzip uses by default, rather than python's maximum
+    with gzip.open(fn, 'wt', compresslevel=6) as f:
+        f.write('\t'.join(hapmap_columns + samples) + '\n')
+        for i in range(n_markers):
+            chrom = i % 12 + 1
+            f.write('S%d_%d\t%s\t%d\t%d\t+\tNA\tNA\tNA\tNA\tNA\tNA\t%s\n' % (
+                chrom, i, rng.choice(alleles), chrom, i * 100, rng.choice(pool)
+            ))
+
+
+def make_gbs_dir(path, n_markers, n_samples, n_files=1, seed=0):
+    """
+    Makes a directory that load_from_config can load: a config.json and n_files
+    gzipped HapMap files of n_markers rows each
+
+    :return: Paths of the files written
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    config = {
+        "Data Creator": "benchmark_ingest",
+        "Experiment Description": "Synthetic GBS data, %d markers x %d samples" % (
+            n_markers, n_samples
+        ),
+        "Experiment Code": "benchmark",
+        "Upload Date": "dt(2016-01-08T11:07:33Z)",
+        "Experiment Date": "dt(2016-01-07)",
+        "Genotype Column": "rs#",
+    }
+    with open(str(path / "config.json"), 'w') as f:
+        json.dump(config, f, indent=4)
+    file_paths = []
+    for i in range(n_files):
+        fn = path / ("lane_%d.hmp.txt.gz" % i)
+        write_gbs_file(str(fn), n_markers, n_samples, seed=seed + i)
+        file_paths.append(fn)
+    return file_paths
+
+
+def time_decompress(file_paths):
+    start = time.time()
+    for fn in file_paths:
+        with gzip.open(str(fn), 'rb') as f:
+            while f.read(CsvConnector.block_size):
+                pass
+    return time.time() - start
+
+
+def time_parse(file_paths, size):
+    start = time.time()
+    rows = 0
+    for fn in file_paths:
+        conn = CsvConnector(str(fn), delimiter='\t', gzipped=True)
+        for batch in conn.chunks(size):
+            rows += len(batch)
+        conn.close()
+    return time.time() - start, rows
+
+
+class DryInserter:
+    # Stands in for a BulkInserter, doing everything to a document but writing it
+    def add(self, doc):
+        doc.validate()
+        doc.to_mongo()
+
+
+def time_build(file_paths, size):
+    # Builds the genotypes the way the loader does, using the experiment and data source
+    # of the load that has just been timed, since references have to be saved documents
+    Import.inserter = DryInserter()
+    start = time.time()
+    try:
+        for fn in file_paths:
+            conn = CsvConnector(str(fn), delimiter='\t', gzipped=True)
+            for batch in conn.chunks(size):
+                Import.load_batch_op(batch, conn.header_index, True)
+            conn.close()
+    finally:
+        Import.inserter = None
+    return time.time() - start
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux. Worker processes are counted separately
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(self_kb / 1024, 1), round(children_kb / 1024, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(n_markers, n_samples, n_files=1, batch_size=1000, workers=1, keep=False,
+              lean=False):
+    """
+    Generates a directory of synthetic data, loads it with load_from_config, times each
+    stage and rolls the load back
+
+    :return: Dictionary of the results
+    """
+    path = Path(tempfile.mkdtemp(prefix="benchmark_ingest_")) / (
+        "GBS_%d_x_%d" % (n_markers, n_samples)
+    )
+    Logger.Message("benchmark_ingest: generating " + str(path))
+    file_paths = make_gbs_dir(path, n_markers, n_samples, n_files)
+    size_mb = sum(fn.stat().st_size for fn in file_paths) / float(1 << 20)
+
+    decompress = time_decompress(file_paths)
+    parse, rows = time_parse(file_paths, batch_size or 1000)
+
+    load_from_config.db_alias = db_alias
+    load_from_config.batch_size = batch_size
+    load_from_config.workers = workers
+    load_from_config.lean = lean
+    collection = get_collection(Genotype, db_alias)
+    data_bytes, index_bytes = collection_sizes(collection)
+    load_from_config.tracker = RunTracker("benchmark_ingest: " + path.name, db_alias)
+    try:
+        start = time.time()
+        load_from_config.load_in_dir(path)
+        load = time.time() - start
+        loaded_bytes, loaded_index_bytes = collection_sizes(collection)
+        build = time_build(file_paths, batch_size or 1000)
+        load_from_config.tracker.save_counts()
+        documents = get_run(load_from_config.tracker.id, db_alias).counts.get('Genotype', 0)
+    finally:
+        # leaves the database as it was
+        load_from_config.tracker.roll_back("benchmark")
+        load_from_config.tracker = None
+        load_from_config.lean = False
+        if not keep:
+            shutil.rmtree(str(path.parent))
+
+    self_mb, children_mb = peak_rss_mb()
+    result = {
+        'date': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'markers': n_markers,
+        'samples': n_samples,
+        'files': n_files,
+        'file_mb': round(size_mb, 2),
+        'batch_size': batch_size,
+        'workers': workers,
+        'lean': lean,
+        'rows': rows,
+        'documents': documents,
+        'seconds': round(load, 3),
+        'rows_per_s': round(rows / load, 1) if load else None,
+        'documents_per_s': round(documents / load, 1) if load else None,
+        'bytes_per_document': round((loaded_bytes - data_bytes) / documents, 1) if documents else None,
+        'data_mb': round((loaded_bytes - data_bytes) / float(1 << 20), 2),
+        'index_mb': round((loaded_index_bytes - index_bytes) / float(1 << 20), 2),
+        'peak_rss_mb': self_mb,
+        'peak_rss_workers_mb': children_mb,
+        'stages': {
+            'decompress': round(decompress, 3),
+            'parse': round(max(parse - decompress, 0), 3),
+            'build': round(max(build - parse, 0), 3),
+            # only meaningful when the load ran in this process
+            'write': round(max(load - build, 0), 3) if workers == 1 else None,
+        },
+    }
+    Logger.Message("benchmark_ingest: " + json.dumps(result))
+    return result
+
+
+def save_results(results, fn):
+    # Appends to the results already in the file
+    previous = []
+    if os.path.exists(fn):
+        with open(fn) as f:
+            previous = json.load(f)
+    with open(fn, 'w') as f:
+        json.dump(previous + results, f, indent=2)
+
+
+def parse_args(args):
+    options = {
+        'markers': [10000], 'samples': [50], 'files': 1, 'batch_size': 1000, 'workers': 1,
+        'db': db_alias, 'out': out_path, 'keep': False, 'lean': False,
+    }
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if key in ('markers', 'samples'):
+            options[key] = [int(v) for v in value.split(',')]
+        elif key in ('files', 'batch_size', 'workers'):
+            options[key] = int(value)
+        elif key in ('db', 'out'):
+            options[key] = value
+        elif key in ('keep', 'lean'):
+            options[key] = True
+        else:
+            raise ValueError("Unknown argument: " + arg + "\n" + __doc__)
+    return options
+
+
+def run(*args):
+    global db_alias
+    options = parse_args(args)
+    db_alias = options['db']
+    results = []
+    for n_markers in options['markers']:
+        for n_samples in options['samples']:
+            result = benchmark(
+                n_markers, n_samples, options['files'], options['batch_size'],
+                options['workers'], options['keep'], options['lean']
+            )
+            print("%9d markers x %4d samples: %10.1f rows/s  %10.1f docs/s  %8.1f MB peak  "
+                  "%8.1f bytes/doc  %s" % (
+                      n_markers, n_samples, result['rows_per_s'] or 0,
+                      result['documents_per_s'] or 0, result['peak_rss_mb'],
+                      result['bytes_per_document'] or 0, result['stages']
+                  ))
+            results.append(result)
+    save_results(results, options['out'])
+    print("Results appended to " + options['out'])
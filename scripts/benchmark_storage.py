@@ -0,0 +1,164 @@
+"""
+Compares storage settings for the Genotype collection (see mongcore.storage). Loads the
+same synthetic GBS experiment (see benchmark_ingest) into a scratch database once per
+setting, with the Genotype collection created afresh with the setting's block compressor
+and index prefix compression, and reports for each:
+
+    data_mb     size of the documents, uncompressed
+    disk_mb     size of the documents on disk
+    index_mb    size of the indexes on disk
+    load_s      time load_from_config took to load the experiment
+    export_s    time the csv export of the whole experiment took
+
+The scratch database is dropped afterwards. The results are appended to a JSON file so
+runs can be compared over time.
+
+Usage:
+    ./manage.py runscript benchmark_storage
+    ./manage.py runscript benchmark_storage --script-args markers=100000 samples=200 \\
+        compressors=none,snappy,zlib,zstd prefix=on,off batch_size=1000 \\
+        out=benchmark_storage.json keep
+"""
+
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from mongoengine import register_connection
+from mongoengine.connection import get_connection
+from mongoengine.context_managers import switch_db
+from kaka.settings import MONGODB_HOST
+from mongcore.models import Experiment
+from mongcore.indexes import build_indexes, get_collection
+from mongcore.logger import Logger
+from mongcore.query_set_helpers import query_to_csv_rows
+from mongcore.storage import create_collection, storage_stats
+from mongenotype.models import Genotype
+from mongenotype.matrix import genotypes_for_study
+from . import load_from_config
+from .benchmark_ingest import make_gbs_dir, git_commit, save_results
+
+# Scratch database the experiment is loaded into, dropped before each setting
+db_alias = 'benchmark_storage'
+db_name = 'kaka_benchmark_storage'
+out_path = "benchmark_storage.json"
+
+
+def settings_to_compare(compressors, prefixes):
+    return [
+        {'block_compressor': compressor, 'prefix_compression': prefix}
+        for compressor in compressors for prefix in prefixes
+    ]
+
+
+def time_export():
+    # Builds the csv export of every experiment in the database, as genotype_csv_report does
+    start = time.time()
+    rows = 0
+    with switch_db(Experiment, db_alias) as Exper:
+        experiments = list(Exper.objects)
+    for experiment in experiments:
+        rows += sum(1 for row in query_to_csv_rows(genotypes_for_study(experiment, db_alias))) - 1
+    return time.time() - start, rows
+
+
+def benchmark(options, n_markers, n_samples, batch_size=1000):
+    """
+    Loads and exports a synthetic experiment with the Genotype collection created with
+    the given storage options
+
+    :param options: Storage options, as in settings.COLLECTION_STORAGE
+    :return: Dictionary of the results
+    """
+    connection = get_connection(db_alias)
+    connection.drop_database(db_name)
+    create_collection(Genotype, db_alias, options)
+    # indexes made after the collection, so they get its index options
+    build_indexes(Genotype, db_alias, background=False)
+
+    path = Path(tempfile.mkdtemp(prefix="benchmark_storage_")) / (
+        "GBS_%d_x_%d" % (n_markers, n_samples)
+    )
+    make_gbs_dir(path, n_markers, n_samples)
+    saved = load_from_config.db_alias, load_from_config.batch_size, load_from_config.workers
+    load_from_config.db_alias = db_alias
+    load_from_config.batch_size = batch_size
+    load_from_config.workers = 1
+    try:
+        start = time.time()
+        load_from_config.load_in_dir(path)
+        load = time.time() - start
+    finally:
+        load_from_config.db_alias, load_from_config.batch_size, load_from_config.workers = saved
+        shutil.rmtree(str(path.parent))
+    export, rows = time_export()
+
+    # writes the collection to disk, so its storage size is up to date
+    connection.admin.command('fsync')
+    stats = storage_stats(get_collection(Genotype, db_alias))
+    mb = float(1 << 20)
+    result = {
+        'date': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'markers': n_markers,
+        'samples': n_samples,
+        'batch_size': batch_size,
+        'block_compressor': options['block_compressor'],
+        'prefix_compression': options['prefix_compression'],
+        'compressor_used': stats['compressor'],
+        'rows': rows,
+        'data_mb': round(stats['size'] / mb, 2),
+        'disk_mb': round(stats['storage_size'] / mb, 2),
+        'index_mb': round(stats['index_size'] / mb, 2),
+        'load_s': round(load, 3),
+        'export_s': round(export, 3),
+    }
+    Logger.Message("benchmark_storage: " + str(result))
+    return result
+
+
+def parse_args(args):
+    options = {
+        'markers': 10000, 'samples': 50, 'batch_size': 1000,
+        'compressors': ['none', 'snappy', 'zlib'], 'prefix': [True],
+        'out': out_path, 'keep': False,
+    }
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if key in ('markers', 'samples', 'batch_size'):
+            options[key] = int(value)
+        elif key == 'compressors':
+            options[key] = value.split(',')
+        elif key == 'prefix':
+            options[key] = [v == 'on' for v in value.split(',')]
+        elif key == 'out':
+            options[key] = value
+        elif key == 'keep':
+            options[key] = True
+        else:
+            raise ValueError("Unknown argument: " + arg + "\n" + __doc__)
+    return options
+
+
+def run(*args):
+    options = parse_args(args)
+    register_connection(db_alias, name=db_name, host=MONGODB_HOST)
+    results = []
+    try:
+        for storage in settings_to_compare(options['compressors'], options['prefix']):
+            result = benchmark(
+                storage, options['markers'], options['samples'], options['batch_size']
+            )
+            prefix = 'on' if storage['prefix_compression'] else 'off'
+            print("%-6s prefix %-3s: %8.2f MB data  %8.2f MB disk  %8.2f MB indexes  "
+                  "%8.2fs load  %8.2fs export" % (
+                      storage['block_compressor'], prefix, result['data_mb'],
+                      result['disk_mb'], result['index_mb'], result['load_s'], result['export_s']
+                  ))
+            results.append(result)
+    finally:
+        if not options['keep']:
+            get_connection(db_alias).drop_database(db_name)
+    save_results(results, options['out'])
+    print("Results appended to " + options['out'])
@@ -0,0 +1,125 @@
+"""
+Converts the obs of the features already in a collection to the encoded form, keeping
+the keys once per data source in ObsKeys documents (see mongcore.obs_keys), or decodes
+them back to plain obs dicts. Prints the size of the collection and its indexes before
+and after.
+
+Usage:
+    ./manage.py runscript encode_obs
+    ./manage.py runscript encode_obs --script-args Genotype Marker
+    ./manage.py runscript encode_obs --script-args decode Genotype
+"""
+
+from mongoengine.base import get_document
+from mongoengine.context_managers import switch_db
+from mongcore.models import class_spec
+from mongcore.obs_keys import ObsKeyEncoder, get_keys, decode_values
+from mongcore.logger import Logger
+
+db_alias = 'default'
+batch_size = 1000
+
+
+def collection_sizes(collection):
+    # Size in bytes of the collection's documents and of its indexes
+    stats = collection.database.command('collstats', collection.name)
+    return stats.get('size', 0), stats.get('totalIndexSize', 0)
+
+
+def get_collection(document):
+    with switch_db(document, db_alias) as Col:
+        return Col._get_collection()
+
+
+class BatchUpdater:
+    # Writes updates with one unordered bulk operation per batch_size documents
+    def __init__(self, collection, before_write=None):
+        self.collection = collection
+        self.before_write = before_write
+        self.bulk = collection.initialize_unordered_bulk_op()
+        self.pending = 0
+        self.updated = 0
+
+    def update(self, _id, update):
+        self.bulk.find({'_id': _id}).update_one(update)
+        self.pending += 1
+        if self.pending >= batch_size:
+            self.execute()
+
+    def execute(self):
+        if not self.pending:
+            return
+        if self.before_write:
+            self.before_write()
+        self.bulk.execute()
+        self.updated += self.pending
+        self.pending = 0
+        self.bulk = self.collection.initialize_unordered_bulk_op()
+
+
+def encode_collection(document):
+    """
+    Encodes the obs of every feature of the given class that has a data source and
+    plain obs
+
+    :param document: Feature class whose collection to encode
+    :return: Number of documents encoded
+    """
+    collection = get_collection(document)
+    encoders = {}
+
+    def save_keys():
+        # key dictionaries are saved before the values that need them are written
+        for encoder in encoders.values():
+            encoder.save()
+
+    updater = BatchUpdater(collection, save_keys)
+    query = dict(
+        class_spec(document), obs={'$exists': True}, obs_values={'$exists': False},
+        datasource={'$ne': None},
+    )
+    for son in collection.find(query, {'obs': 1, 'datasource': 1}):
+        datasource = son['datasource']
+        if datasource not in encoders:
+            encoders[datasource] = ObsKeyEncoder(datasource, db_alias)
+        values = encoders[datasource].encode(son['obs'])
+        updater.update(son['_id'], {'$set': {'obs_values': values}, '$unset': {'obs': ''}})
+    updater.execute()
+    return updater.updated
+
+
+def decode_collection(document):
+    """
+    Turns the encoded obs of every feature of the given class back into plain obs dicts
+
+    :param document: Feature class whose collection to decode
+    :return: Number of documents decoded
+    """
+    collection = get_collection(document)
+    updater = BatchUpdater(collection)
+    query = dict(class_spec(document), obs_values={'$exists': True})
+    for son in collection.find(query, {'obs_values': 1, 'datasource': 1}):
+        keys = get_keys(son.get('datasource'), db_alias, len(son['obs_values']))
+        obs = decode_values(keys, son['obs_values'])
+        updater.update(son['_id'], {'$set': {'obs': obs}, '$unset': {'obs_values': ''}})
+    updater.execute()
+    return updater.updated
+
+
+def run(*args):
+    decode = 'decode' in args
+    names = [arg for arg in args if arg != 'decode'] or ['Genotype']
+    for name in names:
+        document = get_document(name)
+        collection = get_collection(document)
+        size, index_size = collection_sizes(collection)
+        if decode:
+            n = decode_collection(document)
+        else:
+            n = encode_collection(document)
+        new_size, new_index_size = collection_sizes(collection)
+        msg = "%s: %s %d documents. Data %d -> %d bytes, indexes %d -> %d bytes" % (
+            name, 'decoded' if decode else 'encoded', n, size, new_size, index_size, new_index_size
+        )
+        Logger.Message(msg)
+        print(msg)
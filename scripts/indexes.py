@@ -0,0 +1,40 @@
+"""
+Manages the indexes declared in the meta of the document classes (see mongcore.indexes).
+
+build creates the declared indexes in the background, for all indexed document classes
+or the named ones. drop removes the indexes of the named classes, to defer them ahead of
+a bulk load; build them again once it is done, or load with load_from_config's
+defer_indexes argument to do both. report lists, for each index, the queries of the
+views and loaders it serves, and the queries that scan their whole collection
+
+Usage:
+    ./manage.py runscript indexes
+    ./manage.py runscript indexes --script-args build
+    ./manage.py runscript indexes --script-args build Genotype Experiment
+    ./manage.py runscript indexes --script-args drop Genotype
+"""
+
+from mongoengine.base import get_document
+from mongcore.indexes import indexed_documents, build_indexes, drop_indexes, index_report, format_report
+from mongcore.logger import Logger
+
+db_alias = 'default'
+
+
+def run(*args):
+    command = args[0] if args else 'report'
+    documents = [get_document(name) for name in args[1:]]
+    if command == 'build':
+        for document in documents or indexed_documents():
+            build_indexes(document, db_alias)
+            Logger.Message("Building indexes of " + document.__name__)
+    elif command == 'drop':
+        if not documents:
+            raise ValueError("Name the document classes whose indexes to drop")
+        for document in documents:
+            drop_indexes(document, db_alias)
+            Logger.Message("Dropped indexes of " + document.__name__)
+    elif command == 'report':
+        print(format_report(index_report(db_alias)))
+    else:
+        raise ValueError("Unknown command: " + command)
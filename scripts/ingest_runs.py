@@ -0,0 +1,43 @@
+"""
+Lists, inspects and rolls back the ingest runs recorded by the loading scripts.
+
+Usage:
+    ./manage.py runscript ingest_runs
+    ./manage.py runscript ingest_runs --script-args show <run id>
+    ./manage.py runscript ingest_runs --script-args rollback <run id>
+"""
+
+from mongcore.ingest_runs import list_runs, get_run, roll_back_run
+
+db_alias = 'default'
+
+
+def print_run(ingest_run):
+    finished = ingest_run.finished.strftime("%Y-%m-%d %H:%M:%S") if ingest_run.finished else '-'
+    print("%s  %-12s %s  %s  %s" % (
+        ingest_run.id, ingest_run.status, ingest_run.started.strftime("%Y-%m-%d %H:%M:%S"),
+        finished, ingest_run.name
+    ))
+
+
+def show_run(run_id):
+    ingest_run = get_run(run_id, db_alias)
+    print_run(ingest_run)
+    for name in ingest_run.collections:
+        print("    %-20s %d" % (name, ingest_run.counts.get(name, 0)))
+    if ingest_run.message:
+        print("    " + ingest_run.message)
+
+
+def run(*args):
+    if len(args) == 0 or args[0] == 'list':
+        for ingest_run in list_runs(db_alias):
+            print_run(ingest_run)
+    elif args[0] == 'show' and len(args) == 2:
+        show_run(args[1])
+    elif args[0] == 'rollback' and len(args) == 2:
+        removed = roll_back_run(args[1], db_alias)
+        for name in removed:
+            print("Removed %d %s documents" % (removed[name], name))
+    else:
+        print(__doc__)
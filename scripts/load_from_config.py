@@ -2,43 +2,116 @@
 Goes through the data directory finding folders with config files in the correct format.
 Loads the data in those folders to the database using the fields defined in the folder's
 config file
+
+Usage:
+    ./manage.py runscript load_from_config
+    ./manage.py runscript load_from_config --script-args incremental
+    ./manage.py runscript load_from_config --script-args encode_obs
+    ./manage.py runscript load_from_config --script-args defer_indexes
+    ./manage.py runscript load_from_config --script-args lean
+
+An incremental load also goes through directories already marked as loaded, and compares
+each file with the fingerprint recorded on its data source: unchanged files are skipped,
+new files are added and changed files replace the data loaded from them before.
+
+With encode_obs the genotypes store their obs as a list of values, with the keys kept
+once per data source (see mongcore.obs_keys)
+
+defer_indexes drops the indexes of the genotype collection while loading and builds them
+again in the background afterwards (see mongcore.indexes)
+
+lean leaves out of each bulk inserted genotype the fields that are their default or the
+experiment's, which are filled back in when the genotype is read (see mongcore.lean)
+
+A config with "Data Type" : "Expression" loads its files as RNA-seq count tables, each
+to an ExpressionMatrix (see gene_expression.matrix). "Gene Column" names the column of
+gene ids (gene_id by default), and "Library Conditions" and "Library Types" give the
+condition and lib_type of each library column by name
 """
 
+import hashlib
+from multiprocessing import Pool
 from pathlib import Path
 from .configuration_parser import get_parser_from_path
 from mongcore.query_set_helpers import fetch_or_save
-from mongcore.models import DataSource, Experiment, SaveKVs
-from mongenotype.models import Genotype, Primer
+from mongcore.models import (
+    DataSource, Experiment, ObsKeys, DataSummary, SaveKVs, DataError, clear_caches,
+    set_ontology_fields,
+)
+from mongenotype.models import Genotype, GenotypeMatrix, GenotypeMatrixChunk, Primer
+from mongenotype.matrix import MatrixWriter, delete_matrices, hapmap_info_columns
+from mongenotype.regions import coordinate_getter, set_coordinates
+from gene_expression.models import ExpressionMatrix, ExpressionMatrixChunk
+from gene_expression.matrix import load_count_table, delete_expression_matrices
 from mongcore.connectors import CsvConnector
-from mongcore.imports import GenericImport
+from mongcore.imports import GenericImport, BulkInserter
+from mongcore.lean import study_cache
+from mongcore.obs_keys import ObsKeyEncoder
+from mongcore.summaries import SummaryWriter
+from mongcore.headers import invalidate_headers
+from mongcore.ingest_runs import RunTracker
+from mongcore.indexes import deferred_indexes
+from mongcore.storage import ensure_collections
 from mongcore.logger import Logger
 from kaka.settings import TEST_DB_ALIAS
 from mongoengine.context_managers import switch_db
+from mongoengine.connection import get_db
 
 testing = False
 db_alias = 'default'
 path_string = "data/"
-created_doc_ids = []
-
-
-def run():
-    global db_alias
+# Number of genotype documents written per bulk insert. 0 saves documents one at a time
+batch_size = 1000
+# Number of worker processes loading the files of a directory. 1 loads them one after another
+workers = 1
+# Loads only the new and changed files of directories, including those marked as loaded
+incremental = False
+# Stores genotype obs as values in the order of a key dictionary kept per data source
+encode_obs = False
+# Drops the genotype indexes for the duration of the load instead of maintaining them
+defer_indexes = False
+# Leaves default and inherited values out of bulk inserted genotypes
+lean = False
+# Stamps the documents saved to db by the current run of the script with the run's id
+tracker = None
+# Data sources of changed files, removed once the whole run has succeeded
+replaced = []
+
+
+def run(*args):
+    global db_alias, tracker, incremental, encode_obs, defer_indexes, lean
     if testing:
         db_alias = TEST_DB_ALIAS
-    # for keeping track of documents saved to db by this run of script
-    global created_doc_ids
-    created_doc_ids = []
+    if 'incremental' in args:
+        incremental = True
+    if 'encode_obs' in args:
+        encode_obs = True
+    if 'defer_indexes' in args:
+        defer_indexes = True
+    if 'lean' in args:
+        lean = True
+    # collections get the storage in settings.COLLECTION_STORAGE when they are created
+    ensure_collections(db_alias)
+    tracker = RunTracker("load_from_config: " + path_string, db_alias)
 
     path = Path(path_string)
     try:
-        look_for_config_dir(path)
+        if defer_indexes:
+            with deferred_indexes([Genotype], db_alias):
+                look_for_config_dir(path)
+        else:
+            look_for_config_dir(path)
+        remove_replaced()
     except Exception as e:
         Logger.Error(str(e))
         # 'Cancels' the script, by removing from db all documents saved to db in this script run-through
-        for doc_type, doc_id in created_doc_ids:
-            with switch_db(doc_type, db_alias) as Col:
-                Col.objects.get(id=doc_id).delete()
+        tracker.roll_back(str(e))
         raise e
+    else:
+        tracker.finish()
+    finally:
+        tracker = None
+        del replaced[:]
 
 
 def look_for_config_dir(path):
@@ -51,6 +124,7 @@ def look_for_config_dir(path):
 
 
 def load_in_dir(path):
+    global tracker
 
     if isinstance(path, str):
         path = Path(path)
@@ -64,17 +138,163 @@ def load_in_dir(path):
         return
 
     config_dic = config_parser.read()
-    if '_loaded' in config_dic and config_dic['_loaded'] == True:
+    if '_loaded' in config_dic and config_dic['_loaded'] == True and not incremental:
         # skips this directory if it is recorded as already loaded into db
         return
-    build_dic = init_for_all(path, config_dic)
-    for file_path in path.glob("*.gz"):
-        Logger.Message("Processing: " + str(file_path))
-        init_file(file_path, build_dic)
-        load(str(file_path))
+    # Directories loaded outside of run() get an ingest run of their own
+    own_run = tracker is None
+    if own_run:
+        tracker = RunTracker("load_from_config: " + path.as_posix(), db_alias)
+    reset_caches()
+    try:
+        build_dic = init_for_all(path, config_dic)
+        files = files_to_load(list(path.glob("*.gz")))
+        if workers > 1 and len(files) > 1:
+            load_files_parallel(files, build_dic)
+        else:
+            for file_path, stamp in files:
+                Logger.Message("Processing: " + str(file_path))
+                init_file(file_path, build_dic, stamp)
+                load(str(file_path))
+        if own_run:
+            remove_replaced()
+            tracker.finish()
+    except Exception as e:
+        if own_run:
+            tracker.finish('failed', str(e))
+        raise e
+    finally:
+        if own_run:
+            tracker = None
+            del replaced[:]
+    # Only reached once every file, whichever process loaded it, has been loaded
     config_parser.mark_loaded()
 
 
+def reset_caches():
+    # Documents cached by an earlier load, possibly into another database, may have
+    # been changed or deleted since
+    clear_caches()
+    study_cache.clear()
+
+
+def file_stamp(file_path, block_size=1 << 20):
+    """
+    Reads the given file a block at a time, so files of any size are never held in memory
+
+    :param file_path: Path of file to fingerprint
+    :param block_size: Number of bytes read at a time
+    :return: Size of the file in bytes and sha1 hex digest of its content
+    """
+    sha1 = hashlib.sha1()
+    size = 0
+    with open(str(file_path), 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+            size += len(block)
+    return size, sha1.hexdigest()
+
+
+def files_to_load(file_paths):
+    """
+    Picks out the files of a directory that need loading. Every file is loaded unless the
+    load is incremental, in which case files whose size and fingerprint match a data
+    source already loaded from the same path are skipped. The data sources of files that
+    have changed are added to replaced, to be removed once their new data has been loaded
+
+    :param file_paths: Paths of the .gz files in a directory
+    :return: List of (path, stamp) tuples to load. The stamp is the (size, fingerprint)
+             of the file, or None if it has not been worked out yet
+    """
+    if not incremental:
+        return [(file_path, None) for file_path in file_paths]
+    files = []
+    with switch_db(DataSource, db_alias) as DatS:
+        for file_path in file_paths:
+            stamp = file_stamp(file_path)
+            loaded = list(DatS.objects(source=file_path.as_posix()))
+            if any((ds.size, ds.fingerprint) == stamp for ds in loaded):
+                Logger.Message("Unchanged, skipping: " + str(file_path))
+                continue
+            files.append((file_path, stamp))
+            replaced.extend(loaded)
+    return files
+
+
+def remove_replaced():
+    # Removes the data sources of changed files, with the genotypes loaded from them.
+    # Done after the new data is in, so the file's data is never missing from the db
+    with switch_db(Genotype, db_alias) as Gen, switch_db(DataSource, db_alias) as DatS, \
+            switch_db(ObsKeys, db_alias) as Keys, switch_db(DataSummary, db_alias) as Summary:
+        for ds in replaced:
+            removed = Gen.objects(datasource=ds.id).delete()
+            delete_matrices(ds.id, db_alias)
+            delete_expression_matrices(ds.id, db_alias)
+            Keys.objects(datasource=ds.id).delete()
+            Summary.objects(datasource=ds.id).delete()
+            invalidate_headers(Genotype._get_collection_name(), datasource=ds.id, db_alias=db_alias)
+            DatS.objects(id=ds.id).delete()
+            Logger.Message("Replaced " + ds.source + ", removed " + str(removed) + " genotypes")
+    del replaced[:]
+
+
+def load_files_parallel(files, build_dic):
+    """
+    Loads the given files at the same time across a pool of worker processes, each
+    with its own database connection. All the files share the Experiment already set
+    on Import.study, but each gets its own DataSource.
+
+    Waits for every worker to finish. The workers stamp their documents with the
+    current ingest run, and if any worker failed a DataError naming each failed file
+    is raised afterwards so run() can roll back the whole run
+
+    :param files: (path, stamp) tuples of the .gz files to load
+    :param build_dic: Dictionary of field values common to the directory's documents
+    """
+    jobs = [
+        (str(file_path), stamp, build_dic, Import.study.id, tracker.id, db_alias, batch_size)
+        for file_path, stamp in files
+    ]
+    pool = Pool(processes=min(workers, len(jobs)), initializer=init_worker, initargs=(db_alias,))
+    try:
+        errors = pool.map(load_file_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    errors = [error for error in errors if error]
+    if errors:
+        raise DataError("Loading failed: " + "; ".join(errors))
+
+
+def init_worker(alias):
+    # Connections inherited from the parent process are not safe to use after a fork,
+    # so each worker opens its own
+    for connection_alias in {'default', alias}:
+        get_db(connection_alias, reconnect=True)
+
+
+def load_file_job(job):
+    # Loads a single file in a worker process. Returns the error message if it failed,
+    # as a string, since not every exception can be sent back to the parent process
+    global tracker, db_alias, batch_size
+    file_path, stamp, build_dic, study_id, run_id, db_alias, batch_size = job
+    tracker = RunTracker(db_alias=db_alias, run_id=run_id)
+    try:
+        with switch_db(Experiment, db_alias) as Exper:
+            ex = Exper.objects.get(id=study_id)
+        set_import_values(ex, build_dic)
+        Logger.Message("Processing: " + file_path)
+        init_file(Path(file_path), build_dic, stamp)
+        load(file_path)
+    except Exception as e:
+        Logger.Error(file_path + ": " + str(e))
+        return "%s: %s: %s" % (file_path, type(e).__name__, e)
+    finally:
+        tracker.save_counts()
+    return None
+
+
 def init_for_all(path, config_dic):
     # Gets the name for the experiment and data_source documents from the directory name
     posix_path = path.as_posix()
@@ -86,26 +306,45 @@ def init_for_all(path, config_dic):
     build_dic['name'] = name
 
     with switch_db(Experiment, db_alias) as Exper:
-        ex, created = fetch_or_save(Exper, db_alias=db_alias, **make_field_dic(Exper, build_dic))
+        field_dic = make_field_dic(Exper, build_dic)
+        ex, created = fetch_or_save(
+            Exper, db_alias=db_alias, search_dict=field_dic, ingest_run=tracker.id, **field_dic
+        )
         if created:  # add to record of docs saved to db by this run through
-            created_doc_ids.append((Experiment, ex.id))
+            tracker.created(Experiment)
 
+    set_import_values(ex, build_dic)
+    return build_dic
+
+
+def set_import_values(ex, build_dic):
     # Sets the values common to all genotype docs made from the given path
     Import.study = ex
     Import.createddate = build_dic['createddate']
     Import.description = build_dic['description']
-    Import.gen_col = build_dic['Genotype Column']
-    return build_dic
+    Import.gen_col = build_dic.get('Genotype Column')
+    # 'matrix' stores the calls as a GenotypeMatrix instead of a Genotype document per row
+    Import.storage = build_dic.get('Genotype Storage', 'documents')
+    # 'Expression' loads the files as count tables instead of genotypes
+    Import.data_type = build_dic.get('Data Type', 'Genotype')
+    Import.gene_col = build_dic.get('Gene Column', 'gene_id')
+    Import.conditions = build_dic.get('Library Conditions', {})
+    Import.lib_types = build_dic.get('Library Types', {})
 
 
-def init_file(file_path, build_dic):
+def init_file(file_path, build_dic, stamp=None):
     posix_path = file_path.as_posix()
     build_dic['source'] = posix_path
+    # A changed file gets a new data source, as its fingerprint no longer matches the old one
+    build_dic['size'], build_dic['fingerprint'] = stamp or file_stamp(file_path)
 
     with switch_db(DataSource, db_alias) as DatS:
-        ds, created = fetch_or_save(DatS, db_alias=db_alias, **make_field_dic(DatS, build_dic))
+        field_dic = make_field_dic(DatS, build_dic)
+        ds, created = fetch_or_save(
+            DatS, db_alias=db_alias, search_dict=field_dic, ingest_run=tracker.id, **field_dic
+        )
         if created:  # add to record of docs saved to db by this run through
-            created_doc_ids.append((DataSource, ds.id))
+            tracker.created(DataSource)
 
     Import.ds = ds
 
@@ -126,32 +365,193 @@ class Import:
     createddate = None
     description = None
     gen_col = None
+    storage = 'documents'
+    data_type = 'Genotype'
+    gene_col = 'gene_id'
+    conditions = {}
+    lib_types = {}
+    inserter = None
+    encoder = None
+    # SummaryWriter of the file being loaded, None when the rows aren't being loaded
+    # (eg. by benchmark_ingest.time_build)
+    summary = None
 
     @staticmethod
     def load_op(line, succ):
         pr = Genotype(
             name=line[Import.gen_col], study=Import.study, datasource=Import.ds,
             createddate=Import.createddate, description=Import.description,
+            ingest_run=tracker.id,
         )
         SaveKVs(pr, line)
+        set_coordinates(pr, pr.obs)
+        set_ontology_fields(pr)
+        if Import.summary:
+            Import.summary.add([line.get(key) for key in Import.summary.header])
+        if Import.encoder:
+            pr.obs_values = Import.encoder.encode(pr.obs)
+            pr.obs = None
+        if Import.inserter:
+            Import.inserter.add(pr)
+            return True
         pr.switch_db(db_alias)
         pr.save()
         # add to record of docs saved to db by this run through
-        created_doc_ids.append((Genotype, pr.id))
+        tracker.created(Genotype)
+        return True
+
+    @staticmethod
+    def load_batch_op(rows, header_index, succ):
+        # Builds the genotypes straight from positional rows, without a dict per csv row
+        keys = [None] * len(header_index)
+        for key in header_index:
+            keys[header_index[key]] = key.replace(".", "-")
+        gen_i = header_index[Import.gen_col]
+        get_coordinates = coordinate_getter(keys)
+        for row in rows:
+            chrom, pos = get_coordinates(row)
+            pr = Genotype(
+                name=row[gen_i], study=Import.study, datasource=Import.ds,
+                createddate=Import.createddate, description=Import.description,
+                ingest_run=tracker.id, chrom=chrom, pos=pos,
+            )
+            # the data source is a loaded document, so GetName() doesn't look it up
+            set_ontology_fields(pr)
+            if Import.encoder:
+                pr.obs_values = Import.encoder.encode_row(keys, row)
+                pr.obs = None
+            else:
+                obs = dict(zip(keys, row))
+                # a repeated column name only keeps its last column, like csv.DictReader
+                obs.pop(None, None)
+                pr.obs = obs
+            Import.inserter.add(pr)
+            if Import.summary:
+                Import.summary.add(row)
+        # the counts of every batch are added to the data source's summary as it is loaded
+        if Import.summary:
+            Import.summary.flush()
         return True
 
+    @staticmethod
+    def record_inserted(ids):
+        # add to record of docs saved to db by this run through
+        tracker.created(Genotype, len(ids))
+
+    @staticmethod
+    def record_chunks(n):
+        tracker.created(GenotypeMatrixChunk, n)
+        if Import.summary:
+            Import.summary.add_documents(n)
+            Import.summary.flush()
+
+    @staticmethod
+    def record_expression_chunks(n):
+        tracker.created(ExpressionMatrixChunk, n)
+
     @staticmethod
     def clean_op():
         Primer.objects.filter(datasource=Import.ds).delete()
 
 
 def load(fn):
+    if Import.data_type == 'Expression':
+        return load_expression(fn)
+    if Import.storage == 'matrix':
+        return load_matrix(fn)
     conn = CsvConnector(fn, delimiter='\t', gzipped=True)
     im = GenericImport(conn)
     im.load_op = Import.load_op
     im.clean_op = Import.clean_op
-    im.Clean()
-    im.Load()
+    Import.summary = summary_writer(conn.header)
+    if batch_size:
+        Import.inserter = BulkInserter(
+            Genotype, db_alias=db_alias, batch_size=batch_size, on_insert=Import.record_inserted,
+            lean=lean, measure=True,
+        )
+        im.batch_op = Import.load_batch_op
+        im.chunk_size = batch_size
+    if encode_obs:
+        Import.encoder = ObsKeyEncoder(Import.ds, db_alias, tracker.id)
+        if Import.encoder.created:
+            tracker.created(ObsKeys)
+    try:
+        im.Clean()
+        im.Load()
+        if Import.encoder:
+            # a failed load is rolled back, so the keys only need saving once it is done
+            Import.encoder.save()
+        if Import.inserter:
+            Import.inserter.flush()
+            Import.inserter.report(fn)
+            Import.summary.add_documents(0, Import.inserter.bytes)
+        Import.summary.flush()
+        # exports of the experiment work out their header again, with the new data
+        invalidate_headers(Genotype._get_collection_name(), Import.study, Import.ds, db_alias)
+    finally:
+        Import.inserter = None
+        Import.encoder = None
+        Import.summary = None
+
+
+def summary_writer(header):
+    # Keeps the counts of the file's rows in the summary of its data source
+    writer = SummaryWriter(
+        header, [Import.gen_col] + hapmap_info_columns, Import.study, Import.ds, db_alias,
+        tracker.id,
+    )
+    if writer.created:
+        tracker.created(DataSummary)
+    return writer
+
+
+def load_matrix(fn):
+    # Writes the file's calls to a GenotypeMatrix, without a document or dict per row
+    conn = CsvConnector(fn, delimiter='\t', gzipped=True)
+    writer = MatrixWriter(
+        conn.header, Import.gen_col, db_alias=db_alias, on_insert=Import.record_chunks,
+        study=Import.study, datasource=Import.ds, createddate=Import.createddate,
+        description=Import.description, ingest_run=tracker.id,
+    )
+    tracker.created(GenotypeMatrix)
+    Import.summary = summary_writer(conn.header)
+    try:
+        for rows in conn.chunks(writer.chunk_rows):
+            for row in rows:
+                writer.add(row)
+                Import.summary.add(row, documents=0)
+        writer.flush()
+        Import.summary.add_documents(1, writer.bytes)
+        Import.summary.flush()
+    finally:
+        conn.close()
+        Import.summary = None
+    Logger.Message(
+        "Stored %d markers x %d samples of %s as a matrix" % (
+            writer.matrix.n_markers, len(writer.matrix.samples), fn
+        )
+    )
+
+
+def load_expression(fn):
+    # Writes the file's count table to an ExpressionMatrix, in one pass over its rows
+    conn = CsvConnector(fn, delimiter='\t', gzipped=True)
+    tracker.created(ExpressionMatrix)
+    try:
+        matrix = load_count_table(
+            conn, Import.gene_col, db_alias, chunk_size=batch_size or 1000,
+            conditions=Import.conditions, lib_types=Import.lib_types,
+            on_insert=Import.record_expression_chunks, study=Import.study, datasource=Import.ds,
+            createddate=Import.createddate, description=Import.description,
+            ingest_run=tracker.id,
+        )
+    finally:
+        conn.close()
+    Logger.Message(
+        "Stored %d genes x %d libraries of %s as a matrix" % (
+            matrix.n_genes, len(matrix.libraries), fn
+        )
+    )
 
 
 def config_dic_to_build_dic(config_dic):
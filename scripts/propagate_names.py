@@ -0,0 +1,29 @@
+"""
+Updates the copies of experiment and data source names held by Feature documents
+(study_name and datasource_name) after experiments or data sources have been renamed,
+and gives the copies to features saved before they carried them (see
+mongcore.name_copies). Run with no arguments to check every experiment and data source
+
+Usage:
+    ./manage.py runscript propagate_names
+    ./manage.py runscript propagate_names --script-args Experiment
+    ./manage.py runscript propagate_names --script-args DataSource 56a1b2c3d4e5f6a7b8c9d0e1
+"""
+
+from bson import ObjectId
+from mongcore.models import Experiment, DataSource
+from mongcore.name_copies import propagate_names
+from mongcore.logger import Logger
+
+db_alias = 'default'
+documents = {'Experiment': Experiment, 'DataSource': DataSource}
+
+
+def run(*args):
+    names = [arg for arg in args if arg in documents] or sorted(documents)
+    ids = [ObjectId(arg) for arg in args if arg not in documents] or None
+    for name in names:
+        n = propagate_names(documents[name], ids, db_alias)
+        msg = "propagate_names: updated the %s names of %d features" % (name, n)
+        Logger.Message(msg)
+        print(msg)
@@ -1,8 +1,22 @@
-from . import load_from_config, configuration_parser
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from . import load_from_config, configuration_parser, benchmark_ingest, encode_obs
+from . import benchmark_storage, benchmark_export
+from mongoengine import register_connection
+from mongoengine.connection import get_connection
 from kaka.settings import TEST_DB_ALIAS
 from mongoengine.context_managers import switch_db
-from mongcore.models import Experiment, DataSource
+from mongcore.models import Experiment, DataSource, IngestRun, DataError, set_ontology_fields
+from mongcore.ingest_runs import roll_back_run
+from mongcore.summaries import experiment_summaries
+from mongcore.query_set_helpers import document_dict
 from mongenotype.models import Genotype
+from mongenotype.matrix import genotypes_for_study
+from gene_expression.models import ExpressionMatrix
+from gene_expression.matrix import delete_expression_matrices
 from datetime import datetime
 from mongcore.tests import MasterTestCase, expected_experi_model, expected_ds_model
 
@@ -40,6 +54,9 @@ expected_genotype_yaml = Genotype(
     createddate=datetime(2016, 1, 7), obs={'foo': '1', 'bar': '2', 'baz': '3', 'rs#': 'Test source'},
     study=expected_experiment_yaml, datasource=expected_datasource_yaml
 )
+# the loader sets the ontology fields of the genotypes it builds
+set_ontology_fields(expected_genotype_json)
+set_ontology_fields(expected_genotype_yaml)
 yaml_config_string = """---
 Data Creator : Badi James
 Experiment Description : >-
@@ -85,6 +102,10 @@ class ScriptsTestCase(MasterTestCase):
         load_from_config.testing = True
         load_from_config.db_alias = TEST_DB_ALIAS
         load_from_config.path_string = "test_resources/"
+        load_from_config.batch_size = 1000
+        load_from_config.incremental = False
+        load_from_config.encode_obs = False
+        load_from_config.lean = False
         super(ScriptsTestCase, self).setUp()
 
     def tearDown(self):
@@ -97,6 +118,8 @@ class ScriptsTestCase(MasterTestCase):
         json_config = open(path_string_json_full, 'w')
         json_config.write(json_config_string)
         json_config.close()
+        with switch_db(IngestRun, TEST_DB_ALIAS) as TestRun:
+            TestRun.objects.all().delete()
         super(ScriptsTestCase, self).tearDown()
 
     def test_run_json(self):
@@ -135,6 +158,18 @@ class ScriptsTestCase(MasterTestCase):
             self.assertEqual(len(query), 1)
             self.document_compare(query.first(), expected_genotype_yaml)
 
+    def test_run_json_unbatched(self):
+        """
+        Test loads in the data correctly when genotype documents are saved one at a time
+        instead of being written in batches
+        """
+        load_from_config.batch_size = 0
+        load_from_config.load_in_dir(path_string_json)
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            query = TestGen.objects.all()
+            self.assertEqual(len(query), 1)
+            self.document_compare(query.first(), expected_genotype_json)
+
     def test_json_marked_loaded_no_load(self):
         """
         Test script does not load data from a directory where the config.json file has been marked as loaded
@@ -276,6 +311,297 @@ class ScriptsTestCase(MasterTestCase):
             query = TestGen.objects.all()
             self.assertEqual(len(query), 0)
 
+    def test_ingest_run_roll_back(self):
+        """
+        Tests that load_from_config.run() stamps every document it creates with the id of
+        its ingest run, and that rolling back the run removes exactly those documents
+        """
+        expected_experi_model.switch_db(TEST_DB_ALIAS)
+        expected_experi_model.save()
+        load_from_config.run()
+        with switch_db(IngestRun, TEST_DB_ALIAS) as TestRun:
+            ingest_run = TestRun.objects.get()
+        self.assertEqual(ingest_run.status, 'done')
+        self.assertEqual(ingest_run.counts, {'Experiment': 2, 'DataSource': 2, 'Genotype': 2})
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            self.assertEqual(TestGen.objects(ingest_run=ingest_run.id).count(), 2)
+
+        roll_back_run(ingest_run.id, TEST_DB_ALIAS)
+        with switch_db(Experiment, TEST_DB_ALIAS) as TestEx:
+            query = TestEx.objects.all()
+            self.assertEqual(len(query), 1)
+            self.document_compare(query[0], expected_experi_model)
+        with switch_db(DataSource, TEST_DB_ALIAS) as TestDs:
+            self.assertEqual(TestDs.objects.count(), 0)
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            self.assertEqual(TestGen.objects.count(), 0)
+        with switch_db(IngestRun, TEST_DB_ALIAS) as TestRun:
+            self.assertEqual(TestRun.objects.get().status, 'rolled back')
+
+    def test_roll_back_shared_experiment(self):
+        """
+        Tests that rolling back a run keeps the experiment it created while a later run's
+        documents reference it, and that a run can only be rolled back once
+        """
+        path = tempfile.mkdtemp(prefix="roll_back_")
+        try:
+            benchmark_ingest.make_gbs_dir(path + "/first/Shared", 5, 2)
+            benchmark_ingest.make_gbs_dir(path + "/second/Shared", 5, 2)
+            load_from_config.load_in_dir(path + "/first/Shared")
+            load_from_config.load_in_dir(path + "/second/Shared")
+            with switch_db(IngestRun, TEST_DB_ALIAS) as TestRun:
+                first, second = TestRun.objects.order_by('started')
+            self.assertEqual(first.counts.get('Experiment'), 1)
+            self.assertNotIn('Experiment', second.counts)
+
+            removed = roll_back_run(first.id, TEST_DB_ALIAS)
+            self.assertEqual(
+                (removed['Experiment'], removed['DataSource'], removed['Genotype']), (0, 1, 5)
+            )
+            with switch_db(Experiment, TEST_DB_ALIAS) as TestEx:
+                self.assertEqual(TestEx.objects.count(), 1)
+            with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+                self.assertEqual(TestGen.objects(ingest_run=second.id).count(), 5)
+            with self.assertRaises(DataError):
+                roll_back_run(first.id, TEST_DB_ALIAS)
+
+            roll_back_run(second.id, TEST_DB_ALIAS)
+            with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+                self.assertEqual(TestGen.objects.count(), 0)
+        finally:
+            shutil.rmtree(path)
+
+    def test_incremental_load(self):
+        """
+        Tests that an incremental load skips files that have not changed since they were
+        loaded, adds new files and replaces the data of files that have changed
+        """
+        new_file = path_string_json + "/b_test_source.hmp.txt.gz"
+        load_from_config.load_in_dir(path_string_json)
+        load_from_config.incremental = True
+        try:
+            load_from_config.load_in_dir(path_string_json)
+            with switch_db(DataSource, TEST_DB_ALIAS) as TestDs:
+                self.assertEqual(TestDs.objects.count(), 1)
+            with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+                self.assertEqual(TestGen.objects.count(), 1)
+
+            with gzip.open(new_file, 'wt') as f:
+                f.write("rs#\tfoo\tbar\tbaz\nNew source\t4\t5\t6\n")
+            load_from_config.load_in_dir(path_string_json)
+            with switch_db(DataSource, TEST_DB_ALIAS) as TestDs:
+                self.assertEqual(TestDs.objects.count(), 2)
+            with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+                self.assertEqual(TestGen.objects.count(), 2)
+                self.assertEqual(TestGen.objects.get(name='New source').obs['foo'], '4')
+
+            with gzip.open(new_file, 'wt') as f:
+                f.write("rs#\tfoo\tbar\tbaz\nChanged source\t7\t8\t9\n")
+            load_from_config.load_in_dir(path_string_json)
+            with switch_db(DataSource, TEST_DB_ALIAS) as TestDs:
+                self.assertEqual(TestDs.objects(source=new_file).count(), 1)
+                self.assertEqual(TestDs.objects.count(), 2)
+            with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+                self.assertEqual(
+                    sorted(gen.name for gen in TestGen.objects), ['Changed source', 'Test source']
+                )
+        finally:
+            os.remove(new_file)
+
+    def test_load_parallel(self):
+        """
+        Tests that a directory of several files loads across a pool of worker processes,
+        a data source per file, and that a file that fails is reported once the pool is
+        done instead of the pool hanging
+        """
+        path = tempfile.mkdtemp(prefix="load_parallel_")
+        load_from_config.workers = 2
+        try:
+            benchmark_ingest.make_gbs_dir(path + "/Parallel", 20, 3, n_files=2)
+            load_from_config.load_in_dir(path + "/Parallel")
+            with switch_db(DataSource, TEST_DB_ALIAS) as TestDs:
+                self.assertEqual(TestDs.objects.count(), 2)
+            with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+                self.assertEqual(TestGen.objects.count(), 40)
+
+            benchmark_ingest.make_gbs_dir(path + "/Broken", 20, 3, n_files=1)
+            with open(path + "/Broken/not_gzipped.hmp.txt.gz", 'w') as f:
+                f.write("rs#\tS1\nS1_1\tA\n")
+            with self.assertRaises(DataError) as raised:
+                load_from_config.load_in_dir(path + "/Broken")
+            self.assertIn("not_gzipped.hmp.txt.gz", str(raised.exception))
+        finally:
+            load_from_config.workers = 1
+            shutil.rmtree(path)
+
+    def test_load_expression(self):
+        """
+        Tests that a directory whose config has the Expression data type loads its count
+        table as an ExpressionMatrix, with the libraries' conditions from the config
+        """
+        path = tempfile.mkdtemp(prefix="load_expression_")
+        config = json.loads(json_config_string)
+        del config['Genotype Column']
+        config.update({
+            'Data Type': 'Expression', 'Library Conditions': {'L1': 'cold', 'L2': 'warm'}
+        })
+        try:
+            os.mkdir(path + "/Counts")
+            with open(path + "/Counts/config.json", 'w') as f:
+                json.dump(config, f)
+            with gzip.open(path + "/Counts/counts.tsv.gz", 'wt') as f:
+                f.write("gene_id\tlength\tL1\tL2\ng0\t100\t1.5\t0\ng1\t200\t3\tNA\n")
+            load_from_config.load_in_dir(path + "/Counts")
+            with switch_db(ExpressionMatrix, TEST_DB_ALIAS) as TestMatrix:
+                matrix = TestMatrix.objects.get()
+            self.assertEqual(matrix.n_genes, 2)
+            self.assertEqual(matrix.conditions, ['cold', 'warm'])
+            genes, columns = matrix.values(condition='cold', db_alias=TEST_DB_ALIAS)
+            self.assertEqual(genes, ['g0', 'g1'])
+            self.assertEqual(list(columns['L1']), [1.5, 3])
+            with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+                self.assertEqual(TestGen.objects.count(), 0)
+        finally:
+            with switch_db(DataSource, TEST_DB_ALIAS) as TestDs:
+                for ds in TestDs.objects.all():
+                    delete_expression_matrices(ds.id, TEST_DB_ALIAS)
+            shutil.rmtree(path)
+
+    def test_benchmark_ingest(self):
+        """
+        Tests that the ingest benchmark loads every row of the synthetic data it generates,
+        reports each stage, and leaves the database as it was
+        """
+        benchmark_ingest.db_alias = TEST_DB_ALIAS
+        result = benchmark_ingest.benchmark(50, 5, n_files=2, batch_size=20)
+        self.assertEqual(result['rows'], 100)
+        self.assertEqual(result['documents'], 100)
+        self.assertEqual(
+            sorted(result['stages']), ['build', 'decompress', 'parse', 'write']
+        )
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            self.assertEqual(TestGen.objects.count(), 0)
+
+    def test_benchmark_ingest_lean(self):
+        """
+        Tests that genotypes loaded lean take up fewer bytes per document than in full
+        """
+        benchmark_ingest.db_alias = TEST_DB_ALIAS
+        full = benchmark_ingest.benchmark(50, 5, batch_size=20)
+        lean = benchmark_ingest.benchmark(50, 5, batch_size=20, lean=True)
+        self.assertLess(lean['bytes_per_document'], full['bytes_per_document'])
+
+    def test_benchmark_storage(self):
+        """
+        Tests that the storage benchmark loads and exports every row of its synthetic
+        experiment under a setting, in its own scratch database
+        """
+        register_connection(
+            benchmark_storage.db_alias, name=benchmark_storage.db_name, host='mongodb://mongo'
+        )
+        try:
+            result = benchmark_storage.benchmark(
+                {'block_compressor': 'zlib', 'prefix_compression': True}, 20, 3, batch_size=10
+            )
+        finally:
+            get_connection(benchmark_storage.db_alias).drop_database(benchmark_storage.db_name)
+        self.assertEqual(result['rows'], 20)
+        self.assertGreater(result['data_mb'], 0)
+
+    def test_benchmark_export(self):
+        """
+        Tests that the export benchmark exports every row of its synthetic experiment by
+        both paths
+        """
+        register_connection(
+            benchmark_export.db_alias, name=benchmark_export.db_name, host='mongodb://mongo'
+        )
+        try:
+            result = benchmark_export.benchmark(20, 3, repeat=1, batch_size=10)
+        finally:
+            get_connection(benchmark_export.db_alias).drop_database(benchmark_export.db_name)
+        self.assertEqual(result['rows'], 20)
+        self.assertIn('csv_speedup', result)
+
+    def test_run_json_matrix(self):
+        """
+        Test loads the genotypes of a directory as a genotype matrix when its config asks
+        for matrix storage, and that they read back like Genotype documents
+        """
+        json_config = open(path_string_json_full, 'w')
+        json_config.write(json_config_string.replace(
+            '"Genotype Column" : "rs#"', '"Genotype Column" : "rs#",\n    "Genotype Storage" : "matrix"'
+        ))
+        json_config.close()
+        load_from_config.load_in_dir(path_string_json)
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            self.assertEqual(TestGen.objects.count(), 0)
+        with switch_db(Experiment, TEST_DB_ALIAS) as TestEx:
+            experiment = TestEx.objects.get()
+        genotypes = genotypes_for_study(experiment, TEST_DB_ALIAS)
+        self.assertEqual(len(genotypes), 1)
+        self.document_compare(genotypes[0], expected_genotype_json)
+
+    def test_run_json_summary(self):
+        """
+        Test loading keeps the counts of the data source's summary, which the experiment's
+        totals are read from
+        """
+        load_from_config.load_in_dir(path_string_json)
+        with switch_db(Experiment, TEST_DB_ALIAS) as TestEx:
+            experiment = TestEx.objects.get()
+        totals = experiment_summaries([experiment], TEST_DB_ALIAS)[experiment.pk]
+        self.assertEqual((totals['documents'], totals['markers'], totals['samples']), (1, 1, 3))
+        self.assertEqual(totals['call_rate'], {'foo': 1.0, 'bar': 1.0, 'baz': 1.0})
+        self.assertEqual(totals['missing_histogram'][0], 1)
+        self.assertGreater(totals['bytes'], 0)
+
+    def test_run_json_encode_obs(self):
+        """
+        Test loads genotypes with their obs encoded against the data source's key dictionary,
+        and that they read back with the same obs
+        """
+        load_from_config.encode_obs = True
+        load_from_config.load_in_dir(path_string_json)
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            son = TestGen._get_collection().find_one()
+            gen = TestGen.objects.get()
+        self.assertNotIn('obs', son)
+        self.assertEqual(len(son['obs_values']), 4)
+        self.assertEqual(document_dict(gen, testing=True)['obs'], expected_genotype_json.obs)
+
+    def test_run_json_lean(self):
+        """
+        Test loads genotypes without their default and inherited values, and that they read
+        back with those values filled in
+        """
+        load_from_config.lean = True
+        load_from_config.load_in_dir(path_string_json)
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            son = TestGen._get_collection().find_one()
+            for key in ('alias', 'statuscode', 'dtt', 'lastupdateddate', 'createddate', 'description'):
+                self.assertNotIn(key, son)
+            gen = TestGen.objects.get()
+            self.document_compare(gen, expected_genotype_json)
+            self.assertEqual(gen.alias, 'unknown')
+            self.assertEqual(gen.dtt, gen.lastupdateddate)
+
+    def test_encode_obs_migration(self):
+        """
+        Tests that the encode_obs script encodes the obs of genotypes already in the database
+        and can decode them again
+        """
+        load_from_config.load_in_dir(path_string_json)
+        encode_obs.db_alias = TEST_DB_ALIAS
+        self.assertEqual(encode_obs.encode_collection(Genotype), 1)
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            son = TestGen._get_collection().find_one()
+            self.assertNotIn('obs', son)
+            gen = TestGen.objects.get()
+            self.assertEqual(document_dict(gen, testing=True)['obs'], expected_genotype_json.obs)
+            self.assertEqual(encode_obs.decode_collection(Genotype), 1)
+            self.document_compare(TestGen.objects.get(), expected_genotype_json)
+
     def test_config_parser_to_json_yaml(self):
         """
         Tests that the YamlConfigParser get_json_string() method outputs a correct json formatted
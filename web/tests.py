@@ -5,6 +5,9 @@ from datetime import datetime
 from scripts.configuration_parser import datetime_parse
 from mongcore.tests import MasterTestCase
 from mongcore import test_db_setup
+from mongenotype.models import Genotype
+from kaka.settings import TEST_DB_ALIAS
+from mongoengine.context_managers import switch_db
 
 
 class ReportTestCase(MasterTestCase):
@@ -70,7 +73,7 @@ class ReportTestCase(MasterTestCase):
             "from_date_year": 2015, "from_date_month": 11, "from_date_day": 20
         }
         response = self.client.get("/api/genotype/", get_data)
-        actual_bytes = response.content
+        actual_bytes = b"".join(response.streaming_content)
         up_createddate = datetime(2016, 1, 11, 17, 1, 25)
         up_dtt = datetime(2016, 1, 11, 17, 39, 27)
         what_is_up = [{
@@ -234,7 +237,7 @@ class ReportTestCase(MasterTestCase):
         correct json file of Genotype documents that reference the experiments that match the query
         """
         response = self.client.get("/api/genotype/", {"search_name": "What"})
-        actual_bytes = response.content
+        actual_bytes = b"".join(response.streaming_content)
         up_createddate = datetime(2016, 1, 11, 17, 1, 25)
         up_dtt = datetime(2016, 1, 11, 17, 39, 27)
         going_createddate = datetime(2016, 1, 11, 18, 1, 25)
@@ -281,3 +284,21 @@ class ReportTestCase(MasterTestCase):
         response = self.client.get("/api/genotype/?search_name=Banana")
         self.assertFalse(hasattr(response, 'streaming_content'))
         self.assertContains(response, "No Data")
+
+    def test_report_genotype_region(self):
+        """
+        Tests that the link '/api/genotype/region/' streams the genotypes on the region in
+        position order
+        """
+        with switch_db(Genotype, TEST_DB_ALIAS) as TestGen:
+            for name, pos in [('far', 300), ('near', 100), ('outside', 50)]:
+                TestGen(name=name, chrom='1', pos=pos, obs={'S1': 'A'}).save()
+        response = self.client.get("/api/genotype/region/", {"chrom": "1", "start": 100})
+        rows = b"".join(response.streaming_content).decode("utf-8").splitlines()
+        self.assertEqual(rows[0], "name,chrom,pos,study__name,datasource__name,obs")
+        self.assertEqual([row.split(',')[:3] for row in rows[1:]], [['near', '1', '100'], ['far', '1', '300']])
+
+    def test_report_genotype_bad_region(self):
+        response = self.client.get("/api/genotype/region/", {"chrom": "1", "start": 200, "stop": 100})
+        self.assertFalse(hasattr(response, 'streaming_content'))
+        self.assertContains(response, "can't be queried")
@@ -2,6 +2,7 @@ import csv
 import json
 import re
 from collections import OrderedDict
+from itertools import chain
 
 from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render
@@ -11,13 +12,17 @@ from mongcore.models import DataSource, Experiment
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
-from mongcore.query_set_helpers import query_to_csv_rows_list, build_dict
-from mongcore.view_helpers import write_stream_response
+from mongcore.query_set_helpers import query_to_csv_rows, export_dicts
+from mongcore.references import RefNames
+from mongcore.view_helpers import write_stream_response, write_rows_response
 from kaka.settings import TEST_DB_ALIAS
 from mongoengine.context_managers import switch_db
 from mongcore.query_from_request import QueryRequestHandler
+from mongcore.summaries import experiment_summaries
 from scripts.configuration_parser import DateTimeJSONEncoder
 from mongenotype.models import *
+from mongenotype.matrix import genotype_parts, has_genotypes, study_csv_rows
+from mongenotype.regions import parse_region, region_query, region_rows
 from django.core.urlresolvers import reverse_lazy
 
 from querystring_parser import parser
@@ -82,7 +87,7 @@ def page_report(request, report, fmt='csv', conf=None):
     if objs.count()==0:
         return HttpResponse('No Data')
 
-    rows = query_to_csv_rows_list(objs, testing=testing)
+    rows = query_to_csv_rows(objs, testing=testing)
     return write_stream_response(rows, report)
 
 
@@ -102,12 +107,17 @@ def genotype_report(request):
     - search_pi=[string] : Queries experiments by primary investigator
     - from_date_day=[int]&from_date_month=[int]&from_date_year=[int] : Queries experiments by createddate > from_date
     - to_date_day=[int]&to_date_month=[int]&to_date_year=[int] : Queries experiments by createddate < to_date
+    - include_archived=true : Also includes the genotypes of archived data sources (see mongcore.archive)
 
     :param request: Use to query Genotype collection with
     :return: HttpResponse with file representation of Genotype query set(s)
     """
     db_alias = TEST_DB_ALIAS if testing else 'default'
 
+    # include_archived is not a field of experiments, so is kept out of their query
+    get = request.GET.copy()
+    include_archived = get.pop('include_archived', ['false'])[0].lower() in ('true', '1', 'on')
+    request.GET = get
     index_helper = QueryRequestHandler(request, testing=testing)
     try:
         experiments = index_helper.query_for_api()
@@ -116,71 +126,135 @@ def genotype_report(request):
     if len(experiments) == 0:
         return HttpResponse('No Data')
     if len(experiments) == 1:
-        return genotype_csv_report(db_alias, experiments[0])
+        return genotype_csv_report(db_alias, experiments[0], include_archived)
     else:
-        return genotype_json_report(db_alias, experiments)
+        return genotype_json_report(db_alias, experiments, include_archived)
 
 
-def genotype_json_report(db_alias, experiments):
+def genotype_json_report(db_alias, experiments, include_archived=False):
     """
     Creates a JSON file from the given query set of Experiments. Each experiment's name is a key to a list
     of JSON doc representations of the Genotype documents that have the experiment as their study field
     value.
 
-    Returns the JSON file as an attachment for an HttpResponse
+    Returns the JSON file as an attachment for a StreamingHttpResponse. The genotypes are read
+    and written one at a time as the response is streamed
 
     :param db_alias: Alias of database to search through
     :param experiments: Queryset of experiments to use to query the Genotype collection by study
-    :return: HttpResponse with JSON representation of the query sets as an attachment
+    :param include_archived: Also includes the genotypes of archived data sources
+    :return: StreamingHttpResponse with JSON representation of the query sets as an attachment
     """
-    no_data = True  # Used to indicate that no genotype documents referenced any of the experiments
-    json_list = ["{"]
-    outer_list = []  # To contain experiment keys and their values list, as strings
-    for exper in experiments:
-        name = "\"{0}\"".format(exper.name)  # Experiment name as a key
-        experi_string = "\t" + name + " : [\n\t\t"  # Start of list token
-        with switch_db(Genotype, db_alias) as Gen:
-            obs = Gen.objects.filter(study=exper)  # Uses experiment to query genotype collection
-        # If query set contains anything, there are some genotype documents for the JSON file,
-        # so no_data becomes False and stays False for the rest of the iteration through this loop
-        if no_data:
-            no_data = len(obs) == 0
-        # Builds list of genotype documents that reference the experiment
-        inner_list = []
-        for gen in obs:
-            inner_list.append(json.dumps(build_dict(gen, testing), cls=DateTimeJSONEncoder))
-        experi_string += ',\n\t\t'.join(inner_list)
-        experi_string += "\n\t]"  # end of list token
-        outer_list.append(experi_string)
-
-    if no_data:
+    experiments = list(experiments)
+    # Existence queries rather than counts, to check whether any genotype documents
+    # reference the experiments before the response is started
+    if not any(has_genotypes(exper, db_alias, include_archived) for exper in experiments):
         # no genotype documents referenced any of the experiments, so return no JSON file
         return HttpResponse('No Data')
 
-    # puts the strings together to build the JSON file
-    experiments_string = ',\n'.join(outer_list)
-    json_list.append(experiments_string)
-    json_list.append("}")
-    file_content = "\n".join(json_list)
-
-    response = HttpResponse(file_content)
+    response = StreamingHttpResponse(
+        genotype_json_chunks(db_alias, experiments, include_archived), content_type="application/json"
+    )
     content = 'attachment; filename="Genotype.json"'
     response['Content-Disposition'] = content
     return response
 
 
-def genotype_csv_report(db_alias, experiment):
+def genotype_json_chunks(db_alias, experiments, include_archived=False):
+    # Yields the JSON file of genotype_json_report() a genotype document at a time
+    ref_names = RefNames(db_alias)
+    yield "{\n"
+    for i, exper in enumerate(experiments):
+        ref_names.add('study', exper)
+        name = json.dumps(exper.name)  # Experiment name as a key
+        yield (",\n" if i else "") + "\t" + name + " : [\n\t\t"  # Start of list token
+        # Uses experiment to query genotype collection and matrices. The Genotype query set
+        # is read raw, the genotypes of matrices and archives as documents
+        parts = genotype_parts(exper, db_alias, include_archived)
+        obs = chain(*[export_dicts(part, testing, ref_names) for part in parts])
+        for j, gen_dict in enumerate(obs):
+            doc = json.dumps(gen_dict, cls=DateTimeJSONEncoder)
+            yield (",\n\t\t" if j else "") + doc
+        yield "\n\t]"  # end of list token
+    yield "\n}"
+
+
+def genotype_csv_report(db_alias, experiment, include_archived=False):
     """
     Queries the Genotype collection for documents referencing the given Experiment, then returns
     a StreamingHttpResponse with a csv representation of the resulting queryset as an attachment
 
     :param db_alias: Alias of database to query
     :param experiment: Experiment use to query genotype by study
+    :param include_archived: Also includes the genotypes of archived data sources
     :return: StreamingHttpResponse with csv representation of acquired queryset as an attachment
     """
-    with switch_db(Genotype, db_alias) as Gen:
-        obs = Gen.objects.filter(study=experiment)
-    if len(obs) == 0:
+    if not has_genotypes(experiment, db_alias, include_archived):
         return HttpResponse('No Data')
-    rows = query_to_csv_rows_list(obs, testing=testing)
+    # the Genotype documents, matrices and archives are read one after another
+    rows = study_csv_rows(experiment, db_alias, include_archived, testing)
     return write_stream_response(rows, "Genotype")
+
+
+def experiment_summary_report(request):
+    """
+    For the summary statistics of experiments, read from the data summaries kept up to
+    date as their data is loaded rather than from the genotypes. Experiments are queried
+    from the GET data as for genotype_report()
+
+    :param request: Use to query Experiment collection with
+    :return: HttpResponse with a JSON object of each experiment's name to its number of
+             data sources, documents, markers, samples and bytes, the call rate of each
+             sample and the histogram of markers by fraction of missing calls. Experiments
+             with no summaries are left out
+    """
+    db_alias = TEST_DB_ALIAS if testing else 'default'
+
+    index_helper = QueryRequestHandler(request, testing=testing)
+    try:
+        experiments = index_helper.query_for_api()
+    except ExperiSearchError as e:
+        return HttpResponse(str(e))
+    summaries = experiment_summaries(experiments, db_alias)
+    content = OrderedDict(
+        (experiment.name, summaries[experiment.pk]) for experiment in experiments
+        if experiment.pk in summaries
+    )
+    if not content:
+        return HttpResponse('No Data')
+    return HttpResponse(json.dumps(content, indent=2), content_type='application/json')
+
+
+def genotype_region_report(request):
+    """
+    For downloading the genotypes on a region of a chromosome as a csv file, in position
+    order. The rows are streamed as they are read from the (chrom, pos) index
+
+    Query parsed from GET data following these rules:
+
+    - chrom=[string] : Chromosome, as named in the chrom column of the genotype files
+    - start=[int] : First position of the region (optional)
+    - stop=[int] : Last position of the region (optional)
+    - experiment=[string] : Name of an experiment to limit the genotypes to (optional)
+
+    :param request: Use to query Genotype collection with
+    :return: StreamingHttpResponse with csv file of the genotypes on the region
+    """
+    db_alias = TEST_DB_ALIAS if testing else 'default'
+
+    try:
+        chrom, start, stop = parse_region(
+            request.GET.get('chrom'), request.GET.get('start'), request.GET.get('stop')
+        )
+    except ExperiSearchError as e:
+        return HttpResponse(str(e))
+    study = None
+    if request.GET.get('experiment'):
+        with switch_db(Experiment, db_alias) as Exper:
+            study = Exper.objects(name=request.GET['experiment']).first()
+        if study is None:
+            return HttpResponse('No Data')
+    query = region_query(Genotype, chrom, start, stop, study, db_alias)
+    if query.first() is None:
+        return HttpResponse('No Data')
+    return write_rows_response(region_rows(query, db_alias), "Genotype_" + chrom)